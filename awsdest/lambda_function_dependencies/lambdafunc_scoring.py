@@ -1,114 +1,276 @@
-import boto3
-import os
-import sys
-import uuid
-from urllib.parse import unquote_plus
-
-from utils.lambdafunc_core_aws import *
-from utils.lambdafunc_core_k8s import *
-from utils.lambdafunc_core_restapi_score import *
-
-#
-import urllib.request
-import socket
-
-
-##
-
-def scoring_lambda_handler(event, context):
-    aws_region = os.environ['aws_region']
-
-    external_ip = urllib.request.urlopen('https://ident.me').read().decode('utf8')
-    print("External IP to add to Firewall ingress rules:", external_ip)
-    print("======= ")
-
-    fallback_modelname = os.environ['fallback_modelname']
-    fallback_clustername = os.environ['fallback_clustername']
-    fallback_ingress_url = os.environ['fallback_ingress_url']
-    fallback_k8s_namespace = os.environ['k8s_namespace']
-
-    s3out_folder = os.environ['s3_outputfolder']
-    s3out_bucket = urlparse(s3out_folder, allow_fragments=False).netloc
-
-    s3out_parsed = urlparse(s3out_folder, allow_fragments=False)
-    s3out_prefix = s3out_parsed.path.lstrip('/')
-
-    # reference structure of S3 event message at https://docs.aws.amazon.com/AmazonS3/latest/dev/notification-content-structure.html
-    for record in event['Records']:
-        scoring_start_time = time.ctime()
-        s3in_bucket = record['s3']['bucket']['name']
-        s3in_objectkey = unquote_plus(record['s3']['object']['key'])
-        s3out_objectkey = s3out_prefix + path.basename(s3in_objectkey) + ".scoreout"
-
-        # process tags to decide on what model, cluster, ingress and namespace we should act on.
-        process_tags_code, process_text, modelimagename, clustername, ingress_scoring_url, k8s_namespace = \
-            process_tags_on_file(s3in_bucket, s3in_objectkey, fallback_modelname, fallback_clustername,
-                                 fallback_ingress_url, fallback_k8s_namespace)
-        if not process_tags_code == 0:
-            err_msg = "Scoring Terminated for this file" + process_text
-            s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
-            upload_file_s3(s3outfile_presignedurl, text_message=err_msg)
-            return 100
-
-        # Validate model and EKS supplied.
-        validate_model_eks, validate_message = validate_modelimage_eks(modelimagename, clustername, aws_region)
-        if not validate_model_eks:
-            err_msg = validate_message + "Scoring terminated for this file. Either ModelImage or clustername is invalid. Please delete the original file in input bucket folder and recreate file with correct tags for ModelName. Just correcting tags will not invoke scoring."
-            s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
-            upload_file_s3(s3outfile_presignedurl, text_message=err_msg)
-            return 200
-
-        # deploy and check if that is good.
-        # We use unique_file_identifier to have a dedicated pod for each file received as a S3 Event. deployment_name cannot have / or ..
-        unique_env_id = s3in_objectkey.replace("/", "-").replace(".", "-")
-        ingress_scoring_url = ingress_scoring_url + "/" + unique_env_id
-        print("Ingress scoring url:", ingress_scoring_url)
-        print("Env this instance of lambda func dealing :", unique_env_id)
-
-        deployment_status_code, text_message = create_deployment_for_model(modelimagename, clustername, k8s_namespace,
-                                                                           aws_region, unique_env_id)
-        if not deployment_status_code == 0:
-            err_msg = text_message + "Deployment of POD failed. Scoring Aborted. Debug manually "
-            s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
-            upload_file_s3(s3outfile_presignedurl, text_message=err_msg)
-            return deployment_status_code
-
-        # wait for 2 min for ingress rule to commence handling traffic
-        start = time.time()
-        while (time.time() - start) < 120 and (not validate_pingpong_on_scoring(ingress_scoring_url)):
-            time.sleep(10)
-        if not validate_pingpong_on_scoring(ingress_scoring_url):
-            err_msg = 'Scoring terminated for this file.Ingress not responding to ping. Please check K8S deployment and Ingress. We did not delete the K8S deployment and Ingress for debugging. Please delete them after debug.'
-            err_msg_2 = "Also add External IP Address " + external_ip + " to Load Balancer Inbound Firewall rules. Lambda does not run in VPC by default and so this address may change from time to time."
-            s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
-            upload_file_s3(s3outfile_presignedurl, text_message=err_msg + err_msg_2)
-            return 400
-
-        s3infile_presignedurl = get_s3presignedurl(s3in_bucket, s3in_objectkey)
-        s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey)
-        scoring_status_code, scoring_msg = score_file_process(s3infile_presignedurl, s3outfile_presignedurl,
-                                                              ingress_scoring_url, unique_env_id)
-        if not scoring_status_code == 0:
-            err_msg = 'Scoring errors. Did not delete EKS pods. Please delete them after debug.' + scoring_msg
-            s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
-            upload_file_s3(s3outfile_presignedurl, text_message=err_msg)
-            return scoring_status_code
-
-        scoring_end_time = time.ctime()
-        s3_taglist = [
-            {'Key': 'Source of file scored', 'Value': s3in_bucket + "/" + s3in_objectkey},
-            {'Key': 'model_used_for_scoring', 'Value': modelimagename},
-            {'Key': 'Duration', 'Value': scoring_start_time + scoring_end_time},
-            {'Key': 'eks_used_for_scoring:namespace', 'Value': clustername + ":" + k8s_namespace},
-        ]
-        update_tags_s3file(s3out_bucket, s3out_objectkey, s3_taglist)
-
-        delete_status_code, text_message = delete_k8s_deployment(clustername, k8s_namespace, aws_region, unique_env_id)
-        if not delete_status_code == 0:
-            err_msg = text_message + "Scoring may have completed. But K8S assets not cleanuped. Do it manually"
-            s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
-            upload_file_s3(s3outfile_presignedurl, text_message=err_msg)
-            return delete_status_code
-
-        return 0
-
+import boto3
+import concurrent.futures
+import os
+import sys
+import uuid
+from urllib.parse import unquote_plus
+
+from utils.lambdafunc_core_aws import *
+from utils.lambdafunc_core_k8s import *
+from utils.lambdafunc_core_restapi_score import *
+from utils.lambdafunc_core_podpool import *
+from utils.lambdafunc_core_partition import *
+from utils.lambdafunc_core_result_cache import *
+
+#
+import urllib.request
+import socket
+
+
+##
+
+def _scoreout_error_key(record):
+    # <file>.scoreout.error under the output folder. For failures before the output format is known.
+    s3out_prefix = urlparse(os.environ['s3_outputfolder'], allow_fragments=False).path.lstrip('/')
+    return s3out_prefix + path.basename(unquote_plus(record['s3']['object']['key'])) + ".scoreout.error"
+
+
+def _score_s3_record(record, external_ip, pools):
+    # one S3 event record end to end: tags, deployment or pool lease, scoring, cleanup. Returns (status_code, message)
+    # and writes <file>.scoreout.error on failure. Runs on its own thread next to the other records of the event.
+    # A record that raises gives back the pool member it leased or deletes the deployment it created; the handler
+    # writes its error file.
+    held = {}
+    try:
+        return _score_s3_record_steps(record, external_ip, held, pools)
+    except Exception:
+        if 'pool_member' in held:
+            release_pool_member(*held['pool_member'])
+        if 'deployment' in held:
+            delete_k8s_deployment(*held['deployment'])
+        raise
+
+
+def _score_s3_record_steps(record, external_ip, held, pools):
+    # held gets (clustername, k8s_namespace, aws_region, id) of the pool member or deployment the record holds.
+    # pools gets (model image, cluster, namespace) of the warm pool the record leases from; the handler maintains it.
+    aws_region = os.environ['aws_region']
+
+    fallback_modelname = os.environ['fallback_modelname']
+    fallback_clustername = os.environ['fallback_clustername']
+    fallback_ingress_url = os.environ['fallback_ingress_url']
+    fallback_k8s_namespace = os.environ['k8s_namespace']
+    pool_config = get_pool_config_from_env(os.environ)
+
+    s3out_folder = os.environ['s3_outputfolder']
+    s3out_bucket = urlparse(s3out_folder, allow_fragments=False).netloc
+
+    s3out_parsed = urlparse(s3out_folder, allow_fragments=False)
+    s3out_prefix = s3out_parsed.path.lstrip('/')
+
+    scoring_start_time = time.ctime()
+    s3in_bucket = record['s3']['bucket']['name']
+    s3in_objectkey = unquote_plus(record['s3']['object']['key'])
+    s3out_objectkey = s3out_prefix + path.basename(s3in_objectkey) + ".scoreout"
+
+    # process tags to decide on what model, cluster, ingress, namespace and output format we should act on.
+    process_tags_code, process_text, modelimagename, clustername, ingress_scoring_url, k8s_namespace, output_format = \
+        process_tags_on_file(s3in_bucket, s3in_objectkey, fallback_modelname, fallback_clustername,
+                             fallback_ingress_url, fallback_k8s_namespace,
+                             os.environ.get('scoring_output_format', 'input'))
+    if not process_tags_code == 0:
+        err_msg = "Scoring Terminated for this file" + process_text
+        s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
+        upload_file_s3(s3outfile_presignedurl, text_message=err_msg)
+        return (100, err_msg)
+    # <file>.scoreout for csv, <file>.scoreout.parquet / .scoreout.arrow otherwise
+    output_format = output_format_of(s3in_objectkey, output_format)
+    s3out_objectkey = s3out_prefix + path.basename(s3in_objectkey) + SCOREOUT_SUFFIXES[output_format]
+
+    # big csv files are scored in partitions, one replica per partition up to partition_max_replicas. Partitions
+    # need the bytes in lambda, so not with direct_s3_io.
+    partition_size = int(os.environ.get('partition_size', 0))
+    s3in_size = record['s3']['object'].get('size', 0)
+    partitioned = output_format == 'csv' and not os.environ.get('direct_s3_io', 'false') == 'true' and \
+        is_partitionable(s3in_objectkey, s3in_size, partition_size)
+    replicas = min(partition_count(s3in_size, partition_size), int(os.environ.get('partition_max_replicas', 8))) \
+        if partitioned else 1
+
+    # same content scored before with this very model image: copy that scoreout, no pod needed.
+    result_cache_config = get_result_cache_config_from_env(os.environ)
+    s3in_etag = record['s3']['object'].get('eTag', '')
+    cache_prefix = result_cache_prefix(s3out_prefix)
+    image_digest = get_model_image_digest(modelimagename, aws_region) \
+        if result_cache_config['cache_enabled'] and not s3in_etag == '' else None
+    if image_digest is not None:
+        entry_key = lookup_result_cache(s3out_bucket, cache_prefix, s3in_etag, image_digest, output_format,
+                                        result_cache_config['cache_max_age'])
+        if entry_key is not None and copy_from_result_cache(s3out_bucket, entry_key, s3out_objectkey):
+            s3_taglist = [
+                {'Key': 'Source of file scored', 'Value': s3in_bucket + "/" + s3in_objectkey},
+                {'Key': 'model_used_for_scoring', 'Value': modelimagename},
+                {'Key': 'served_from_result_cache', 'Value': image_digest},
+            ]
+            update_tags_s3file(s3out_bucket, s3out_objectkey, s3_taglist)
+            return (0, "Copied from result cache into s3://" + s3out_bucket + "/" + s3out_objectkey)
+
+    # Validate model and EKS supplied.
+    validate_model_eks, validate_message = validate_modelimage_eks(modelimagename, clustername, aws_region)
+    if not validate_model_eks:
+        err_msg = validate_message + "Scoring terminated for this file. Either ModelImage or clustername is invalid. Please delete the original file in input bucket folder and recreate file with correct tags for ModelName. Just correcting tags will not invoke scoring."
+        s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
+        upload_file_s3(s3outfile_presignedurl, text_message=err_msg)
+        return (200, err_msg)
+
+    # deploy and check if that is good.
+    # We use unique_file_identifier to have a dedicated pod for each file received as a S3 Event. deployment_name cannot have / or ..
+    # With warm pod pool enabled we lease a pool member instead and its member id takes the place of unique_env_id.
+    unique_env_id = s3in_objectkey.replace("/", "-").replace(".", "-")
+    if is_pool_enabled(pool_config):
+        pools.add((modelimagename, clustername, k8s_namespace))
+        deployment_status_code, text_message, pool_member_id = lease_pool_member(modelimagename, clustername,
+                                                                                 k8s_namespace, aws_region,
+                                                                                 unique_env_id, pool_config)
+        unique_env_id = pool_member_id
+        if deployment_status_code == 0:
+            held['pool_member'] = (clustername, k8s_namespace, aws_region, unique_env_id)
+            # member may still be starting up. Returns right away for a warm one.
+            deployment_status_code, text_message = wait_for_deployment_ready(clustername, k8s_namespace,
+                                                                             aws_region, unique_env_id, 120)
+            if not deployment_status_code == 0:
+                # broken member (bad image, crash loop, unschedulable). Drop it so nobody else leases it.
+                delete_k8s_deployment(clustername, k8s_namespace, aws_region, unique_env_id)
+                del held['pool_member']
+    else:
+        held['deployment'] = (clustername, k8s_namespace, aws_region, unique_env_id)
+        deployment_status_code, text_message = create_deployment_for_model(modelimagename, clustername,
+                                                                           k8s_namespace, aws_region, unique_env_id,
+                                                                           replicas)
+    if not deployment_status_code == 0:
+        err_msg = text_message + "Deployment of POD failed. Scoring Aborted. Debug manually "
+        s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
+        upload_file_s3(s3outfile_presignedurl, text_message=err_msg)
+        return (deployment_status_code, err_msg)
+
+    ingress_scoring_url = ingress_scoring_url + "/" + unique_env_id
+    print("Ingress scoring url:", ingress_scoring_url)
+    print("Env this instance of lambda func dealing :", unique_env_id)
+
+    # pods are ready and routable by now. Only the ingress controller may still be syncing the new rule.
+    start = time.time()
+    while (time.time() - start) < 120 and (not validate_pingpong_on_scoring(ingress_scoring_url)):
+        time.sleep(2)
+    if not validate_pingpong_on_scoring(ingress_scoring_url):
+        err_msg = 'Scoring terminated for this file.Ingress not responding to ping. Please check K8S deployment and Ingress. We did not delete the K8S deployment and Ingress for debugging. Please delete them after debug.'
+        err_msg_2 = "Also add External IP Address " + external_ip + " to Load Balancer Inbound Firewall rules. Lambda does not run in VPC by default and so this address may change from time to time."
+        s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
+        upload_file_s3(s3outfile_presignedurl, text_message=err_msg + err_msg_2)
+        return (400, err_msg + err_msg_2)
+
+    s3infile_presignedurl = get_s3presignedurl(s3in_bucket, s3in_objectkey)
+    s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey)
+    if os.environ.get('direct_s3_io', 'false') == 'true':
+        scoring_status_code, scoring_msg = score_file_process_direct_s3(s3infile_presignedurl,
+                                                                        s3outfile_presignedurl,
+                                                                        ingress_scoring_url,
+                                                                        input_filename=path.basename(s3in_objectkey),
+                                                                        output_format=output_format)
+    elif os.environ.get('streaming_scoring', 'false') == 'true' and input_format_of(s3in_objectkey) == 'csv' and \
+            output_format == 'csv' and not partitioned:
+        # streaming is csv in, csv out. Parquet/Arrow and partitioned files take the regular path below.
+        scoring_status_code, scoring_msg = score_file_process_streaming(s3infile_presignedurl,
+                                                                        s3outfile_presignedurl,
+                                                                        ingress_scoring_url, unique_env_id,
+                                                                        s3out_location=(s3out_bucket, s3out_objectkey))
+    else:
+        scoring_status_code, scoring_msg = score_file_process(s3infile_presignedurl, s3outfile_presignedurl,
+                                                              ingress_scoring_url, unique_env_id,
+                                                              s3out_location=(s3out_bucket, s3out_objectkey),
+                                                              input_filename=path.basename(s3in_objectkey),
+                                                              output_format=output_format,
+                                                              partition_size=partition_size if partitioned else 0)
+    if not scoring_status_code == 0:
+        err_msg = 'Scoring errors. Did not delete EKS pods. Please delete them after debug.' + scoring_msg
+        if is_pool_enabled(pool_config):
+            # pool member goes back to the pool. Its lease would expire anyway.
+            release_pool_member(clustername, k8s_namespace, aws_region, unique_env_id)
+            err_msg = 'Scoring errors. Pool member ' + unique_env_id + ' released back to pool.' + scoring_msg
+        s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
+        upload_file_s3(s3outfile_presignedurl, text_message=err_msg)
+        return (scoring_status_code, err_msg)
+
+    scoring_end_time = time.ctime()
+    s3_taglist = [
+        {'Key': 'Source of file scored', 'Value': s3in_bucket + "/" + s3in_objectkey},
+        {'Key': 'model_used_for_scoring', 'Value': modelimagename},
+        {'Key': 'Duration', 'Value': scoring_start_time + scoring_end_time},
+        {'Key': 'eks_used_for_scoring:namespace', 'Value': clustername + ":" + k8s_namespace},
+    ]
+    update_tags_s3file(s3out_bucket, s3out_objectkey, s3_taglist)
+    if image_digest is not None:
+        # cached under the digest of the image that did the scoring. When that is not the :latest digest looked up
+        # above (leased pool member from before a push, :latest moved meanwhile) the output is not stored: it would
+        # be served for the newer model.
+        deployed_digest = get_deployment_image_digest(clustername, k8s_namespace, aws_region, unique_env_id)
+        if deployed_digest == image_digest:
+            store_in_result_cache(s3out_bucket, s3out_objectkey, cache_prefix, s3in_etag, image_digest, output_format)
+        else:
+            print("Not stored in result cache. Scored with image", deployed_digest, "not", image_digest)
+
+    if is_pool_enabled(pool_config):
+        delete_status_code, text_message = release_pool_member(clustername, k8s_namespace, aws_region, unique_env_id)
+    else:
+        delete_status_code, text_message = delete_k8s_deployment(clustername, k8s_namespace, aws_region,
+                                                                 unique_env_id)
+    if not delete_status_code == 0:
+        err_msg = text_message + "Scoring may have completed. But K8S assets not cleanuped. Do it manually"
+        s3outfile_presignedurl = get_s3presignedurl_for_post(s3out_bucket, s3out_objectkey + ".error")
+        upload_file_s3(s3outfile_presignedurl, text_message=err_msg)
+        return (delete_status_code, err_msg)
+
+    return (0, "Scored into s3://" + s3out_bucket + "/" + s3out_objectkey)
+
+
+def scoring_lambda_handler(event, context):
+    external_ip = urllib.request.urlopen('https://ident.me').read().decode('utf8')
+    print("External IP to add to Firewall ingress rules:", external_ip)
+    print("======= ")
+
+    # reference structure of S3 event message at https://docs.aws.amazon.com/AmazonS3/latest/dev/notification-content-structure.html
+    # S3 may deliver several records in one event. Score all of them, at most max_concurrent_records at a time,
+    # each with its own deployment (or pool lease) and error file, so one bad file does not stop the others.
+    records = event['Records']
+    max_concurrent_records = max(1, min(int(os.environ.get('max_concurrent_records', 4)), len(records)))
+    pools = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_records) as executor:
+        futures = [executor.submit(_score_s3_record, record, external_ip, pools) for record in records]
+
+    summary = []
+    for record, future in zip(records, futures):
+        try:
+            status_code, message = future.result()
+        except Exception as e:
+            print("Unexpected error:", sys.exc_info())
+            status_code, message = (990, "Unexpected error scoring record " + str(e))
+            # S3 triggered invocations have nobody reading the summary. The error file is what tells.
+            s3outfile_presignedurl = get_s3presignedurl_for_post(
+                urlparse(os.environ['s3_outputfolder'], allow_fragments=False).netloc, _scoreout_error_key(record))
+            upload_file_s3(s3outfile_presignedurl, text_message=message)
+        summary.append({'bucket': record['s3']['bucket']['name'],
+                        'key': unquote_plus(record['s3']['object']['key']),
+                        'status_code': status_code,
+                        'message': message})
+        print("Record:", summary[-1])
+
+    # warm pools are kept between lambda.pool.min.size and max.size here, once per invocation whatever came of the
+    # records: idle members are reaped even while scoring keeps failing. The fallback model's pool always.
+    pool_config = get_pool_config_from_env(os.environ)
+    if is_pool_enabled(pool_config):
+        pools.add((os.environ['fallback_modelname'], os.environ['fallback_clustername'], os.environ['k8s_namespace']))
+        for modelimagename, clustername, k8s_namespace in pools:
+            try:
+                print("Pool maintenance:", modelimagename, maintain_pool(modelimagename, clustername, k8s_namespace,
+                                                                         os.environ['aws_region'], pool_config))
+            except Exception:
+                print("Unexpected error:", sys.exc_info())
+
+    # not per record, and only on a sample of invocations: it lists the whole cache folder
+    result_cache_config = get_result_cache_config_from_env(os.environ)
+    if result_cache_config['cache_enabled'] and is_result_cache_eviction_due(result_cache_config):
+        s3out_parsed = urlparse(os.environ['s3_outputfolder'], allow_fragments=False)
+        print(evict_result_cache(s3out_parsed.netloc, result_cache_prefix(s3out_parsed.path.lstrip('/')),
+                                 result_cache_config['cache_max_age'], result_cache_config['cache_max_bytes']))
+
+    return {'records': summary,
+            'failed': sum(1 for record_summary in summary if not record_summary['status_code'] == 0)}
+
@@ -1,125 +1,210 @@
-import configparser
-from urllib.parse import urlparse
-import boto3
-import json
-from botocore.exceptions import ClientError
-
-
-########
-
-def validate_modelimage_eks(model_imagename, clustername, awsregion):
-    # check if ECR image is available
-    try:
-        #print("check on model:", model_imagename)
-        ecr_client = boto3.client('ecr', region_name=awsregion)
-        response = ecr_client.describe_images(repositoryName=model_imagename)
-        if (response['ResponseMetadata']['HTTPStatusCode'] != 200):
-            print("Image not found or something else wrong with repo")
-            return (False, "ModelImage not found" + model_imagename)
-    except ClientError as e:
-        print("Unexpected error while trying to check on Model image presence: %s" % e)
-        return (False, str(e))
-
-    # check if EKS cluster is running and active
-    try:
-        #print("check on eks:", clustername)
-        eks_client = boto3.client('eks', region_name=awsregion)
-        response = eks_client.describe_cluster(name=clustername)
-        if (response['ResponseMetadata']['HTTPStatusCode'] != 200) or (response['cluster']['status'] != 'ACTIVE'):
-            print("EKS cluster is not Active:", clustername)
-            print(response)
-            return (False, "Cluster not Active:" + clustername)
-    except ClientError as e:
-        print("Unexpected error while trying to check on EKS cluster: %s" % e)
-        return (False, str(e))
-
-    # print("S3 folders exist")
-    # print("Validated Model Image available on ECR. Validated EKS Cluster to be Active")
-    # print("All environment check out passed. Proceeding to next step")
-
-    return (True, "Model and Cluster are validated.")
-
-
-##
-def _get_s3tags(bucket, objectkey):
-    try:
-        s3_client = boto3.client('s3')
-        kwargs = {'Bucket': bucket, 'Key': objectkey}
-        s3_taglist = s3_client.get_object_tagging(**kwargs)['TagSet']
-        s3_tagdict = {}
-        if not s3_taglist is None:
-            for tag in s3_taglist:
-                s3_tagdict[tag['Key']] = tag['Value']
-
-        return s3_tagdict
-
-    except ClientError as e:
-        print("Unexpected error while getting tags for s3 in file: %s" % e)
-        return None
-
-###
-def process_tags_on_file(s3in_bucket, s3in_objectkey, fallback_modelname, fallback_clustername, fallback_ingress_url,
-                         fallback_k8s_namespace):
-    s3_tagdict = _get_s3tags(s3in_bucket, s3in_objectkey)
-    if len(s3_tagdict) == 0:
-        modelimagename = fallback_modelname
-        clustername = fallback_clustername
-        ingress_scoring_url = fallback_ingress_url
-        k8s_namespace = fallback_k8s_namespace
-    else:
-        # inspect for all 4 tags we need. Else abort
-        if len(s3_tagdict) == 4:
-            modelimagename = s3_tagdict.get('modelimagename', '')
-            clustername = s3_tagdict.get('k8scluster', '')
-            ingress_scoring_url = s3_tagdict.get('k8singressurl', '')
-            k8s_namespace = s3_tagdict.get('k8snamespace', '')
-        else:
-            err_msg = "Aborted scoring. One of the scoring input tag is missing. We need all 4 tags - modelimagename, k8scluster, k8singressurl and k8snamespace. Or leave them empty and we use default values picked from config.properties of application"
-            return (100, err_msg, '', '', '', '')
-
-    if modelimagename == '' or clustername == '' or ingress_scoring_url == '' or k8s_namespace == '':
-        err_msg = "Aborted scoring as one of tags is missing or misspelled. We need all 4 tags - modelimagename, k8scluster, k8singressurl and k8snamespace. Or leave them empty and we use default values picked from config.properties of application"
-        return (100, err_msg, '', '', '', '')
-
-    return (0, "Success", modelimagename, clustername, ingress_scoring_url, k8s_namespace)
-
-###
-
-def update_tags_s3file(s3_bucket, objectkey, s3_taglist):
-    try:
-        s3_client = boto3.client('s3')
-        response = s3_client.put_object_tagging(Bucket=s3_bucket,Key=objectkey,
-                        Tagging={
-                            'TagSet': s3_taglist
-                        }
-        )
-        return 0
-    except ClientError as e:
-        print("Unexpected error while updating tags %s" % e)
-        return None
-
-###
-
-def get_s3presignedurl(bucket, objectkey):
-    try:
-        s3_client = boto3.client('s3')
-        kwargs = {'Bucket': bucket, 'Key': objectkey}
-        s3_presigned_url = s3_client.generate_presigned_url(ClientMethod="get_object", Params=kwargs)
-        return s3_presigned_url
-
-    except ClientError as e:
-        print("Unexpected error while generating presigned url : %s" % e)
-        return None
-
-###
-def get_s3presignedurl_for_post(bucket, objectkey):
-    try:
-        s3_client = boto3.client('s3')
-        kwargs = {'Bucket': bucket, 'Key': objectkey, }
-        s3_presigned_url = s3_client.generate_presigned_post(bucket, objectkey)
-        return s3_presigned_url
-
-    except ClientError as e:
-        print("Unexpected error while generating presigned url for posting file: %s" % e)
-        return None
-
+import configparser
+from urllib.parse import urlparse
+import boto3
+import json
+import threading
+from botocore.exceptions import ClientError
+
+########
+# One boto3 session and one client per (service, region) for the whole process. Module level so they survive
+# across warm invocations of the lambda function. Credentials come from the lambda role and botocore refreshes them.
+# boto3 clients are thread safe once created; sessions are not, so creation happens under the lock.
+_aws_session = None
+_aws_clients = {}
+_aws_registry_lock = threading.Lock()
+
+
+def get_aws_session():
+    global _aws_session
+    with _aws_registry_lock:
+        if _aws_session is None:
+            _aws_session = boto3.session.Session()
+        return _aws_session
+
+
+def get_aws_client(service, region_name=None):
+    key = (service, region_name)
+    aws_client = _aws_clients.get(key)
+    if aws_client is None:
+        session = get_aws_session()
+        with _aws_registry_lock:
+            if key not in _aws_clients:
+                _aws_clients[key] = session.client(service, region_name=region_name)
+            aws_client = _aws_clients[key]
+    return aws_client
+
+
+########
+
+def validate_modelimage_eks(model_imagename, clustername, awsregion):
+    # check if ECR image is available
+    try:
+        #print("check on model:", model_imagename)
+        ecr_client = get_aws_client('ecr', awsregion)
+        response = ecr_client.describe_images(repositoryName=model_imagename)
+        if (response['ResponseMetadata']['HTTPStatusCode'] != 200):
+            print("Image not found or something else wrong with repo")
+            return (False, "ModelImage not found" + model_imagename)
+    except ClientError as e:
+        print("Unexpected error while trying to check on Model image presence: %s" % e)
+        return (False, str(e))
+
+    # check if EKS cluster is running and active
+    try:
+        #print("check on eks:", clustername)
+        eks_client = get_aws_client('eks', awsregion)
+        response = eks_client.describe_cluster(name=clustername)
+        if (response['ResponseMetadata']['HTTPStatusCode'] != 200) or (response['cluster']['status'] != 'ACTIVE'):
+            print("EKS cluster is not Active:", clustername)
+            print(response)
+            return (False, "Cluster not Active:" + clustername)
+    except ClientError as e:
+        print("Unexpected error while trying to check on EKS cluster: %s" % e)
+        return (False, str(e))
+
+    # print("S3 folders exist")
+    # print("Validated Model Image available on ECR. Validated EKS Cluster to be Active")
+    # print("All environment check out passed. Proceeding to next step")
+
+    return (True, "Model and Cluster are validated.")
+
+
+##
+def get_model_image_digest(model_imagename, aws_region):
+    # digest of the :latest image. Unlike the tag it changes with every push. None when it cannot be read.
+    try:
+        ecr_client = get_aws_client('ecr', aws_region)
+        response = ecr_client.describe_images(repositoryName=model_imagename, imageIds=[{'imageTag': 'latest'}])
+        return response['imageDetails'][0]['imageDigest']
+    except (ClientError, IndexError) as e:
+        print("Unexpected error while reading model image digest: %s" % e)
+        return None
+
+###
+def _get_s3tags(bucket, objectkey):
+    try:
+        s3_client = get_aws_client('s3')
+        kwargs = {'Bucket': bucket, 'Key': objectkey}
+        s3_taglist = s3_client.get_object_tagging(**kwargs)['TagSet']
+        s3_tagdict = {}
+        if not s3_taglist is None:
+            for tag in s3_taglist:
+                s3_tagdict[tag['Key']] = tag['Value']
+
+        return s3_tagdict
+
+    except ClientError as e:
+        print("Unexpected error while getting tags for s3 in file: %s" % e)
+        return None
+
+###
+def process_tags_on_file(s3in_bucket, s3in_objectkey, fallback_modelname, fallback_clustername, fallback_ingress_url,
+                         fallback_k8s_namespace, fallback_output_format='input'):
+    # output_format tag (csv, parquet, arrow or input) is optional on top of the 4 tags and is not counted with them
+    s3_tagdict = _get_s3tags(s3in_bucket, s3in_objectkey)
+    output_format = s3_tagdict.pop('output_format', fallback_output_format)
+    if output_format not in ('input', 'csv', 'parquet', 'arrow'):
+        err_msg = "Aborted scoring. output_format tag must be one of input, csv, parquet or arrow. Got " + output_format
+        return (100, err_msg, '', '', '', '', '')
+    if len(s3_tagdict) == 0:
+        modelimagename = fallback_modelname
+        clustername = fallback_clustername
+        ingress_scoring_url = fallback_ingress_url
+        k8s_namespace = fallback_k8s_namespace
+    else:
+        # inspect for all 4 tags we need. Else abort
+        if len(s3_tagdict) == 4:
+            modelimagename = s3_tagdict.get('modelimagename', '')
+            clustername = s3_tagdict.get('k8scluster', '')
+            ingress_scoring_url = s3_tagdict.get('k8singressurl', '')
+            k8s_namespace = s3_tagdict.get('k8snamespace', '')
+        else:
+            err_msg = "Aborted scoring. One of the scoring input tag is missing. We need all 4 tags - modelimagename, k8scluster, k8singressurl and k8snamespace. Or leave them empty and we use default values picked from config.properties of application"
+            return (100, err_msg, '', '', '', '', '')
+
+    if modelimagename == '' or clustername == '' or ingress_scoring_url == '' or k8s_namespace == '':
+        err_msg = "Aborted scoring as one of tags is missing or misspelled. We need all 4 tags - modelimagename, k8scluster, k8singressurl and k8snamespace. Or leave them empty and we use default values picked from config.properties of application"
+        return (100, err_msg, '', '', '', '', '')
+
+    return (0, "Success", modelimagename, clustername, ingress_scoring_url, k8s_namespace, output_format)
+
+###
+
+def update_tags_s3file(s3_bucket, objectkey, s3_taglist):
+    try:
+        s3_client = get_aws_client('s3')
+        response = s3_client.put_object_tagging(Bucket=s3_bucket,Key=objectkey,
+                        Tagging={
+                            'TagSet': s3_taglist
+                        }
+        )
+        return 0
+    except ClientError as e:
+        print("Unexpected error while updating tags %s" % e)
+        return None
+
+###
+
+def get_s3presignedurl(bucket, objectkey):
+    try:
+        s3_client = get_aws_client('s3')
+        kwargs = {'Bucket': bucket, 'Key': objectkey}
+        s3_presigned_url = s3_client.generate_presigned_url(ClientMethod="get_object", Params=kwargs)
+        return s3_presigned_url
+
+    except ClientError as e:
+        print("Unexpected error while generating presigned url : %s" % e)
+        return None
+
+###
+def get_s3presignedurl_for_post(bucket, objectkey):
+    try:
+        s3_client = get_aws_client('s3')
+        kwargs = {'Bucket': bucket, 'Key': objectkey, }
+        s3_presigned_url = s3_client.generate_presigned_post(bucket, objectkey)
+        return s3_presigned_url
+
+    except ClientError as e:
+        print("Unexpected error while generating presigned url for posting file: %s" % e)
+        return None
+
+
+###
+# S3 multipart upload with presigned UploadPart URLs. Parts are PUT with requests (see lambdafunc_core_s3_transfer.py),
+# only create/complete/abort go through boto3.
+def create_multipart_upload(bucket, objectkey):
+    try:
+        s3_client = get_aws_client('s3')
+        return s3_client.create_multipart_upload(Bucket=bucket, Key=objectkey)['UploadId']
+    except ClientError as e:
+        print("Unexpected error while creating multipart upload : %s" % e)
+        return None
+
+
+def get_s3presignedurls_for_uploadpart(bucket, objectkey, upload_id, number_of_parts, expires_in=3600):
+    s3_client = get_aws_client('s3')
+    return [s3_client.generate_presigned_url(ClientMethod='upload_part', ExpiresIn=expires_in,
+                                             Params={'Bucket': bucket, 'Key': objectkey, 'UploadId': upload_id,
+                                                     'PartNumber': part_number})
+            for part_number in range(1, number_of_parts + 1)]
+
+
+def complete_multipart_upload(bucket, objectkey, upload_id, parts):
+    # parts: [{'ETag', 'PartNumber'}] in part number order
+    try:
+        s3_client = get_aws_client('s3')
+        s3_client.complete_multipart_upload(Bucket=bucket, Key=objectkey, UploadId=upload_id,
+                                            MultipartUpload={'Parts': parts})
+        return True
+    except ClientError as e:
+        print("Unexpected error while completing multipart upload : %s" % e)
+        return False
+
+
+def abort_multipart_upload(bucket, objectkey, upload_id):
+    # parts already uploaded are billed as storage until the upload is aborted.
+    try:
+        s3_client = get_aws_client('s3')
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=objectkey, UploadId=upload_id)
+    except ClientError as e:
+        print("Unexpected error while aborting multipart upload : %s" % e)
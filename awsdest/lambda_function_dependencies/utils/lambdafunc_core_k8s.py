@@ -1,340 +1,481 @@
-from os import path
-from typing import Any, Union
-
-import yaml
-from kubernetes import client, config, utils
-import boto3
-import string
-import random
-import base64
-from botocore.signers import RequestSigner
-import re
-
-from utils.lambdafunc_core_aws import *
-import time
-
-
-############
-
-def _get_bearer_token(cluster_id, region):
-    # print("awsconfig in get bearer:", awsconfig)
-    STS_TOKEN_EXPIRES_IN = 60
-
-    session = boto3.session.Session(region_name=region)
-    client = session.client('sts')
-    service_id = client.meta.service_model.service_id
-
-    signer = RequestSigner(
-        service_id,
-        region,
-        'sts',
-        'v4',
-        session.get_credentials(),
-        session.events
-    )
-
-    params = {
-        'method': 'GET',
-        'url': 'https://sts.{}.amazonaws.com/?Action=GetCallerIdentity&Version=2011-06-15'.format(region),
-        'body': {},
-        'headers': {
-            'x-k8s-aws-id': cluster_id
-        },
-        'context': {}
-    }
-
-    signed_url = signer.generate_presigned_url(
-        params,
-        region_name=region,
-        expires_in=STS_TOKEN_EXPIRES_IN,
-        operation_name=''
-    )
-
-    # print("signed URL:", signed_url)
-    base64_url = base64.urlsafe_b64encode(signed_url.encode('utf-8')).decode('utf-8')
-    # remove any base64 encoding padding:
-    return 'k8s-aws-v1.' + re.sub(r'=*', '', base64_url)
-
-
-############
-
-def _create_kube_config(clustername, aws_region, KUBE_FILEPATH):
-    try:
-        eks_client = boto3.client('eks', region_name=aws_region)
-        response = eks_client.describe_cluster(name=clustername)
-    except ClientError as e:
-        print("Unexpected error while describing cluster : %s" % e)
-        return False
-
-    k8s_cert = response["cluster"]["certificateAuthority"]["data"]
-    k8s_ep = response["cluster"]["endpoint"]
-    # Generating kubeconfig
-    kube_content = dict()
-    kube_content['apiVersion'] = 'v1'
-    kube_content['clusters'] = [
-        {
-            'cluster':
-                {
-                    'server': k8s_ep,
-                    'certificate-authority-data': k8s_cert
-                },
-            'name': 'kubernetes'
-
-        }]
-
-    kube_content['contexts'] = [
-        {
-            'context':
-                {
-                    'cluster': 'kubernetes',
-                    'user': 'aws'
-                },
-            'name': 'aws'
-        }]
-
-    kube_content['current-context'] = 'aws'
-    kube_content['Kind'] = 'config'
-    kube_content['users'] = [
-        {
-            'name': 'aws',
-            'user':
-                {
-                    'name': 'who-cares'
-                }
-        }]
-    # Write kubeconfig
-    with open(KUBE_FILEPATH, 'w') as outfile:
-        yaml.dump(kube_content, outfile, default_flow_style=False)
-    return True
-
-
-def _create_deployment_object(DEPLOYMENT_NAME, model_imagename_ecrpath, replicas_for_app):
-    container = client.V1Container(
-        name=DEPLOYMENT_NAME,
-        image=model_imagename_ecrpath,
-        ports=[client.V1ContainerPort(container_port=8080)])
-    # Create and configurate a spec section
-    template = client.V1PodTemplateSpec(
-        metadata=client.V1ObjectMeta(labels={"app": DEPLOYMENT_NAME}),
-        spec=client.V1PodSpec(containers=[container]))
-    # Create the specification of deployment
-    spec = client.V1DeploymentSpec(
-        replicas=replicas_for_app,
-        template=template,
-        selector={'matchLabels': {'app': DEPLOYMENT_NAME}})
-    # Instantiate the deployment object
-    deployment = client.V1Deployment(
-        api_version="apps/v1",
-        kind="Deployment",
-        metadata=client.V1ObjectMeta(name=DEPLOYMENT_NAME),
-        spec=spec)
-
-    return deployment
-
-
-def _create_service_body(k8s_service_name, k8s_deployment_name):
-    core_v1_api = client.CoreV1Api()
-    body = client.V1Service(
-        api_version="v1",
-        kind="Service",
-        metadata=client.V1ObjectMeta(
-            name=k8s_service_name
-        ),
-        spec=client.V1ServiceSpec(
-            selector={"app": k8s_deployment_name},
-            ports=[client.V1ServicePort(
-                port=8080,
-                target_port=8080
-            )]
-        )
-    )
-    return body
-
-
-def _create_ingress_body(k8s_ingress_name, k8s_service_name, unique_env_id):
-    # we have to have following rewrites else there will be ingress conflicts between multiple pods.
-    rewrite_target = "/$2"
-    body = client.NetworkingV1beta1Ingress(
-        api_version="networking.k8s.io/v1beta1",
-        kind="Ingress",
-        metadata=client.V1ObjectMeta(name=k8s_ingress_name, annotations={
-            "nginx.ingress.kubernetes.io/rewrite-target": rewrite_target
-        }),
-        spec=client.NetworkingV1beta1IngressSpec(
-            rules=[client.NetworkingV1beta1IngressRule(
-                host="",
-                http=client.NetworkingV1beta1HTTPIngressRuleValue(
-                    paths=[client.NetworkingV1beta1HTTPIngressPath(
-                        path="/" + unique_env_id + "(/|$)(.*)",
-                        backend=client.NetworkingV1beta1IngressBackend(
-                            service_port=8080,
-                            service_name=k8s_service_name)
-
-                    )]
-                )
-            )
-            ]
-        )
-    )
-    return body
-
-
-def _wait_for_deployment_complete(deployment_name, replicas, timeout, k8s_api_v1_client, k8s_namespace):
-    start = time.time()
-    while (time.time() - start) < timeout:
-        time.sleep(5)
-        try:
-            api_response = k8s_api_v1_client.read_namespaced_deployment(name=deployment_name, namespace=k8s_namespace)
-            if api_response.status.available_replicas == replicas:
-                return True
-            else:
-                return False
-        except:
-            return False
-    raise RuntimeError(f'waiting timeout for deployment {deployment_name}')
-
-
-def create_deployment_for_model(model_imagename, clustername, k8s_namespace, aws_region, unique_env_id):
-    # keep following name in mind as this is the selector and used across the board.
-    # Referred again in "service.yaml" and loadbabalncer.yaml object creation
-
-    DEPLOYMENT_NAME = "scoringsasmm-" + unique_env_id
-    k8s_service_name = "scoringsassvc-" + unique_env_id
-    k8s_ingress_name = "scoringsasing-" + unique_env_id
-    k8s_kubefilepath = "/tmp/tmp_kubeconfig"
-
-    k8s_pods_creation_timeout = 120
-    replicas = 1
-
-    try:
-        ecr_client = boto3.client('ecr', region_name=aws_region)
-        response = ecr_client.describe_images(repositoryName=model_imagename)
-        model_imagename_ecrpath = response['imageDetails'][0][
-                                      'registryId'] + ".dkr.ecr." + aws_region + ".amazonaws.com/" + model_imagename + ":latest"
-        if (response['ResponseMetadata']['HTTPStatusCode'] != 200):
-            print("Image not found or something else wrong with repo")
-            return (310, "Unexpected error getting model ")
-    except ClientError as e:
-        print("Unexpected error while trying to check on Model image presence: %s" % e)
-        return (320, "Unexpected error getting model" + str(e))
-
-    if not _create_kube_config(clustername, aws_region, k8s_kubefilepath):
-        print("Kube config creation failed:")
-        return (330, "Kube config creation failed")
-
-    config.load_kube_config(config_file=k8s_kubefilepath)
-    configuration = client.Configuration()
-    configuration.api_key['authorization'] = _get_bearer_token(clustername, aws_region)
-    # print("Token: ", configuration.api_key['authorization'] )
-    configuration.api_key_prefix['authorization'] = 'Bearer'
-
-    # API
-    # Uncomment the following lines to enable debug logging
-    # configuration.debug = True
-    # apps_v1 = client.AppsV1Api(api_client=client.ApiClient(configuration))
-    apps_v1 = client.AppsV1Api()
-    deployment = _create_deployment_object(DEPLOYMENT_NAME, model_imagename_ecrpath, replicas)
-    # print("deployment: ", deployment)
-    try:
-        api_response = apps_v1.create_namespaced_deployment(
-            body=deployment,
-            namespace=k8s_namespace)
-    except Exception as e:
-        print(str(e))
-        # raise e
-        return (340, str(e))
-
-    # print("Deployment created. status='%s'" % str(api_response.status))
-    # wait till deployment object is launched and all pods meeting scaling policy are available.
-    if _wait_for_deployment_complete(DEPLOYMENT_NAME, replicas, k8s_pods_creation_timeout, apps_v1, k8s_namespace):
-        print("Deployment complete. Number of pods available:", replicas)
-
-    #########
-
-    #   proceed creating service and ingress objects
-    try:
-        svc_body = _create_service_body(k8s_service_name, DEPLOYMENT_NAME)
-        v1 = client.CoreV1Api()
-        v1.create_namespaced_service(namespace=k8s_namespace, body=svc_body)
-
-        ingress_body = _create_ingress_body(k8s_ingress_name, k8s_service_name, unique_env_id)
-        networking_v1_beta1_api = client.NetworkingV1beta1Api()
-        networking_v1_beta1_api.create_namespaced_ingress(namespace=k8s_namespace, body=ingress_body)
-
-    except Exception as e:
-        print(str(e))
-        # raise e
-        return (350, str(e))
-
-    return (0, "Success")
-
-
-###
-
-def delete_k8s_deployment(k8s_clustername, k8s_namespace, aws_region, unique_env_id):
-    # keep following name in mind as this is the selector and used across the board.
-    # Referred again in "service.yaml" and loadbabalncer.yaml object creation
-
-    k8s_deployment_name = "scoringsasmm-" + unique_env_id
-    k8s_service_name = "scoringsassvc-" + unique_env_id
-    k8s_ingress_name = "scoringsasing-" + unique_env_id
-    k8s_kubefilepath = "/tmp/tmp_kubeconfig"
-
-    # we reuse /tmp/kubeconfig since we created it earlier during deployment/pod launch.
-    #
-    config.load_kube_config(config_file=k8s_kubefilepath)
-    configuration = client.Configuration()
-    configuration.api_key['authorization'] = _get_bearer_token(k8s_clustername, aws_region)
-    configuration.api_key_prefix['authorization'] = 'Bearer'
-
-    # API
-    # Uncomment the following lines to enable debug logging
-    # configuration.debug = True
-    # apps_v1 = client.AppsV1Api(api_client=client.ApiClient(configuration))
-    apps_v1 = client.AppsV1Api()
-    extensions_v1beta1 = client.ExtensionsV1beta1Api()
-    delete_options = client.V1DeleteOptions()
-    delete_options.grace_period_seconds = 0
-    delete_options.propagation_policy = 'Foreground'
-    try:
-        api_response = extensions_v1beta1.delete_namespaced_deployment(
-            name=k8s_deployment_name,
-            body=delete_options,
-            grace_period_seconds=0,
-            namespace=k8s_namespace)
-        print("Deleted deployment:", k8s_deployment_name)
-    except Exception as e:
-        print(str(e))
-        return (910, "deployment not deleted" + k8s_deployment_name)
-
-    # delete services
-    v1 = client.CoreV1Api()
-    delete_options = client.V1DeleteOptions()
-    try:
-        api_response = v1.delete_namespaced_service(k8s_service_name, k8s_namespace, body=delete_options)
-    except client.rest.ApiException as e:
-        print(str(e))
-        return (920, "service not deleted" + k8s_service_name)
-    print('deleted svc/{} from ns/{}'.format(k8s_service_name, k8s_namespace))
-
-    # delete ingress which is part of extensionsapi
-    api_instance = client.ExtensionsV1beta1Api(client.ApiClient(configuration))
-    try:
-        api_response = api_instance.delete_namespaced_ingress(k8s_ingress_name, k8s_namespace, body=delete_options)
-    except client.rest.ApiException as e:
-        print(str(e))
-        return (930, "ingress not deleted" + k8s_ingress_name)
-    print('deleted ingress/{} from ns/{}'.format(k8s_ingress_name, k8s_namespace))
-
-    return (0, "K8S cleanup good")
-
-
-###### never used. just for testing
-if __name__ == '__main__':
-    s3folderin = "s3://fsbu-sunall-bucket1/folder1/folder2"
-    model_imagename = 'jakochdockermodel'
-
-###### never used. just for testing
-if __name__ == '__main__':
-    s3folderin = "s3://fsbu-sunall-bucket1/folder1/folder2"
-    model_imagename = 'jakochdockermodel'
+import os
+from os import path
+from typing import Any, Union
+
+import yaml
+from kubernetes import client, config, utils, watch
+import boto3
+import string
+import random
+import base64
+from botocore.signers import RequestSigner
+import re
+import tempfile
+import threading
+
+from utils.lambdafunc_core_aws import *
+from utils.lambdafunc_core_prepull import *
+import time
+
+
+############
+
+STS_TOKEN_EXPIRES_IN = 60
+
+
+def _get_bearer_token(cluster_id, region):
+    # print("awsconfig in get bearer:", awsconfig)
+    session = get_aws_session()
+    client = get_aws_client('sts', region)
+    service_id = client.meta.service_model.service_id
+
+    signer = RequestSigner(
+        service_id,
+        region,
+        'sts',
+        'v4',
+        session.get_credentials(),
+        session.events
+    )
+
+    params = {
+        'method': 'GET',
+        'url': 'https://sts.{}.amazonaws.com/?Action=GetCallerIdentity&Version=2011-06-15'.format(region),
+        'body': {},
+        'headers': {
+            'x-k8s-aws-id': cluster_id
+        },
+        'context': {}
+    }
+
+    signed_url = signer.generate_presigned_url(
+        params,
+        region_name=region,
+        expires_in=STS_TOKEN_EXPIRES_IN,
+        operation_name=''
+    )
+
+    # print("signed URL:", signed_url)
+    base64_url = base64.urlsafe_b64encode(signed_url.encode('utf-8')).decode('utf-8')
+    # remove any base64 encoding padding:
+    return 'k8s-aws-v1.' + re.sub(r'=*', '', base64_url)
+
+
+############
+
+# Cluster endpoint and CA per cluster name and one ApiClient per cluster, kept at module level so warm lambda
+# invocations skip describe_cluster and client setup. No kubeconfig file involved. The STS based bearer token is
+# only valid for STS_TOKEN_EXPIRES_IN secs so it is re-signed shortly before it runs out.
+K8S_TOKEN_REFRESH_MARGIN = 15
+_k8s_clusters = {}
+_k8s_api_clients = {}
+_k8s_lock = threading.Lock()
+
+
+def _describe_cluster(clustername, aws_region):
+    key = (clustername, aws_region)
+    with _k8s_lock:
+        if key in _k8s_clusters:
+            return _k8s_clusters[key]
+
+    try:
+        eks_client = get_aws_client('eks', aws_region)
+        response = eks_client.describe_cluster(name=clustername)
+    except ClientError as e:
+        print("Unexpected error while describing cluster : %s" % e)
+        return None
+
+    # kubernetes client wants the CA as a file
+    with tempfile.NamedTemporaryFile(prefix="k8s-ca-", suffix=".crt", delete=False) as ca_file:
+        ca_file.write(base64.b64decode(response["cluster"]["certificateAuthority"]["data"]))
+    cluster = {'endpoint': response["cluster"]["endpoint"], 'ca_file': ca_file.name}
+    with _k8s_lock:
+        _k8s_clusters[key] = cluster
+    return cluster
+
+
+def _refresh_bearer_token(configuration, clustername, aws_region):
+    if time.time() - configuration.token_created < STS_TOKEN_EXPIRES_IN - K8S_TOKEN_REFRESH_MARGIN:
+        return
+    configuration.api_key['authorization'] = _get_bearer_token(clustername, aws_region)
+    configuration.token_created = time.time()
+
+
+def _get_k8s_api_client(clustername, aws_region):
+    # returns None if cluster cannot be described.
+    key = (clustername, aws_region)
+    with _k8s_lock:
+        api_client = _k8s_api_clients.get(key)
+    if api_client is None:
+        cluster = _describe_cluster(clustername, aws_region)
+        if cluster is None:
+            return None
+        configuration = client.Configuration()
+        configuration.host = cluster['endpoint']
+        configuration.ssl_ca_cert = cluster['ca_file']
+        configuration.api_key_prefix['authorization'] = 'Bearer'
+        configuration.token_created = 0
+        # kubernetes client calls this before every request; older clients without the hook get refreshed below.
+        configuration.refresh_api_key_hook = lambda conf: _refresh_bearer_token(conf, clustername, aws_region)
+        api_client = client.ApiClient(configuration)
+        with _k8s_lock:
+            api_client = _k8s_api_clients.setdefault(key, api_client)
+
+    _refresh_bearer_token(api_client.configuration, clustername, aws_region)
+    return api_client
+
+
+def _create_deployment_object(DEPLOYMENT_NAME, model_imagename_ecrpath, replicas_for_app, labels=None, annotations=None):
+    # extra labels/annotations are used by warm pod pool to find and lease its members. selector stays on "app" only.
+    deployment_labels = {"app": DEPLOYMENT_NAME}
+    if labels is not None:
+        deployment_labels.update(labels)
+    # readiness_probe_path (/ready on server.py) keeps pods unready until the scoring service warmed up.
+    readiness_probe = None
+    if os.environ.get('readiness_probe_path', '') != '':
+        readiness_probe = client.V1Probe(http_get=client.V1HTTPGetAction(path=os.environ['readiness_probe_path'],
+                                                                         port=8080),
+                                         period_seconds=2, failure_threshold=3)
+    container = client.V1Container(
+        name=DEPLOYMENT_NAME,
+        image=model_imagename_ecrpath,
+        ports=[client.V1ContainerPort(container_port=8080)],
+        readiness_probe=readiness_probe)
+    # Create and configurate a spec section
+    template = client.V1PodTemplateSpec(
+        metadata=client.V1ObjectMeta(labels={"app": DEPLOYMENT_NAME}),
+        spec=client.V1PodSpec(containers=[container]))
+    # Create the specification of deployment
+    spec = client.V1DeploymentSpec(
+        replicas=replicas_for_app,
+        template=template,
+        selector={'matchLabels': {'app': DEPLOYMENT_NAME}})
+    # Instantiate the deployment object
+    deployment = client.V1Deployment(
+        api_version="apps/v1",
+        kind="Deployment",
+        metadata=client.V1ObjectMeta(name=DEPLOYMENT_NAME, labels=deployment_labels, annotations=annotations),
+        spec=spec)
+
+    return deployment
+
+
+def _create_service_body(k8s_service_name, k8s_deployment_name):
+    core_v1_api = client.CoreV1Api()
+    body = client.V1Service(
+        api_version="v1",
+        kind="Service",
+        metadata=client.V1ObjectMeta(
+            name=k8s_service_name
+        ),
+        spec=client.V1ServiceSpec(
+            selector={"app": k8s_deployment_name},
+            ports=[client.V1ServicePort(
+                port=8080,
+                target_port=8080
+            )]
+        )
+    )
+    return body
+
+
+def _create_ingress_body(k8s_ingress_name, k8s_service_name, unique_env_id):
+    # we have to have following rewrites else there will be ingress conflicts between multiple pods.
+    # Job state lives in the pod, so with several replicas a client's /status and /query must reach the pod its
+    # /executions went to: cookie affinity. Cookie path is explicit since nginx can't derive it from a regex path.
+    rewrite_target = "/$2"
+    body = client.NetworkingV1beta1Ingress(
+        api_version="networking.k8s.io/v1beta1",
+        kind="Ingress",
+        metadata=client.V1ObjectMeta(name=k8s_ingress_name, annotations={
+            "nginx.ingress.kubernetes.io/rewrite-target": rewrite_target,
+            "nginx.ingress.kubernetes.io/affinity": "cookie",
+            "nginx.ingress.kubernetes.io/session-cookie-name": "route",
+            "nginx.ingress.kubernetes.io/session-cookie-path": "/" + unique_env_id,
+            "nginx.ingress.kubernetes.io/session-cookie-expires": "172800",
+            "nginx.ingress.kubernetes.io/session-cookie-max-age": "172800"
+        }),
+        spec=client.NetworkingV1beta1IngressSpec(
+            rules=[client.NetworkingV1beta1IngressRule(
+                host="",
+                http=client.NetworkingV1beta1HTTPIngressRuleValue(
+                    paths=[client.NetworkingV1beta1HTTPIngressPath(
+                        path="/" + unique_env_id + "(/|$)(.*)",
+                        backend=client.NetworkingV1beta1IngressBackend(
+                            service_port=8080,
+                            service_name=k8s_service_name)
+
+                    )]
+                )
+            )
+            ]
+        )
+    )
+    return body
+
+
+# Pod states that do not fix themselves. We give up on the first one rather than waiting out the timeout.
+FATAL_WAITING_REASONS = ('ImagePullBackOff', 'InvalidImageName', 'CrashLoopBackOff', 'CreateContainerConfigError')
+
+
+def _pod_failure_reason(pod):
+    for condition in pod.status.conditions or []:
+        if condition.type == 'PodScheduled' and condition.status == 'False' and condition.reason == 'Unschedulable':
+            return "Unschedulable: " + str(condition.message)
+    for container_status in pod.status.container_statuses or []:
+        waiting = container_status.state.waiting if container_status.state else None
+        if waiting is not None and waiting.reason in FATAL_WAITING_REASONS:
+            return waiting.reason + ": " + str(waiting.message)
+    return None
+
+
+def _is_pod_ready(pod):
+    return any(c.type == 'Ready' and c.status == 'True' for c in pod.status.conditions or [])
+
+
+def _ready_endpoint_addresses(endpoints):
+    return sum(len(subset.addresses or []) for subset in endpoints.subsets or [])
+
+
+def _watch_until(list_func, deadline, on_event, **kwargs):
+    # on_event returns None to keep watching. API server may end a watch before timeout_seconds so watch again till
+    # deadline. Every (re)watch starts with an ADDED event per existing object so current state is never missed.
+    while time.time() < deadline:
+        k8s_watch = watch.Watch()
+        for event in k8s_watch.stream(list_func, timeout_seconds=max(int(deadline - time.time()), 1), **kwargs):
+            result = on_event(event)
+            if result is not None:
+                k8s_watch.stop()
+                return result
+    return None
+
+
+def _wait_for_deployment_complete(deployment_name, service_name, replicas, timeout, api_client, k8s_namespace):
+    # returns (True, message) as soon as service endpoints route to replicas ready pods, (False, reason) on the first
+    # unrecoverable pod failure or on timeout. Driven by watch events, nothing polls here.
+    deadline = time.time() + timeout
+    core_v1 = client.CoreV1Api(api_client)
+    ready_pods = set()
+
+    def _on_pod_event(event):
+        pod = event['object']
+        failure_reason = _pod_failure_reason(pod)
+        if failure_reason is not None:
+            return (False, "Pod " + pod.metadata.name + " failed. " + failure_reason)
+        if event['type'] != 'DELETED' and _is_pod_ready(pod):
+            ready_pods.add(pod.metadata.name)
+        else:
+            ready_pods.discard(pod.metadata.name)
+        if len(ready_pods) >= replicas:
+            return (True, "Pods ready")
+        return None
+
+    def _on_endpoints_event(event):
+        if event['type'] != 'DELETED' and _ready_endpoint_addresses(event['object']) >= replicas:
+            return (True, "Endpoints ready")
+        return None
+
+    try:
+        pods_ready = _watch_until(core_v1.list_namespaced_pod, deadline, _on_pod_event, namespace=k8s_namespace,
+                                  label_selector="app=" + deployment_name)
+        if pods_ready is None:
+            return (False, "Pods of " + deployment_name + " not ready within " + str(timeout) + " secs")
+        if not pods_ready[0]:
+            return pods_ready
+        endpoints_ready = _watch_until(core_v1.list_namespaced_endpoints, deadline, _on_endpoints_event,
+                                       namespace=k8s_namespace, field_selector="metadata.name=" + service_name)
+        if endpoints_ready is None:
+            return (False, "Endpoints of " + service_name + " not ready within " + str(timeout) + " secs")
+    except Exception as e:
+        print(str(e))
+        return (False, "Watching deployment " + deployment_name + " failed " + str(e))
+    return endpoints_ready
+
+
+def _get_model_imagename_ecrpath(model_imagename, aws_region):
+    # <registry>/<image>@sha256:... for the image :latest points at right now. All pods of a file run the same image
+    # even if :latest is pushed meanwhile, and nodes already holding that digest start them without a pull (digest
+    # references default to imagePullPolicy IfNotPresent, :latest to Always).
+    try:
+        ecr_client = get_aws_client('ecr', aws_region)
+        response = ecr_client.describe_images(repositoryName=model_imagename, imageIds=[{'imageTag': 'latest'}])
+        if (response['ResponseMetadata']['HTTPStatusCode'] != 200) or not response['imageDetails']:
+            print("Image not found or something else wrong with repo")
+            return (310, "Unexpected error getting model ")
+        image_details = response['imageDetails'][0]
+        model_imagename_ecrpath = image_details['registryId'] + ".dkr.ecr." + aws_region + ".amazonaws.com/" + \
+                                  model_imagename + "@" + image_details['imageDigest']
+    except ClientError as e:
+        print("Unexpected error while trying to check on Model image presence: %s" % e)
+        return (320, "Unexpected error getting model" + str(e))
+
+    return (0, model_imagename_ecrpath)
+
+
+def _record_model_image_use(api_client, k8s_namespace, model_imagename, model_imagename_ecrpath):
+    # pre-pull bookkeeping never fails the deployment, see lambdafunc_core_prepull.py.
+    status_code, text_message = record_model_image_use(api_client, k8s_namespace, model_imagename,
+                                                       model_imagename_ecrpath,
+                                                       int(os.environ.get('prepull_images', 0)))
+    if not status_code == 0:
+        print(text_message)
+
+
+def create_deployment_for_model(model_imagename, clustername, k8s_namespace, aws_region, unique_env_id, replicas=1):
+    # keep following name in mind as this is the selector and used across the board.
+    # Referred again in "service.yaml" and loadbabalncer.yaml object creation
+
+    DEPLOYMENT_NAME = "scoringsasmm-" + unique_env_id
+    k8s_service_name = "scoringsassvc-" + unique_env_id
+    k8s_ingress_name = "scoringsasing-" + unique_env_id
+
+    k8s_pods_creation_timeout = 120
+    # more than 1 only for files scored in partitions, see lambdafunc_core_partition.py
+
+    image_status_code, model_imagename_ecrpath = _get_model_imagename_ecrpath(model_imagename, aws_region)
+    if not image_status_code == 0:
+        return (image_status_code, model_imagename_ecrpath)
+
+    api_client = _get_k8s_api_client(clustername, aws_region)
+    if api_client is None:
+        print("K8S api client creation failed:")
+        return (330, "K8S api client creation failed")
+
+    # API
+    # Uncomment the following lines to enable debug logging
+    # api_client.configuration.debug = True
+    apps_v1 = client.AppsV1Api(api_client)
+    deployment = _create_deployment_object(DEPLOYMENT_NAME, model_imagename_ecrpath, replicas)
+    # print("deployment: ", deployment)
+    try:
+        api_response = apps_v1.create_namespaced_deployment(
+            body=deployment,
+            namespace=k8s_namespace)
+    except Exception as e:
+        print(str(e))
+        # raise e
+        return (340, str(e))
+
+    # print("Deployment created. status='%s'" % str(api_response.status))
+    #   proceed creating service and ingress objects right away. They do not need running pods and the ingress
+    #   controller picks them up while the image is being pulled.
+    try:
+        svc_body = _create_service_body(k8s_service_name, DEPLOYMENT_NAME)
+        v1 = client.CoreV1Api(api_client)
+        v1.create_namespaced_service(namespace=k8s_namespace, body=svc_body)
+
+        ingress_body = _create_ingress_body(k8s_ingress_name, k8s_service_name, unique_env_id)
+        networking_v1_beta1_api = client.NetworkingV1beta1Api(api_client)
+        networking_v1_beta1_api.create_namespaced_ingress(namespace=k8s_namespace, body=ingress_body)
+
+    except Exception as e:
+        print(str(e))
+        # raise e
+        return (350, str(e))
+
+    # wait till all pods meeting scaling policy are ready and the service routes to them.
+    ready, text_message = _wait_for_deployment_complete(DEPLOYMENT_NAME, k8s_service_name, replicas,
+                                                        k8s_pods_creation_timeout, api_client, k8s_namespace)
+    if not ready:
+        print(text_message)
+        return (360, text_message)
+    print("Deployment complete. Number of pods available:", replicas)
+    _record_model_image_use(api_client, k8s_namespace, model_imagename, model_imagename_ecrpath)
+
+    return (0, "Success")
+
+
+def get_deployment_image_digest(clustername, k8s_namespace, aws_region, unique_env_id):
+    # digest of the image the deployment actually runs (sha256:...), which for a leased pool member may be older than
+    # :latest. None when it can't be read or the image is referenced by tag.
+    api_client = _get_k8s_api_client(clustername, aws_region)
+    if api_client is None:
+        return None
+    try:
+        deployment = client.AppsV1Api(api_client).read_namespaced_deployment(name="scoringsasmm-" + unique_env_id,
+                                                                            namespace=k8s_namespace)
+    except client.rest.ApiException as e:
+        print(str(e))
+        return None
+    image = deployment.spec.template.spec.containers[0].image
+    return image.split('@', 1)[1] if '@' in image else None
+
+
+def wait_for_deployment_ready(clustername, k8s_namespace, aws_region, unique_env_id, timeout):
+    # same readiness wait for deployments we did not just create, e.g. a leased pool member still starting up.
+    api_client = _get_k8s_api_client(clustername, aws_region)
+    if api_client is None:
+        return (370, "K8S api client creation failed")
+    ready, text_message = _wait_for_deployment_complete("scoringsasmm-" + unique_env_id,
+                                                        "scoringsassvc-" + unique_env_id, 1, timeout, api_client,
+                                                        k8s_namespace)
+    if not ready:
+        print(text_message)
+        return (380, text_message)
+    return (0, text_message)
+
+
+###
+
+def delete_k8s_deployment(k8s_clustername, k8s_namespace, aws_region, unique_env_id):
+    # keep following name in mind as this is the selector and used across the board.
+    # Referred again in "service.yaml" and loadbabalncer.yaml object creation
+
+    k8s_deployment_name = "scoringsasmm-" + unique_env_id
+    k8s_service_name = "scoringsassvc-" + unique_env_id
+    k8s_ingress_name = "scoringsasing-" + unique_env_id
+
+    # same cached api client we used during deployment/pod launch.
+    api_client = _get_k8s_api_client(k8s_clustername, aws_region)
+    if api_client is None:
+        return (900, "K8S api client creation failed")
+
+    # API
+    # Uncomment the following lines to enable debug logging
+    # api_client.configuration.debug = True
+    extensions_v1beta1 = client.ExtensionsV1beta1Api(api_client)
+    delete_options = client.V1DeleteOptions()
+    delete_options.grace_period_seconds = 0
+    delete_options.propagation_policy = 'Foreground'
+    try:
+        api_response = extensions_v1beta1.delete_namespaced_deployment(
+            name=k8s_deployment_name,
+            body=delete_options,
+            grace_period_seconds=0,
+            namespace=k8s_namespace)
+        print("Deleted deployment:", k8s_deployment_name)
+    except Exception as e:
+        print(str(e))
+        return (910, "deployment not deleted" + k8s_deployment_name)
+
+    # delete services
+    v1 = client.CoreV1Api(api_client)
+    delete_options = client.V1DeleteOptions()
+    try:
+        api_response = v1.delete_namespaced_service(k8s_service_name, k8s_namespace, body=delete_options)
+    except client.rest.ApiException as e:
+        print(str(e))
+        return (920, "service not deleted" + k8s_service_name)
+    print('deleted svc/{} from ns/{}'.format(k8s_service_name, k8s_namespace))
+
+    # delete ingress which is part of extensionsapi
+    api_instance = client.ExtensionsV1beta1Api(api_client)
+    try:
+        api_response = api_instance.delete_namespaced_ingress(k8s_ingress_name, k8s_namespace, body=delete_options)
+    except client.rest.ApiException as e:
+        print(str(e))
+        return (930, "ingress not deleted" + k8s_ingress_name)
+    print('deleted ingress/{} from ns/{}'.format(k8s_ingress_name, k8s_namespace))
+
+    return (0, "K8S cleanup good")
+
+
+###### never used. just for testing
+if __name__ == '__main__':
+    s3folderin = "s3://fsbu-sunall-bucket1/folder1/folder2"
+    model_imagename = 'jakochdockermodel'
+
+###### never used. just for testing
+if __name__ == '__main__':
+    s3folderin = "s3://fsbu-sunall-bucket1/folder1/folder2"
+    model_imagename = 'jakochdockermodel'
@@ -0,0 +1,240 @@
+import hashlib
+import random
+import string
+import time
+
+from kubernetes import client
+
+from utils.lambdafunc_core_k8s import *
+
+
+# Warm pod pool. Instead of a dedicated deployment/service/ingress per S3 file, we keep a few scoring pods per
+# (model image, namespace) on each cluster and lease one to each incoming file. Every pool member is a regular
+# deployment + service + ingress (same objects create_deployment_for_model builds) named after its member id, so
+# ingress url is <ingress>/<member_id> just like <ingress>/<unique_env_id>.
+# Pool state lives on the deployment objects themselves (labels/annotations) since lambda has no state of its own.
+# Leases use resourceVersion on replace so two lambdas cannot take the same pod.
+# Members are pinned to the image digest :latest pointed at when they were created and the pool key includes it, so a
+# push of the model image starts a new pool; members of older digests are never leased again and evicted once free.
+
+POOL_LABEL = "sasmm-pool"
+ANNOTATION_MODEL_IMAGE = "sasmm/model-image"
+ANNOTATION_LEASED_BY = "sasmm/leased-by"
+ANNOTATION_LEASE_EXPIRES = "sasmm/lease-expires"
+ANNOTATION_LAST_RELEASED = "sasmm/last-released"
+
+
+def get_pool_config_from_env(environ):
+    # pool_max_size of 0 (default) keeps the old dedicated deployment per file behaviour.
+    return {
+        'pool_min_size': int(environ.get('pool_min_size', 0)),
+        'pool_max_size': int(environ.get('pool_max_size', 0)),
+        'pool_idle_timeout': int(environ.get('pool_idle_timeout', 900)),
+        'pool_lease_seconds': int(environ.get('pool_lease_seconds', 900)),
+        'pool_lease_wait_timeout': int(environ.get('pool_lease_wait_timeout', 120))
+    }
+
+
+def is_pool_enabled(pool_config):
+    return pool_config['pool_max_size'] > 0
+
+
+def _pool_key(model_imagename_ecrpath, k8s_namespace):
+    # label values are limited to 63 chars so hash the pinned image (<image>@sha256:...). Cluster is implicit in the
+    # API server we talk to.
+    return hashlib.sha1((model_imagename_ecrpath + "/" + k8s_namespace).encode('utf-8')).hexdigest()[:10]
+
+
+def _new_member_id(pool_key):
+    suffix = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(6))
+    return "pool-" + pool_key + "-" + suffix
+
+
+def _member_id_of(deployment):
+    # deployment name is "scoringsasmm-" + member_id. See create_deployment_for_model for naming.
+    return deployment.metadata.name[len("scoringsasmm-"):]
+
+
+def _is_leased(deployment, now):
+    annotations = deployment.metadata.annotations or {}
+    if annotations.get(ANNOTATION_LEASED_BY, '') == '':
+        return False
+    # a lambda that died (timeout, crash) never releases its lease. Expired leases are free again.
+    return float(annotations.get(ANNOTATION_LEASE_EXPIRES, 0)) > now
+
+
+def _is_available(deployment):
+    return (deployment.status.available_replicas or 0) >= 1
+
+
+def _last_released(deployment):
+    annotations = deployment.metadata.annotations or {}
+    return float(annotations.get(ANNOTATION_LAST_RELEASED, 0))
+
+
+def _list_pool_members(apps_v1, k8s_namespace, pool_key):
+    response = apps_v1.list_namespaced_deployment(namespace=k8s_namespace, label_selector=POOL_LABEL + "=" + pool_key)
+    return response.items
+
+
+def _list_model_pool_members(apps_v1, k8s_namespace, model_imagename):
+    # members of every pool of this model image, current digest or not
+    response = apps_v1.list_namespaced_deployment(namespace=k8s_namespace, label_selector=POOL_LABEL)
+    return [m for m in response.items if (m.metadata.annotations or {}).get(ANNOTATION_MODEL_IMAGE) == model_imagename]
+
+
+def _try_lease(apps_v1, deployment, lease_owner, lease_seconds):
+    annotations = deployment.metadata.annotations or {}
+    annotations[ANNOTATION_LEASED_BY] = lease_owner
+    annotations[ANNOTATION_LEASE_EXPIRES] = str(time.time() + lease_seconds)
+    deployment.metadata.annotations = annotations
+    try:
+        # deployment still carries resourceVersion we read it with. Somebody else leased it in between => 409.
+        apps_v1.replace_namespaced_deployment(name=deployment.metadata.name, namespace=deployment.metadata.namespace,
+                                              body=deployment)
+        return True
+    except client.rest.ApiException as e:
+        if e.status == 409:
+            return False
+        raise e
+
+
+def _create_pool_member(api_client, model_imagename, model_imagename_ecrpath, k8s_namespace, pool_key, lease_owner,
+                        lease_seconds):
+    member_id = _new_member_id(pool_key)
+    deployment_name = "scoringsasmm-" + member_id
+    k8s_service_name = "scoringsassvc-" + member_id
+    k8s_ingress_name = "scoringsasing-" + member_id
+
+    annotations = {
+        ANNOTATION_MODEL_IMAGE: model_imagename,
+        ANNOTATION_LEASED_BY: lease_owner,
+        ANNOTATION_LEASE_EXPIRES: str(time.time() + lease_seconds) if lease_owner != '' else '0',
+        ANNOTATION_LAST_RELEASED: str(time.time())
+    }
+    deployment = _create_deployment_object(deployment_name, model_imagename_ecrpath, 1,
+                                           labels={POOL_LABEL: pool_key}, annotations=annotations)
+    client.AppsV1Api(api_client).create_namespaced_deployment(body=deployment, namespace=k8s_namespace)
+
+    svc_body = _create_service_body(k8s_service_name, deployment_name)
+    client.CoreV1Api(api_client).create_namespaced_service(namespace=k8s_namespace, body=svc_body)
+
+    ingress_body = _create_ingress_body(k8s_ingress_name, k8s_service_name, member_id)
+    client.NetworkingV1beta1Api(api_client).create_namespaced_ingress(namespace=k8s_namespace, body=ingress_body)
+    _record_model_image_use(api_client, k8s_namespace, model_imagename, model_imagename_ecrpath)
+
+    print("Created pool member:", member_id, "leased by:", lease_owner)
+    return member_id
+
+
+def lease_pool_member(model_imagename, clustername, k8s_namespace, aws_region, lease_owner, pool_config):
+    # returns (status_code, message, member_id). member_id is used in place of unique_env_id for ingress url.
+    api_client = _get_k8s_api_client(clustername, aws_region)
+    if api_client is None:
+        return (610, "K8S api client creation failed", None)
+    apps_v1 = client.AppsV1Api(api_client)
+    image_status_code, model_imagename_ecrpath = _get_model_imagename_ecrpath(model_imagename, aws_region)
+    if not image_status_code == 0:
+        return (image_status_code, model_imagename_ecrpath, None)
+    pool_key = _pool_key(model_imagename_ecrpath, k8s_namespace)
+
+    start = time.time()
+    while (time.time() - start) < pool_config['pool_lease_wait_timeout']:
+        try:
+            now = time.time()
+            members = _list_pool_members(apps_v1, k8s_namespace, pool_key)
+            free_members = [m for m in members if not _is_leased(m, now)]
+            # warm pods first, then pods still starting up (their image pull is already underway).
+            # Most recently released first so idle eviction can trim the ones nobody uses.
+            free_members.sort(key=lambda m: (not _is_available(m), -_last_released(m)))
+            for member in free_members:
+                if _try_lease(apps_v1, member, lease_owner, pool_config['pool_lease_seconds']):
+                    print("Leased pool member:", _member_id_of(member), "available:", _is_available(member))
+                    return (0, "Leased pool member", _member_id_of(member))
+
+            if len(members) < pool_config['pool_max_size']:
+                member_id = _create_pool_member(api_client, model_imagename, model_imagename_ecrpath, k8s_namespace,
+                                                pool_key, lease_owner, pool_config['pool_lease_seconds'])
+                return (0, "Created pool member", member_id)
+        except Exception as e:
+            print(str(e))
+            return (620, "Pool lease failed " + str(e), None)
+
+        # pool is at max size and every member is busy. Wait for one to be released.
+        time.sleep(5)
+
+    return (630, "No pool member became free within " + str(pool_config['pool_lease_wait_timeout']) + " secs", None)
+
+
+def release_pool_member(clustername, k8s_namespace, aws_region, member_id):
+    api_client = _get_k8s_api_client(clustername, aws_region)
+    if api_client is None:
+        return (640, "K8S api client creation failed")
+    apps_v1 = client.AppsV1Api(api_client)
+    # read + replace like the lease (the model deployers role has update, not patch). A 409 means the deployment
+    # changed since we read it (status updates do that too); read it again.
+    for attempt in range(5):
+        try:
+            deployment = apps_v1.read_namespaced_deployment(name="scoringsasmm-" + member_id, namespace=k8s_namespace)
+            annotations = deployment.metadata.annotations or {}
+            annotations[ANNOTATION_LEASED_BY] = ''
+            annotations[ANNOTATION_LEASE_EXPIRES] = '0'
+            annotations[ANNOTATION_LAST_RELEASED] = str(time.time())
+            deployment.metadata.annotations = annotations
+            apps_v1.replace_namespaced_deployment(name=deployment.metadata.name, namespace=k8s_namespace,
+                                                  body=deployment)
+            print("Released pool member:", member_id)
+            return (0, "Released pool member")
+        except client.rest.ApiException as e:
+            if not e.status == 409:
+                print(str(e))
+                return (650, "pool member not released" + member_id)
+    return (650, "pool member not released, conflicting updates " + member_id)
+
+
+def maintain_pool(model_imagename, clustername, k8s_namespace, aws_region, pool_config):
+    # evict members idle beyond pool_idle_timeout while keeping pool_min_size around, then top up to pool_min_size.
+    # Lambda only runs when files arrive, so this runs at the end of every invocation.
+    api_client = _get_k8s_api_client(clustername, aws_region)
+    if api_client is None:
+        return (660, "K8S api client creation failed")
+    apps_v1 = client.AppsV1Api(api_client)
+    image_status_code, model_imagename_ecrpath = _get_model_imagename_ecrpath(model_imagename, aws_region)
+    if not image_status_code == 0:
+        return (image_status_code, model_imagename_ecrpath)
+    pool_key = _pool_key(model_imagename_ecrpath, k8s_namespace)
+
+    try:
+        now = time.time()
+        # members still on an older image digest go as soon as nobody holds them
+        for member in _list_model_pool_members(apps_v1, k8s_namespace, model_imagename):
+            if not (member.metadata.labels or {}).get(POOL_LABEL) == pool_key and not _is_leased(member, now) and \
+                    _try_lease(apps_v1, member, "evicting", pool_config['pool_lease_seconds']):
+                delete_status_code, text_message = delete_k8s_deployment(clustername, k8s_namespace, aws_region,
+                                                                         _member_id_of(member))
+                print("Evicted pool member of an older model image:", _member_id_of(member), delete_status_code,
+                      text_message)
+
+        members = _list_pool_members(apps_v1, k8s_namespace, pool_key)
+        idle_members = [m for m in members if not _is_leased(m, now) and
+                        (now - _last_released(m)) > pool_config['pool_idle_timeout']]
+        idle_members.sort(key=_last_released)
+        number_to_evict = min(len(idle_members), len(members) - pool_config['pool_min_size'])
+        for member in idle_members[:max(number_to_evict, 0)]:
+            # lease it first so nobody picks it up while we delete it.
+            if not _try_lease(apps_v1, member, "evicting", pool_config['pool_lease_seconds']):
+                continue
+            delete_status_code, text_message = delete_k8s_deployment(clustername, k8s_namespace, aws_region,
+                                                                     _member_id_of(member))
+            print("Evicted idle pool member:", _member_id_of(member), delete_status_code, text_message)
+            members.remove(member)
+
+        if len(members) < pool_config['pool_min_size']:
+            for i in range(pool_config['pool_min_size'] - len(members)):
+                _create_pool_member(api_client, model_imagename, model_imagename_ecrpath, k8s_namespace, pool_key, '',
+                                    pool_config['pool_lease_seconds'])
+    except Exception as e:
+        print(str(e))
+        return (670, "Pool maintenance failed " + str(e))
+
+    return (0, "Pool maintained")
@@ -1,141 +1,383 @@
-from os import path
-
-import requests
-import json
-import yaml
-import xml.etree.ElementTree as ET
-import pickle
-import time
-import sys
-import os
-
-from utils.lambdafunc_core_aws import *
-
-
-def validate_pingpong_on_scoring(k8s_cluster_url_for_scoring):
-    try:
-        http_resp = requests.get(url=k8s_cluster_url_for_scoring, timeout=10)
-        print("Ingress ping pong response: ", http_resp.text)
-        if http_resp.text == 'pong':
-            return True
-        else:
-            return False
-    except:
-        print("No response from scoring service in validate_pingpong_on_scoring method:")
-        print("Unexpected error:", sys.exc_info())
-        return False
-
-
-###
-
-def upload_file_s3(s3_presigned_url, filename=None, text_message=None):
-    # print("s3 file upload URL", s3file_uploadurl)
-    try:
-        # either filename or text_message or used by clients.
-        if text_message is not None:
-            err_filename = '/tmp/err_text'
-            with open(err_filename, 'w+') as f:
-                f.write(text_message)
-            file_r = {"file": open(err_filename, 'r')}
-        else:
-            filename1 = "/tmp/" + filename
-            file_r = {"file": open(filename1, 'rb')}
-    except:
-        err_message = str(sys.exc_info())
-        return (560, err_message)
-
-    try:
-        http_response = requests.post(url=s3_presigned_url['url'], data=s3_presigned_url['fields'], files=file_r)
-        if not http_response.status_code in range(200, 290):
-            print("file upload to s3 failed", http_response.status_code)
-            print("Full response:", http_response.text)
-
-        return (0, http_response.status_code)
-    except:
-        error_message = str(sys.exc_info())
-        return (570, "error uploading file to S3" + error_message)
-
-
-###--
-
-def _download_one_file(s3file_downloadurl, unique_env_idenitier):
-    try:
-        r = requests.get(s3file_downloadurl, stream=True)
-        filename = unique_env_idenitier
-        with open("/tmp/" + filename, "wb") as s3csv:
-            # print(" file opened for writing")
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    s3csv.write(chunk)
-        return (0, "success")
-    except:
-        err_mesg1 = "Error downloading file from S3 "
-        err_mesg2 = str(sys.exc_info())
-        return (510, err_mesg1 + err_mesg2)
-
-
-def _score_one_file(k8s_url_for_scoring, unique_env_identifier):
-    try:
-        filename1 = {"file": open("/tmp/" + unique_env_identifier, 'rb')}
-        http_response = requests.post(url=k8s_url_for_scoring + "/executions", files=filename1)
-        scoring_token = json.loads(http_response.text)["id"]
-        # print("scoring response token:", scoring_token)
-        return (0, scoring_token)
-    except:
-        err_mesg1 = "Error submitting to scoring url @" + k8s_url_for_scoring + "/executions"
-        err_mesg2 = str(sys.exc_info())
-        return (520, err_mesg1 + err_mesg2)
-
-
-def _get_scoring_result(k8s_url_for_scoring, unique_env_identifier, scoring_token):
-    query_url = k8s_url_for_scoring + "/query/" + scoring_token
-    try:
-        filename = unique_env_identifier
-        r = requests.get(query_url, stream=True)
-        if not r.status_code == 200:
-            return (530, "scoring_progress")
-
-        with open("/tmp/" + filename + ".scoreout", "wb") as s3csv:
-            # print("opened scoreout for writing")
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    s3csv.write(chunk)
-        # print("Retrieving scored output for :", filename)
-        return (0, "scoring_completed")
-    except:
-        err_mesg = str(sys.exc_info())
-        return (540, "scoring_result method failed" + err_mesg)
-
-
-def score_file_process(s3infile_presignedurl, s3outfile_presignedurl, k8s_url_for_scoring, unique_env_identifier,
-                       maxtime_scoring=40):
-    download_status_code, message = _download_one_file(s3infile_presignedurl, unique_env_identifier)
-    if not download_status_code == 0:
-        return (download_status_code, message)
-
-    score_status_code, scoring_token = _score_one_file(k8s_url_for_scoring, unique_env_identifier)
-    print("score status code and token:", score_status_code, scoring_token)
-    if not score_status_code == 0:
-        return (score_status_code, scoring_token)
-
-    jobs_pending = True
-    start = time.time()
-    while jobs_pending and (time.time() - start < maxtime_scoring):
-        scoring_result_code, message = _get_scoring_result(k8s_url_for_scoring, unique_env_identifier, scoring_token)
-        # print("scoring result code:", scoring_result_code)
-        if scoring_result_code == 0:
-            jobs_pending = False
-
-    if jobs_pending:
-        print("Went beyond allocated time. Aborting scoring ")
-        print("Time limit for scoring in secs: ", maxtime_scoring, "start time: ", time.ctime(start), "current time: ",
-              time.ctime(time.time()))
-        return (550, "Went beyond allocated time of 720secs for scoring")
-
-    # print("Scoring completed. File upload to begin..")
-    upload_status_code, message = upload_file_s3(s3outfile_presignedurl, filename=unique_env_identifier + ".scoreout")
-    if not upload_status_code == 0:
-        return (570, message)
-
-    return (0, "scoring completed and file uploaded to S3")
-
+from os import path
+
+import requests
+import json
+import yaml
+import xml.etree.ElementTree as ET
+import pickle
+import time
+import sys
+import os
+import threading
+import concurrent.futures
+import gzip
+import shutil
+import zlib
+
+from utils.lambdafunc_core_aws import *
+from utils.lambdafunc_core_s3_transfer import *
+from utils.lambdafunc_core_partition import *
+
+# gzip compressed uploads to scoring services that list gzip in X-Upload-Encodings of their ping response.
+# Results come back compressed anyway since requests sends Accept-Encoding and decodes transparently.
+_scoring_upload_encodings = {}
+
+
+def _upload_gzip(k8s_url_for_scoring):
+    return 'gzip' in _scoring_upload_encodings.get(k8s_url_for_scoring.rstrip('/'), [])
+
+
+# Input format by file extension, output csv, parquet or arrow. Output key suffix says which, as in the controller.
+INPUT_FORMAT_EXTENSIONS = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow'}
+SCOREOUT_SUFFIXES = {'csv': '.scoreout', 'parquet': '.scoreout.parquet', 'arrow': '.scoreout.arrow'}
+
+
+def input_format_of(objectkey):
+    return INPUT_FORMAT_EXTENSIONS.get(path.splitext(objectkey)[1].lower(), 'csv')
+
+
+def output_format_of(objectkey, output_format):
+    # "input" keeps the input file's format
+    if output_format in (None, '', 'input'):
+        return input_format_of(objectkey)
+    return output_format
+
+
+def _gzip_chunks(chunks):
+    # fastest level. Compression has to keep up with the network to be worth it.
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def validate_pingpong_on_scoring(k8s_cluster_url_for_scoring):
+    try:
+        http_resp = requests.get(url=k8s_cluster_url_for_scoring, timeout=10)
+        print("Ingress ping pong response: ", http_resp.text)
+        if http_resp.text == 'pong':
+            encodings = http_resp.headers.get('X-Upload-Encodings', '')
+            _scoring_upload_encodings[k8s_cluster_url_for_scoring.rstrip('/')] = \
+                [encoding.strip() for encoding in encodings.split(',') if encoding.strip()]
+            return True
+        else:
+            return False
+    except:
+        print("No response from scoring service in validate_pingpong_on_scoring method:")
+        print("Unexpected error:", sys.exc_info())
+        return False
+
+
+###
+
+def upload_file_s3(s3_presigned_url, filename=None, text_message=None):
+    # print("s3 file upload URL", s3file_uploadurl)
+    try:
+        # either filename or text_message or used by clients.
+        if text_message is not None:
+            # posted straight from memory. A shared /tmp file would get mixed up between records scored concurrently.
+            file_r = {"file": ("err_text", text_message)}
+        else:
+            filename1 = "/tmp/" + filename
+            file_r = {"file": open(filename1, 'rb')}
+    except:
+        err_message = str(sys.exc_info())
+        return (560, err_message)
+
+    try:
+        http_response = requests.post(url=s3_presigned_url['url'], data=s3_presigned_url['fields'], files=file_r)
+        if not http_response.status_code in range(200, 290):
+            print("file upload to s3 failed", http_response.status_code)
+            print("Full response:", http_response.text)
+
+        return (0, http_response.status_code)
+    except:
+        error_message = str(sys.exc_info())
+        return (570, "error uploading file to S3" + error_message)
+
+
+def _upload_scoreout(s3outfile_presignedurl, unique_env_identifier, s3out_location=None):
+    # with s3out_location (bucket, objectkey) large outputs go up as parallel multipart upload instead of one POST.
+    filename = unique_env_identifier + ".scoreout"
+    transfer_config = get_transfer_config_from_env(os.environ)
+    if s3out_location is not None and use_multipart_upload("/tmp/" + filename, transfer_config):
+        return upload_file_multipart(s3out_location[0], s3out_location[1], "/tmp/" + filename, transfer_config)
+    return upload_file_s3(s3outfile_presignedurl, filename=filename)
+
+
+###--
+
+def _download_one_file(s3file_downloadurl, unique_env_idenitier):
+    # large files come down as concurrent ranged GETs, see lambdafunc_core_s3_transfer.py
+    try:
+        filename = unique_env_idenitier
+        if not download_file_ranged(s3file_downloadurl, "/tmp/" + filename, get_transfer_config_from_env(os.environ)):
+            return (510, "Error downloading file from S3. Download failed or incomplete")
+        return (0, "success")
+    except:
+        err_mesg1 = "Error downloading file from S3 "
+        err_mesg2 = str(sys.exc_info())
+        return (510, err_mesg1 + err_mesg2)
+
+
+def _score_one_file(session_id, k8s_url_for_scoring, unique_env_identifier, input_filename=None, output_format='csv'):
+    # input_filename (S3 object name) goes along as upload file name. Scoring service reads the format off its extension.
+    # session_id carries the ingress affinity cookie; /status and /query have to reach the pod holding the job.
+    upload_filename = "/tmp/" + unique_env_identifier
+    input_filename = input_filename or unique_env_identifier
+    try:
+        if _upload_gzip(k8s_url_for_scoring):
+            with open(upload_filename, 'rb') as src, gzip.open(upload_filename + ".gz", 'wb', compresslevel=1) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            with open(upload_filename + ".gz", 'rb') as f:
+                http_response = session_id.post(url=k8s_url_for_scoring + "/executions",
+                                                files={"file": (input_filename, f, 'application/gzip')},
+                                                data={"output_format": output_format})
+            os.remove(upload_filename + ".gz")
+        else:
+            filename1 = {"file": (input_filename, open(upload_filename, 'rb'))}
+            http_response = session_id.post(url=k8s_url_for_scoring + "/executions", files=filename1,
+                                            data={"output_format": output_format})
+        scoring_token = json.loads(http_response.text)["id"]
+        # print("scoring response token:", scoring_token)
+        return (0, scoring_token)
+    except:
+        err_mesg1 = "Error submitting to scoring url @" + k8s_url_for_scoring + "/executions"
+        err_mesg2 = str(sys.exc_info())
+        return (520, err_mesg1 + err_mesg2)
+
+
+def _get_scoring_result(session_id, k8s_url_for_scoring, unique_env_identifier, scoring_token):
+    query_url = k8s_url_for_scoring + "/query/" + scoring_token
+    try:
+        filename = unique_env_identifier
+        r = session_id.get(query_url, stream=True)
+        if not r.status_code == 200:
+            return (530, "scoring_progress")
+
+        with open("/tmp/" + filename + ".scoreout", "wb") as s3csv:
+            # print("opened scoreout for writing")
+            for chunk in r.iter_content(chunk_size=1024):
+                if chunk:
+                    s3csv.write(chunk)
+        # print("Retrieving scored output for :", filename)
+        return (0, "scoring_completed")
+    except:
+        err_mesg = str(sys.exc_info())
+        return (540, "scoring_result method failed" + err_mesg)
+
+
+def _get_scoring_status(session_id, k8s_url_for_scoring, scoring_token, wait=0, state=None):
+    # returns (0, queued|running|succeeded|failed, waited). Long-polls up to wait secs for the state to change from
+    # state. waited is False when the service answered without long-polling.
+    # (580, None, False) when scoring service has no /status (older model images); caller falls back to /query.
+    status_url = k8s_url_for_scoring + "/status/" + scoring_token
+    params = {'wait': wait}
+    if state is not None:
+        params['state'] = state
+    try:
+        r = session_id.get(status_url, params=params, timeout=wait + 30)
+        if not r.status_code == 200:
+            return (580, None, False)
+        job_status = json.loads(r.text)
+        # services from before waited always long-polled
+        return (0, job_status["status"], job_status.get("waited", True))
+    except:
+        print("Unexpected error:", sys.exc_info())
+        return (580, None, False)
+
+
+def _status_poll_backoff(job_status, last_status, waited, backoff):
+    # secs to sleep before the next /status poll: backoff doubling to 10 while polls come back unchanged without
+    # having waited on the service, 0 otherwise. Returns (sleep, next backoff).
+    if job_status is None or (job_status == last_status and not waited):
+        return (backoff, min(backoff * 2, 10))
+    return (0, 0.5)
+
+
+def _score_downloaded_file(k8s_url_for_scoring, unique_env_identifier, maxtime_scoring, input_filename, output_format):
+    # /tmp/<unique_env_identifier> in, /tmp/<unique_env_identifier>.scoreout out. Returns (status_code, message).
+    # Own session per file (partition) for cookie affinity to the pod holding its job, as in the controller.
+    session_id = requests.session()
+    score_status_code, scoring_token = _score_one_file(session_id, k8s_url_for_scoring, unique_env_identifier,
+                                                       input_filename, output_format)
+    print("score status code and token:", score_status_code, scoring_token)
+    if not score_status_code == 0:
+        return (score_status_code, scoring_token)
+
+    # long-poll /status until the job finishes. Scoring services without /status are polled on /query with backoff.
+    jobs_pending = True
+    last_status = None
+    backoff = 0.5
+    start = time.time()
+    while jobs_pending and (time.time() - start < maxtime_scoring):
+        wait = max(min(20, int(maxtime_scoring - (time.time() - start))), 0)
+        status_code, job_status, waited = _get_scoring_status(session_id, k8s_url_for_scoring, scoring_token, wait,
+                                                              last_status)
+        if job_status == "failed":
+            return (555, "Scoring failed on scoring service. See " + k8s_url_for_scoring + "/query/" + scoring_token + "/log")
+        if job_status in ("succeeded", None):
+            scoring_result_code, message = _get_scoring_result(session_id, k8s_url_for_scoring, unique_env_identifier,
+                                                               scoring_token)
+            # print("scoring result code:", scoring_result_code)
+            if scoring_result_code == 0:
+                jobs_pending = False
+        if jobs_pending:
+            sleep, backoff = _status_poll_backoff(job_status, last_status, waited, backoff)
+            time.sleep(sleep)
+            last_status = job_status
+
+    if jobs_pending:
+        print("Went beyond allocated time. Aborting scoring ")
+        print("Time limit for scoring in secs: ", maxtime_scoring, "start time: ", time.ctime(start), "current time: ",
+              time.ctime(time.time()))
+        return (550, "Went beyond allocated time of 720secs for scoring")
+    return (0, "scoring completed")
+
+
+def _score_partitioned(k8s_url_for_scoring, unique_env_identifier, maxtime_scoring, input_filename, partition_size):
+    # input split at row boundaries, partitions scored concurrently (a session each, so the ingress spreads them over
+    # the deployment's replicas and keeps each on its own) and merged in row order into
+    # /tmp/<unique_env_identifier>.scoreout.
+    partitions = split_csv_file("/tmp/" + unique_env_identifier, partition_size)
+    os.remove("/tmp/" + unique_env_identifier)
+    print("Scoring in partitions:", len(partitions))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+            results = list(executor.map(
+                lambda partition: _score_downloaded_file(k8s_url_for_scoring, path.basename(partition),
+                                                         maxtime_scoring,
+                                                         (input_filename or unique_env_identifier) +
+                                                         path.splitext(partition)[1],
+                                                         'csv'),
+                partitions))
+        failed = [result for result in results if not result[0] == 0]
+        if failed:
+            return (failed[0][0], "Partitioned scoring failed. Partitions failed: " + str(len(failed)) + " " + failed[0][1])
+        merge_csv_files([partition + ".scoreout" for partition in partitions], "/tmp/" + unique_env_identifier + ".scoreout")
+        return (0, "scoring completed")
+    finally:
+        for partition in partitions:
+            for tmp_file in (partition, partition + ".scoreout"):
+                if path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+
+def score_file_process(s3infile_presignedurl, s3outfile_presignedurl, k8s_url_for_scoring, unique_env_identifier,
+                       maxtime_scoring=40, s3out_location=None, input_filename=None, output_format='csv',
+                       partition_size=0):
+    # csv files above partition_size are scored in partitions across the deployment's replicas
+    download_status_code, message = _download_one_file(s3infile_presignedurl, unique_env_identifier)
+    if not download_status_code == 0:
+        return (download_status_code, message)
+
+    if output_format == 'csv' and is_partitionable(input_filename or unique_env_identifier,
+                                                   path.getsize("/tmp/" + unique_env_identifier), partition_size):
+        score_status_code, message = _score_partitioned(k8s_url_for_scoring, unique_env_identifier, maxtime_scoring,
+                                                        input_filename, partition_size)
+    else:
+        score_status_code, message = _score_downloaded_file(k8s_url_for_scoring, unique_env_identifier,
+                                                            maxtime_scoring, input_filename, output_format)
+    if not score_status_code == 0:
+        return (score_status_code, message)
+
+    # print("Scoring completed. File upload to begin..")
+    upload_status_code, message = _upload_scoreout(s3outfile_presignedurl, unique_env_identifier, s3out_location)
+    if not upload_status_code == 0:
+        return (upload_status_code, message)
+
+    return (0, "scoring completed and file uploaded to S3")
+
+
+def score_file_process_streaming(s3infile_presignedurl, s3outfile_presignedurl, k8s_url_for_scoring,
+                                 unique_env_identifier, s3out_location=None):
+    # S3 input is streamed straight into the scoring pod (nothing lands in lambda /tmp) and scored rows stream back
+    # while the upload is still running. Needs in-process scoring on the pod.
+    session_id = requests.session()
+    upload_result = {}
+
+    def _stream_input(scoring_token, cookies):
+        try:
+            r = requests.get(s3infile_presignedurl, stream=True)
+            chunks = r.iter_content(chunk_size=1024 * 1024)
+            headers = {}
+            if _upload_gzip(k8s_url_for_scoring):
+                chunks = _gzip_chunks(chunks)
+                headers['Content-Encoding'] = 'gzip'
+            upload_result['response'] = requests.put(url=k8s_url_for_scoring + "/executions/stream/" + scoring_token,
+                                                     data=chunks, headers=headers, cookies=cookies)
+        except:
+            upload_result['error'] = str(sys.exc_info())
+
+    try:
+        http_response = session_id.post(url=k8s_url_for_scoring + "/executions/stream")
+        if not http_response.status_code == 201:
+            return (525, "Streaming scoring not available on scoring service " + http_response.text)
+        scoring_token = json.loads(http_response.text)["id"]
+
+        uploader = threading.Thread(target=_stream_input, args=(scoring_token, session_id.cookies.copy()))
+        uploader.start()
+
+        r = session_id.get(k8s_url_for_scoring + "/query/" + scoring_token + "/stream", stream=True)
+        with open("/tmp/" + unique_env_identifier + ".scoreout", "wb") as s3csv:
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                if chunk:
+                    s3csv.write(chunk)
+        uploader.join()
+    except:
+        err_mesg = str(sys.exc_info())
+        return (545, "streaming scoring failed" + err_mesg)
+
+    if 'error' in upload_result:
+        return (520, "Error streaming input to scoring url " + upload_result['error'])
+    if not upload_result['response'].status_code == 200:
+        return (540, "streaming scoring failed " + upload_result['response'].text)
+
+    upload_status_code, message = _upload_scoreout(s3outfile_presignedurl, unique_env_identifier, s3out_location)
+    if not upload_status_code == 0:
+        return (upload_status_code, message)
+
+    return (0, "scoring completed and file uploaded to S3")
+
+
+def score_file_process_direct_s3(s3infile_presignedurl, s3outfile_presignedurl, k8s_url_for_scoring,
+                                 maxtime_scoring=600, input_filename='input.csv', output_format='csv'):
+    # scoring pod fetches the input and uploads scored output itself. Lambda (128MB) only coordinates
+    # and no scoring bytes go through it.
+    job = {'input_url': s3infile_presignedurl, 'output_post': s3outfile_presignedurl, 'filename': input_filename,
+           'output_format': output_format}
+    session_id = requests.session()
+    start = time.time()
+    try:
+        # 429 while the scoring queue is full. Come back after Retry-After, as the controller does.
+        while True:
+            http_response = session_id.post(url=k8s_url_for_scoring + "/executions/s3", json=job)
+            retry_after = int(http_response.headers.get('Retry-After', 5))
+            if not http_response.status_code == 429 or time.time() + retry_after - start > maxtime_scoring:
+                break
+            time.sleep(retry_after)
+        if not http_response.status_code == 201:
+            return (520, "Error submitting to scoring url @" + k8s_url_for_scoring + "/executions/s3 " + http_response.text)
+        scoring_token = json.loads(http_response.text)["id"]
+    except:
+        err_mesg = str(sys.exc_info())
+        return (520, "Error submitting to scoring url @" + k8s_url_for_scoring + "/executions/s3 " + err_mesg)
+
+    last_status = None
+    backoff = 0.5
+    while time.time() - start < maxtime_scoring:
+        wait = max(min(20, int(maxtime_scoring - (time.time() - start))), 0)
+        status_code, job_status, waited = _get_scoring_status(session_id, k8s_url_for_scoring, scoring_token, wait,
+                                                              last_status)
+        if job_status == "succeeded":
+            return (0, "scoring completed and file uploaded to S3 by scoring service")
+        if job_status == "failed":
+            return (555, "Scoring failed on scoring service. See " + k8s_url_for_scoring + "/query/" + scoring_token + "/log")
+        # None: network error or ingress 5xx. Ask again after a backoff, the job runs on regardless.
+        sleep, backoff = _status_poll_backoff(job_status, last_status, waited, backoff)
+        time.sleep(sleep)
+        last_status = job_status
+
+    return (550, "Went beyond allocated time of " + str(maxtime_scoring) + "secs for scoring")
@@ -0,0 +1,93 @@
+import datetime
+import hashlib
+import random
+
+from utils.lambdafunc_core_aws import *
+
+
+# Cache of scored outputs keyed by (input ETag, model image digest, output format), same layout as the controller's
+# core_result_cache.py: an entry is a copy of the scoreout under <s3_outputfolder>/_scorecache/. A file scored before
+# with the very same model image is copied from there and no pod is provisioned for it. Entries older than
+# cache_max_age secs are ignored and evicted; beyond cache_max_bytes in total the oldest go first.
+# Eviction lists the whole cache folder, so an invocation only runs it with a chance of 1 in cache_evict_every.
+RESULT_CACHE_FOLDER = "_scorecache/"
+
+
+def get_result_cache_config_from_env(environ):
+    return {
+        'cache_enabled': environ.get('cache_enabled', 'false') == 'true',
+        'cache_max_age': int(environ.get('cache_max_age', 604800)),
+        'cache_max_bytes': int(environ.get('cache_max_bytes', 107374182400)),
+        'cache_evict_every': int(environ.get('cache_evict_every', 100))
+    }
+
+
+def is_result_cache_eviction_due(result_cache_config):
+    return random.randrange(max(result_cache_config['cache_evict_every'], 1)) == 0
+
+
+def result_cache_prefix(s3out_prefix):
+    return s3out_prefix + RESULT_CACHE_FOLDER
+
+
+def _cache_entry_key(cache_prefix, etag, image_digest, output_format):
+    return cache_prefix + hashlib.sha256((etag.strip('"') + "/" + image_digest + "/" + output_format).encode('utf-8')).hexdigest()
+
+
+def _age_secs(last_modified):
+    return (datetime.datetime.now(datetime.timezone.utc) - last_modified).total_seconds()
+
+
+def lookup_result_cache(bucket, cache_prefix, etag, image_digest, output_format, max_age):
+    # key of a fresh entry, None on a miss.
+    entry_key = _cache_entry_key(cache_prefix, etag, image_digest, output_format)
+    try:
+        response = get_aws_client('s3').head_object(Bucket=bucket, Key=entry_key)
+    except ClientError as e:
+        if not e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            print("Unexpected error while looking up result cache: %s" % e)
+        return None
+    if _age_secs(response['LastModified']) > max_age:
+        return None
+    return entry_key
+
+
+def _copy_s3object(bucket_from, key_from, bucket_to, key_to):
+    # managed copy, multipart for objects above 5GB. Bytes stay within S3, none go through lambda.
+    try:
+        get_aws_client('s3').copy({'Bucket': bucket_from, 'Key': key_from}, bucket_to, key_to)
+        return True
+    except ClientError as e:
+        print("Unexpected error while copying s3 object %s: %s" % (key_from, e))
+        return False
+
+
+def copy_from_result_cache(bucket, entry_key, s3out_objectkey):
+    return _copy_s3object(bucket, entry_key, bucket, s3out_objectkey)
+
+
+def store_in_result_cache(bucket, s3out_objectkey, cache_prefix, etag, image_digest, output_format):
+    return _copy_s3object(bucket, s3out_objectkey, bucket,
+                          _cache_entry_key(cache_prefix, etag, image_digest, output_format))
+
+
+def evict_result_cache(bucket, cache_prefix, max_age, max_bytes):
+    s3_client = get_aws_client('s3')
+    try:
+        entries = []
+        for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=cache_prefix):
+            entries.extend(page.get('Contents', []))
+        entries.sort(key=lambda entry: entry['LastModified'])
+        total_bytes = sum(entry['Size'] for entry in entries)
+        evicted = []
+        for entry in entries:
+            if _age_secs(entry['LastModified']) > max_age or total_bytes > max_bytes:
+                evicted.append({'Key': entry['Key']})
+                total_bytes -= entry['Size']
+        # delete_objects takes 1000 keys per call
+        for batch in range(0, len(evicted), 1000):
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': evicted[batch:batch + 1000], 'Quiet': True})
+    except ClientError as e:
+        print("Unexpected error while evicting result cache entries: %s" % e)
+        return (690, "Result cache eviction failed " + str(e))
+    return (0, "Result cache entries: " + str(len(entries) - len(evicted)) + " evicted: " + str(len(evicted)))
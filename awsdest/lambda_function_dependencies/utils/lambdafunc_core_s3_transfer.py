@@ -0,0 +1,189 @@
+import concurrent.futures
+import math
+import os
+import sys
+import time
+
+import requests
+
+from utils.lambdafunc_core_aws import *
+
+
+# Parallel S3 transfers for large files. Uploads go through S3 multipart upload with presigned UploadPart URLs: the
+# file is cut into parts that are PUT concurrently, each retried on its own, instead of one POST form upload that is
+# single stream, capped at 5 GB and restarts from zero on failure.
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+
+
+def get_transfer_config_from_env(environ):
+    return {
+        'multipart_threshold': int(environ.get('multipart_threshold', 64 * 1024 * 1024)),
+        'multipart_part_size': int(environ.get('multipart_part_size', 32 * 1024 * 1024)),
+        'multipart_concurrency': int(environ.get('multipart_concurrency', 8)),
+        'multipart_part_retries': int(environ.get('multipart_part_retries', 3))
+    }
+
+
+def use_multipart_upload(filename, transfer_config):
+    return os.path.getsize(filename) >= transfer_config['multipart_threshold']
+
+
+class _FilePart(object):
+    # read-only view of length bytes of a file from offset. requests streams it from /tmp with a Content-Length, so
+    # parts never have to fit in lambda memory.
+    def __init__(self, filename, offset, length):
+        self._file = open(filename, 'rb')
+        self._file.seek(offset)
+        self._remaining = length
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def _part_layout(file_size, part_size):
+    # S3 wants parts of at least 5MB (except the last) and at most 10000 of them. Returns [(offset, length)].
+    part_size = max(part_size, S3_MIN_PART_SIZE, int(math.ceil(file_size / S3_MAX_PARTS)))
+    return [(offset, min(part_size, file_size - offset)) for offset in range(0, max(file_size, 1), part_size)]
+
+
+def _put_part(part_url, filename, offset, length, retries):
+    # returns ETag of the uploaded part or None once retries are used up.
+    for attempt in range(retries + 1):
+        part = _FilePart(filename, offset, length)
+        try:
+            http_response = requests.put(part_url, data=part, timeout=(10, 300))
+            if http_response.status_code == 200:
+                return http_response.headers['ETag']
+            print("part upload to s3 failed", http_response.status_code, http_response.text)
+        except requests.exceptions.RequestException as e:
+            print("part upload to s3 failed", str(e))
+        finally:
+            part.close()
+        time.sleep(min(2 ** attempt, 30))
+    return None
+
+
+def upload_file_multipart(bucket, objectkey, filename, transfer_config):
+    # returns (0, message) once the object is complete in S3. On any part failing for good the upload is aborted.
+    parts_layout = _part_layout(os.path.getsize(filename), transfer_config['multipart_part_size'])
+    upload_id = create_multipart_upload(bucket, objectkey)
+    if upload_id is None:
+        return (585, "multipart upload to S3 could not be created")
+
+    try:
+        part_urls = get_s3presignedurls_for_uploadpart(bucket, objectkey, upload_id, len(parts_layout),
+                                                       expires_in=3600)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=transfer_config['multipart_concurrency']) as executor:
+            etags = list(executor.map(lambda part: _put_part(part[0], filename, part[1][0], part[1][1],
+                                                             transfer_config['multipart_part_retries']),
+                                      zip(part_urls, parts_layout)))
+    except:
+        abort_multipart_upload(bucket, objectkey, upload_id)
+        return (590, "multipart upload to S3 failed " + str(sys.exc_info()))
+
+    if None in etags:
+        abort_multipart_upload(bucket, objectkey, upload_id)
+        return (590, "multipart upload to S3 failed. Parts failed: " + str(etags.count(None)))
+
+    parts = [{'ETag': etag, 'PartNumber': part_number} for part_number, etag in enumerate(etags, start=1)]
+    if not complete_multipart_upload(bucket, objectkey, upload_id, parts):
+        abort_multipart_upload(bucket, objectkey, upload_id)
+        return (595, "multipart upload to S3 could not be completed")
+
+    return (0, "multipart upload to S3 complete. Parts: " + str(len(parts_layout)))
+
+
+###
+# Downloads: concurrent byte-range GETs against the presigned URL, each written at its offset into a preallocated
+# file in /tmp. Uses the same threshold, part size, concurrency and retries as uploads.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _probe_object(s3file_downloadurl):
+    # (size, etag) from a one byte ranged GET. size None when the server ignored the range and sent the whole object.
+    with requests.get(s3file_downloadurl, headers={'Range': 'bytes=0-0'}, stream=True, timeout=(10, 60)) as http_response:
+        if http_response.status_code == 416:
+            # empty object, nothing to range over
+            return (0, None)
+        http_response.raise_for_status()
+        etag = http_response.headers.get('ETag')
+        if http_response.status_code == 206:
+            return (int(http_response.headers['Content-Range'].split('/')[-1]), etag)
+        return (None, etag)
+
+
+def _download_single_stream(s3file_downloadurl, filename):
+    with requests.get(s3file_downloadurl, stream=True, timeout=(10, 300)) as http_response:
+        http_response.raise_for_status()
+        written = 0
+        with open(filename, "wb") as f:
+            for chunk in http_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+        expected = http_response.headers.get('Content-Length')
+        return expected is None or written == int(expected)
+
+
+def _get_range(s3file_downloadurl, filename, offset, length, etag, retries):
+    # bytes written to [offset, offset + length): length once the range is complete, 0 if it failed. If-Match makes
+    # S3 refuse (412) if the object was replaced since the probe, so ranges of two different versions never end up
+    # in one file.
+    headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+    if etag is not None:
+        headers['If-Match'] = etag
+    for attempt in range(retries + 1):
+        try:
+            with requests.get(s3file_downloadurl, headers=headers, stream=True, timeout=(10, 300)) as http_response:
+                if http_response.status_code == 412:
+                    print("s3 object changed during download")
+                    return 0
+                if http_response.status_code == 206:
+                    written = 0
+                    with open(filename, "r+b") as f:
+                        f.seek(offset)
+                        for chunk in http_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            # more than asked for would overwrite the next range
+                            if written + len(chunk) > length:
+                                break
+                            f.write(chunk)
+                            written += len(chunk)
+                        else:
+                            if written == length:
+                                return written
+                print("range download from s3 failed", http_response.status_code, offset, length)
+        except requests.exceptions.RequestException as e:
+            print("range download from s3 failed", str(e))
+        time.sleep(min(2 ** attempt, 30))
+    return 0
+
+
+def download_file_ranged(s3file_downloadurl, filename, transfer_config):
+    # True once every range of the object is written, their bytes adding up to the size S3 reported. The file is
+    # preallocated to that size, so its size on disk says nothing.
+    size, etag = _probe_object(s3file_downloadurl)
+    if size is None or size < transfer_config['multipart_threshold']:
+        return _download_single_stream(s3file_downloadurl, filename)
+
+    with open(filename, "wb") as f:
+        f.truncate(size)
+    ranges = _part_layout(size, transfer_config['multipart_part_size'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=transfer_config['multipart_concurrency']) as executor:
+        written = list(executor.map(lambda part: _get_range(s3file_downloadurl, filename, part[0], part[1], etag,
+                                                            transfer_config['multipart_part_retries']), ranges))
+    failed = [part for part, part_written in zip(ranges, written) if not part_written == part[1]]
+    if failed:
+        print("ranged download from s3 failed for", filename, "ranges failed:", len(failed))
+        return False
+    return sum(written) == size
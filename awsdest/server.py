@@ -1,282 +1,1645 @@
-#
-# Copyright © 2019, SAS Institute Inc., Cary, NC, USA.  All Rights Reserved.
-# SPDX-License-Identifier: Apache-2.0
-#
-
-import os
-import zipfile
-import time
-import json
-import logging
-from flask import Flask, jsonify, request, Response
-from flask import send_from_directory
-
-import warnings
-warnings.filterwarnings("ignore")
-
-app = Flask(__name__)
-if __name__ != '__main__':
-    gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-
-
-def locate_zip_file(dest):
-    # search for zip file
-    for file1 in os.listdir(dest):
-        if file1.endswith(".zip"):
-            return file1
-    return None
-
-
-def unzip_file(zip_file, dest):
-    # unzip
-    zip_ref = zipfile.ZipFile(zip_file, 'r')
-
-    if not os.path.isdir(dest):
-        os.mkdir(dest)
-    zip_ref.extractall(dest)
-    zip_ref.close()
-
-
-# find the first file which matches the pattern
-def find_file(suffix):
-    current_dir = os.getcwd()
-    for file in os.listdir(current_dir):
-        if file.endswith(suffix):
-            filename = file
-            return os.path.join(current_dir, filename)
-
-    return None
-
-
-def find_names_by_role(filename, role):
-    var_file = find_file(filename)
-    if var_file is None:
-        return None
-    if os.path.isfile(var_file):
-        with open(var_file) as f:
-            json_object = json.load(f)
-
-        names = []
-        for row in json_object:
-            if row['role'] == role:
-                names.append(row["name"])
-        if names == []:
-            return None
-        return names
-    else:
-        app.logger.info('Didnot find any role: ' + role + ' in file: ' + filename)
-        return None
-
-
-def find_score_script(filename):
-    return find_names_by_role(filename, 'score')
-
-
-def find_models(filename):
-    return find_names_by_role(filename, 'model')
-
-
-# setup model repository directory
-model_repo = '/pybox/model'
-if "model_repository" in os.environ:
-    model_repo = os.environ['model_repository']
-
-app.logger.info("Model location: " + model_repo)
-if not os.path.isdir(model_repo):
-    raise RuntimeError("model repository not existed!")
-
-# locate the zip file
-model_zip_file_name = locate_zip_file(model_repo)
-if model_zip_file_name is None:
-    app.logger.info("Error: Can't find model zip file in the repository!")
-    raise RuntimeError("Can't find model zip file in the repository!")
-
-subfolder = model_repo
-
-model_zip_file = os.path.join(model_repo, model_zip_file_name)
-
-# extract the zip file
-unzip_file(model_zip_file, subfolder)
-
-print("Completed Initialization!")
-
-
-# return test_id value
-# the result file will be <test_id>.csv
-def score(filename):
-    app.logger.debug(filename)
-
-    # based on current timestamp
-    test_id = str(time.time())
-    output_file = test_id + '.csv'
-    log_file = test_id + '.log'
-    app.logger.debug(output_file)
-
-    # keep current dir
-    current_dir = os.getcwd()
-    os.chdir(subfolder)
-
-    # search for score script
-    # 1) search for ContainerWrapper.py
-    if os.path.isfile("ContainerWrapper.py"):
-        score_file = "ContainerWrapper.py"
-    else:
-        # 2) search for score code defined in fileMetadata.json
-        names = find_score_script('fileMetadata.json')
-
-        if names is None:
-            # 3) find the first score script in the current then
-            score_file = '_score.py'
-            for file1 in os.listdir("."):
-                if file1.endswith("score.py") and file1 != score_file:
-                    score_file = file1
-                    break
-        else:
-            score_file = names[0]
-
-    # search for model
-    names = find_models('fileMetadata.json')
-    model_param = ''
-    if names is not None:
-        model_param = ' -m '+names[0]
-
-    command_str = 'python -W ignore ' + score_file + model_param + ' -i ' + filename+' -o ' + output_file 
-
-    f = open(log_file,"w+")
-    f.write("Scoring...\n")
-    f.write(" "+command_str+"\n")
-    f.close()
-
-    command_str = command_str + ' >> '+log_file + ' 2>&1'
-
-    app.logger.info(command_str)
-    os.system(command_str)
-
-    f = open(log_file,"a")
-    f.write("\nCompleted!\n")
-    f.close()
-
-    os.chdir(current_dir)
-
-    return test_id
-
-
-@app.route('/', methods=['GET'])
-def ping():
-    return return_text("pong")
-
-
-@app.route('/executions', methods=['POST'])
-def batch():
-    """
- * Accept input data in csv file and store it to subdirectory <model repo dir>/<job definition id>
- * Try sample.csv if there's no input data file;
- * execute the python program (under the anaconda environment)
- * extract score filename from fileMetadata.json if any, otherwise assume the first python script ending with 'score.py'. Default script is _score.py
- * execution
-   - cd <model repo dir>/<job definition id>
-   - python score.py -i <inputdata.csv> -o <timestamp>.csv
- * return output filename with the path if succeed
- * TODO single score, async
-    """
-    try:
-        file = request.files['file']
-        # print(file)
-        input_file_name = file.filename
-        input_file = os.path.join(subfolder, input_file_name)
-        file.save(input_file)
-    except:
-        input_file_name = 'sample.csv'
-        input_file = os.path.join(subfolder, input_file_name)
-        if not os.path.isfile(input_file):
-            return bad_request("Can't find sample.csv in the model zip file!")
-
-    test_id = score(input_file)
-    return created_request(test_id)
-
-
-# In future we could extend this call to two calls, one for checking status and the other for retrieving csv file
-@app.route('/query/<test_id>', methods=['GET'])
-def query(test_id):
-    """
-    read csv file from <test_id>.csv as an attachment
-    """
-    test_id = test_id.lower()
-    if not test_id.endswith('.csv'):
-        output_file = test_id + '.csv'
-    else:
-        output_file = test_id
-
-    full_output_file = os.path.join(subfolder, output_file)
-    if not os.path.isfile(full_output_file):
-        return not_found(full_output_file)
-
-    return send_from_directory(subfolder, output_file, as_attachment=True)
-
-
-# return <test_id>.log
-@app.route('/query/<test_id>/log', methods=['GET'])
-def querylog(test_id):
-    """
-    read log file from <test_id>.log as an attachment
-    """
-    test_id = test_id.lower()
-    output_file = test_id + '.log'
-
-    full_output_file = os.path.join(subfolder, output_file)
-    if not os.path.isfile(full_output_file):
-        return not_found(full_output_file)
-
-    return send_from_directory(subfolder, output_file, as_attachment=True)
-
-
-# get gunicorn log
-@app.route('/system/log', methods=['GET'])
-def systemlog():
-
-    full_log_file = "/var/log/gunicorn.log"
-    if not os.path.isfile(full_log_file):
-        return not_found(full_log_file)
-
-    return send_from_directory('/var/log', 'gunicorn.log', as_attachment=True)
-
-
-def return_text(text):
-    return Response(text, status=200, mimetype='text/plain')
-
-
-def created_request(msg=None):
-    message = {
-        'status': 201,
-        'id': msg
-    }
-    resp = jsonify(message)
-    resp.status_code = 201
-
-    return resp
-
-
-@app.errorhandler(400)
-def bad_request(error=None):
-    message = {
-        'status': 400,
-        'message': 'Bad Request: ' + request.url + '--> Please check your data payload...' + error,
-    }
-    resp = jsonify(message)
-    resp.status_code = 400
-
-    return resp
-
-
-@app.errorhandler(404)
-def not_found(filename=None):
-    message = {
-        'status': 404,
-        'message': 'Bad Request: ' + request.url + '--> Please check your input...' + filename,
-    }
-    resp = jsonify(message)
-    resp.status_code = 404
-
-    return resp
+#
+# Copyright © 2019, SAS Institute Inc., Cary, NC, USA.  All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+import io
+import sys
+import csv
+import zipfile
+import time
+import json
+import pickle
+import logging
+import traceback
+import importlib.util
+import queue
+import subprocess
+import threading
+import shutil
+import gzip
+import zlib
+import hashlib
+import sqlite3
+import uuid
+import re
+from flask import Flask, jsonify, request, Response
+from flask import send_from_directory
+from werkzeug.utils import secure_filename
+
+# requests is only needed for pod-side S3 I/O (/executions/s3)
+try:
+    import requests
+except ImportError:
+    requests = None
+
+# zstandard is optional. Without it uploads and results are gzip only.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# pyarrow is optional. Without it only csv goes in and out.
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import warnings
+warnings.filterwarnings("ignore")
+
+app = Flask(__name__)
+if __name__ != '__main__':
+    gunicorn_logger = logging.getLogger('gunicorn.error')
+    app.logger.handlers = gunicorn_logger.handlers
+    app.logger.setLevel(gunicorn_logger.level)
+
+
+def locate_zip_file(dest):
+    # search for zip file
+    for file1 in os.listdir(dest):
+        if file1.endswith(".zip"):
+            return file1
+    return None
+
+
+def unzip_file(zip_file, dest):
+    # unzip
+    zip_ref = zipfile.ZipFile(zip_file, 'r')
+
+    if not os.path.isdir(dest):
+        os.mkdir(dest)
+    zip_ref.extractall(dest)
+    zip_ref.close()
+
+
+def file_checksum(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# find the first file which matches the pattern
+def find_file(suffix):
+    current_dir = os.getcwd()
+    for file in os.listdir(current_dir):
+        if file.endswith(suffix):
+            filename = file
+            return os.path.join(current_dir, filename)
+
+    return None
+
+
+def find_names_by_role(filename, role):
+    var_file = find_file(filename)
+    if var_file is None:
+        return None
+    if os.path.isfile(var_file):
+        with open(var_file) as f:
+            json_object = json.load(f)
+
+        names = []
+        for row in json_object:
+            if row['role'] == role:
+                names.append(row["name"])
+        if names == []:
+            return None
+        return names
+    else:
+        app.logger.info('Didnot find any role: ' + role + ' in file: ' + filename)
+        return None
+
+
+def find_score_script(filename):
+    return find_names_by_role(filename, 'score')
+
+
+def find_models(filename):
+    return find_names_by_role(filename, 'model')
+
+
+def find_input_variables(filename):
+    return find_names_by_role(filename, 'input')
+
+
+# setup model repository directory
+model_repo = '/pybox/model'
+if "model_repository" in os.environ:
+    model_repo = os.environ['model_repository']
+
+app.logger.info("Model location: " + model_repo)
+if not os.path.isdir(model_repo):
+    raise RuntimeError("model repository not existed!")
+
+# locate the zip file
+model_zip_file_name = locate_zip_file(model_repo)
+if model_zip_file_name is None:
+    app.logger.info("Error: Can't find model zip file in the repository!")
+    raise RuntimeError("Can't find model zip file in the repository!")
+
+subfolder = model_repo
+
+model_zip_file = os.path.join(model_repo, model_zip_file_name)
+model_zip_checksum = file_checksum(model_zip_file)
+
+# extract the zip file. Skipped when the marker left by the last extraction has this zip's checksum, so a restarted
+# container with the repository on a volume does not unzip again.
+extract_marker_file = os.path.join(subfolder, '.extracted.sha256')
+extracted_checksum = None
+if os.path.isfile(extract_marker_file):
+    with open(extract_marker_file) as f:
+        extracted_checksum = f.read().strip()
+if extracted_checksum == model_zip_checksum:
+    app.logger.info("Model zip already extracted: " + model_zip_checksum)
+else:
+    unzip_file(model_zip_file, subfolder)
+    with open(extract_marker_file + '.tmp', 'w') as f:
+        f.write(model_zip_checksum)
+    os.replace(extract_marker_file + '.tmp', extract_marker_file)
+
+
+# search for score script. Expects current dir to be the model subfolder.
+def find_score_file():
+    # 1) search for ContainerWrapper.py
+    if os.path.isfile("ContainerWrapper.py"):
+        return "ContainerWrapper.py"
+
+    # 2) search for score code defined in fileMetadata.json
+    names = find_score_script('fileMetadata.json')
+    if names is not None:
+        return names[0]
+
+    # 3) find the first score script in the current then
+    score_file = '_score.py'
+    for file1 in os.listdir("."):
+        if file1.endswith("score.py") and file1 != score_file:
+            score_file = file1
+            break
+    return score_file
+
+
+# search for model. Expects current dir to be the model subfolder.
+def find_model_file():
+    names = find_models('fileMetadata.json')
+    if names is None:
+        return None
+    return names[0]
+
+
+# csv cells come in as text. Give score code numbers where the text is plainly a number so
+# 46236 stays 46236 (and not 46236.0) when written back out. Anything that would not be written
+# back the same (ids like 007, " 5", 1e5, nan, 1.50) stays text.
+INT_TEXT = re.compile(r'-?(0|[1-9][0-9]*)')
+FLOAT_TEXT = re.compile(r'-?(0|[1-9][0-9]*)\.[0-9]+')
+
+
+def typed_value(text):
+    if text == '':
+        return None
+    if INT_TEXT.fullmatch(text) and not text == '-0':
+        return int(text)
+    if FLOAT_TEXT.fullmatch(text):
+        number = float(text)
+        if repr(number) == text:
+            return number
+    return text
+
+
+class Metrics(object):
+    """
+    Counters and histograms served on /metrics in the Prometheus text format (hand-rolled, no prometheus_client in
+    the image). Gauges (queue depth, RSS and such) are read when /metrics is scraped, see metrics_text().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.described = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def describe(self, name, metric_type, help_text, buckets=None):
+        self.described[name] = (metric_type, help_text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.described[name][2]
+        with self.lock:
+            # per bucket counts (not cumulative), then sum
+            histogram = self.histograms.setdefault(key, [0] * len(buckets) + [0.0])
+            for bucket, upper in enumerate(buckets):
+                if value <= upper:
+                    histogram[bucket] += 1
+                    break
+            histogram[-1] += value
+
+    def text(self):
+        lines = []
+        with self.lock:
+            for name, (metric_type, help_text, buckets) in self.described.items():
+                lines.append('# HELP ' + name + ' ' + help_text)
+                lines.append('# TYPE ' + name + ' ' + metric_type)
+                for (key_name, labels), value in sorted(self.counters.items()):
+                    if key_name == name:
+                        lines.append(name + metric_labels(labels) + ' ' + str(value))
+                for (key_name, labels), histogram in sorted(self.histograms.items()):
+                    if key_name == name:
+                        lines.extend(histogram_lines(name, labels, buckets, histogram[:-1], histogram[-1]))
+        return lines
+
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for name, value in labels) + '}'
+
+
+def histogram_lines(name, labels, buckets, counts, total):
+    lines = []
+    cumulative = 0
+    for upper, count in zip(buckets, counts):
+        cumulative += count
+        le = '+Inf' if upper == float('inf') else repr(float(upper))
+        lines.append(name + '_bucket' + metric_labels(tuple(labels) + (('le', le),)) + ' ' + str(cumulative))
+    lines.append(name + '_sum' + metric_labels(labels) + ' ' + str(total))
+    lines.append(name + '_count' + metric_labels(labels) + ' ' + str(cumulative))
+    return lines
+
+
+metrics = Metrics()
+metrics.describe('scoring_job_duration_seconds', 'histogram', 'Duration of scoring jobs (/executions, /executions/s3) by outcome.',
+                 [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float('inf')])
+metrics.describe('scoring_realtime_duration_seconds', 'histogram', 'Duration of /score requests, micro-batch wait included.',
+                 [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, float('inf')])
+metrics.describe('scoring_rows_total', 'counter', 'Rows passed to score_records (in-process scoring).')
+metrics.describe('scoring_input_bytes_total', 'counter', 'Bytes of input scored: job input files and /score request bodies.')
+metrics.describe('scoring_output_bytes_total', 'counter', 'Bytes of scored output: job result files, /score responses and streamed results.')
+metrics.describe('scoring_errors_total', 'counter', 'Failed scoring jobs, streams and /score requests.')
+
+
+# Input format comes from the file extension, output format from the request (default: same as the input).
+# Parquet and Arrow IPC keep column types from end to end, no csv text in between.
+file_format_extensions = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow'}
+output_extensions = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+output_mimetypes = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet',
+                    'arrow': 'application/vnd.apache.arrow.file'}
+scoring_formats = ['csv'] + (['parquet', 'arrow'] if pyarrow is not None else [])
+
+
+def file_format(filename):
+    return file_format_extensions.get(os.path.splitext(filename)[1].lower(), 'csv')
+
+
+def find_output_file(test_id):
+    # <test_id>.csv, .parquet or .arrow, whichever the job wrote. None while it is not there (yet).
+    for extension in output_extensions.values():
+        if os.path.isfile(os.path.join(subfolder, test_id + extension)):
+            return test_id + extension
+    return None
+
+
+def open_record_batches(filename, input_format, block_rows):
+    # (schema, iterator of record batches) without reading the whole file into memory
+    if input_format == 'parquet':
+        parquet_file = pyarrow.parquet.ParquetFile(filename)
+        return parquet_file.schema_arrow, parquet_file.iter_batches(batch_size=block_rows)
+    if input_format == 'arrow':
+        source = pyarrow.memory_map(filename)
+        try:
+            reader = pyarrow.ipc.open_file(source)
+            return reader.schema, (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pyarrow.ArrowInvalid:
+            # Arrow IPC stream format rather than file format
+            source.seek(0)
+            reader = pyarrow.ipc.open_stream(source)
+            return reader.schema, iter(reader)
+    reader = pyarrow.csv.open_csv(filename)
+    return reader.schema, iter(reader)
+
+
+def open_table_writer(filename, output_format, schema):
+    if output_format == 'parquet':
+        return pyarrow.parquet.ParquetWriter(filename, schema)
+    if output_format == 'arrow':
+        return pyarrow.ipc.new_file(pyarrow.OSFile(filename, 'wb'), schema)
+    return pyarrow.csv.CSVWriter(filename, schema)
+
+
+def convert_file_format(input_file, input_format, output_file, output_format):
+    # for csv-only score code. Types are then whatever the csv reader infers.
+    schema, batches = open_record_batches(input_file, input_format, score_block_rows)
+    writer = open_table_writer(output_file, output_format, schema)
+    try:
+        for batch in batches:
+            writer.write_batch(batch)
+    finally:
+        writer.close()
+
+
+class RowDeduplicator(object):
+    """
+    Scores each distinct feature vector once. Rows are keyed by a hash of their feature columns (input variables from
+    inputVar.json, all columns without it); score_records only sees the first row of every key in a block and its
+    output is copied to the duplicates in their original order. Other input columns (ids and such) stay the row's own.
+    With a memo file, outputs are also kept in sqlite per model version (model zip checksum), so a feature vector
+    scored in an earlier file or job is not scored again as long as the model zip is unchanged.
+    """
+
+    def __init__(self, feature_names, memo_file, model_version):
+        self.feature_names = feature_names
+        self.memo_file = memo_file
+        self.model_version = model_version
+        self.rows_seen = 0
+        self.rows_scored = 0
+        self.stats_lock = threading.Lock()
+        self.connections = threading.local()
+        if memo_file is not None:
+            with self._memo() as memo:
+                memo.execute("CREATE TABLE IF NOT EXISTS memo (model_version TEXT, row_key BLOB, output BLOB, "
+                             "PRIMARY KEY (model_version, row_key))")
+
+    def _memo(self):
+        # one connection per scoring thread. sqlite serializes the writers.
+        if getattr(self.connections, 'memo', None) is None:
+            self.connections.memo = sqlite3.connect(self.memo_file, timeout=30)
+        return self.connections.memo
+
+    def _row_key(self, record):
+        names = self.feature_names if self.feature_names is not None else sorted(record)
+        return hashlib.blake2b(repr([record.get(name) for name in names]).encode('utf-8'), digest_size=16).digest()
+
+    def _memo_lookup(self, keys):
+        found = {}
+        # sqlite allows 999 parameters per statement in older versions
+        for start in range(0, len(keys), 900):
+            batch = keys[start:start + 900]
+            rows = self._memo().execute("SELECT row_key, output FROM memo WHERE model_version = ? AND row_key IN (" +
+                                        ",".join("?" * len(batch)) + ")", [self.model_version] + batch)
+            found.update((row_key, pickle.loads(output)) for row_key, output in rows)
+        return found
+
+    def _memo_store(self, outputs_by_key):
+        with self._memo() as memo:
+            memo.executemany("INSERT OR IGNORE INTO memo VALUES (?, ?, ?)",
+                             [(self.model_version, key, pickle.dumps(output)) for key, output in outputs_by_key.items()])
+
+    def score_records(self, records, score_fn):
+        keys = [self._row_key(record) for record in records]
+        first_rows = {}
+        for index, key in enumerate(keys):
+            first_rows.setdefault(key, index)
+
+        outputs_by_key = self._memo_lookup(list(first_rows)) if self.memo_file is not None else {}
+        missing = [key for key in first_rows if key not in outputs_by_key]
+        if missing:
+            scored = dict(zip(missing, score_fn([records[first_rows[key]] for key in missing])))
+            outputs_by_key.update(scored)
+            if self.memo_file is not None:
+                self._memo_store(scored)
+        with self.stats_lock:
+            self.rows_seen += len(records)
+            self.rows_scored += len(missing)
+
+        features = set(self.feature_names) if self.feature_names is not None else None
+        outputs = []
+        for record, key in zip(records, keys):
+            output = outputs_by_key[key]
+            # a copied output carries the scored row's values of non-feature columns. Put this row's own back.
+            own_names = [name for name in output if name in record and name not in features] if features else []
+            if own_names:
+                output = dict(output)
+                output.update((name, record[name]) for name in own_names)
+            outputs.append(output)
+        return outputs
+
+
+class InProcessScorer(object):
+    """
+    Score module imported once at startup and called directly for each request.
+    The score module (found by find_score_file) may define
+      load_model(model_file) -> model                optional, default unpickles the model file if there is one
+      score_records(model, records) -> list of dict  one output dict per input record dict
+      score_file(model, input_file, output_file)     optional, default is csv -> score_records -> csv
+    Scripts with neither entry point (for example a ContainerWrapper.py doing all its work in main) run in subprocess mode.
+    """
+
+    def __init__(self, score_file, model_file, block_rows, deduplicator=None):
+        self.score_file_name = score_file
+        self.block_rows = block_rows
+        self.deduplicator = deduplicator
+
+        module_name = os.path.splitext(os.path.basename(score_file))[0]
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(subfolder, score_file))
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+
+        self.score_records_fn = getattr(self.module, 'score_records', None)
+        self.score_file_fn = getattr(self.module, 'score_file', None)
+        if self.score_records_fn is None and self.score_file_fn is None:
+            raise RuntimeError(score_file + " has no score_records or score_file entry point")
+
+        self.model = None
+        if hasattr(self.module, 'load_model'):
+            self.model = self.module.load_model(model_file)
+        elif model_file is not None and os.path.isfile(model_file):
+            with open(model_file, 'rb') as f:
+                self.model = pickle.load(f)
+
+    def score_records(self, records):
+        if self.score_records_fn is None:
+            raise RuntimeError(self.score_file_name + " can only score files (no score_records entry point)")
+        metrics.inc('scoring_rows_total', len(records))
+        if self.deduplicator is not None:
+            return self.deduplicator.score_records(records, self._score_unique_records)
+        return self._score_unique_records(records)
+
+    def _score_unique_records(self, records):
+        outputs = self.score_records_fn(self.model, records)
+        if len(outputs) != len(records):
+            raise RuntimeError("score_records returned " + str(len(outputs)) + " rows for " + str(len(records)) + " input rows")
+        return outputs
+
+    def can_score_records(self):
+        return self.score_records_fn is not None
+
+    def score_file(self, input_file, output_file):
+        if self.score_file_fn is not None:
+            self.score_file_fn(self.model, input_file, output_file)
+            return
+
+        with open(input_file, newline='') as fin, open(output_file, 'w', newline='') as fout:
+            for chunk in self.score_csv_stream(fin):
+                fout.write(chunk)
+
+    def score_csv_stream(self, text_stream):
+        # generator of scored csv text, one chunk per block of rows. Memory stays flat however big the input is.
+        reader = csv.reader(text_stream)
+        header = next(reader, None)
+        if header is None:
+            return
+        output_names = None
+        block = []
+        for row in reader:
+            block.append(dict(zip(header, [typed_value(v) for v in row])))
+            if len(block) >= self.block_rows:
+                chunk, output_names = self._format_block(header, output_names, block)
+                yield chunk
+                block = []
+        if block or output_names is None:
+            chunk, output_names = self._format_block(header, output_names, block)
+            yield chunk
+
+    def score_arrow_file(self, input_file, input_format, output_file, output_format):
+        # Parquet/Arrow on either side. score_records gets each block as python values of the column types (ints
+        # stay ints). Input columns keep their types; output column types come from the first scored block.
+        schema, batches = open_record_batches(input_file, input_format, self.block_rows)
+        output_types = None
+        writer = None
+        try:
+            for batch in batches:
+                records = batch.to_pylist()
+                outputs = self.score_records(records) if records else []
+                if output_types is None:
+                    output_types = {name: pyarrow.array([output.get(name) for output in outputs]).type
+                                    for name in (outputs[0].keys() if outputs else [])}
+                table = self._merge_block(batch, outputs, output_types)
+                if writer is None:
+                    writer = open_table_writer(output_file, output_format, table.schema)
+                writer.write_table(table)
+            if writer is None:
+                # no rows at all. Still leave a file with the input columns.
+                writer = open_table_writer(output_file, output_format, schema)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _merge_block(self, batch, outputs, output_types):
+        # input columns first, then output columns, like the csv output. Outputs named like an input column replace it.
+        names = list(batch.schema.names) + [name for name in output_types if name not in batch.schema.names]
+        columns = []
+        for name in names:
+            if name in output_types:
+                columns.append(pyarrow.array([output.get(name) for output in outputs], type=output_types[name]))
+            else:
+                columns.append(batch.column(name))
+        return pyarrow.Table.from_arrays(columns, names=names)
+
+    def _format_block(self, header, output_names, block):
+        outputs = self.score_records(block) if block else []
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator='\n')
+        if output_names is None:
+            # output columns are known after the first block. Input columns come first as with the score scripts.
+            output_names = [name for name in (outputs[0].keys() if outputs else []) if name not in header]
+            writer.writerow(header + output_names)
+        for record, output in zip(block, outputs):
+            merged = dict(record)
+            merged.update(output)
+            writer.writerow(['' if merged.get(name) is None else merged.get(name) for name in header + output_names])
+        return text.getvalue(), output_names
+
+
+# scoring_mode: auto (default) imports the score module in-process and falls back to a python subprocess per request
+# if it cannot be imported; inprocess fails startup instead of falling back; subprocess keeps the old behaviour.
+scoring_mode = os.environ.get('scoring_mode', 'auto')
+score_block_rows = int(os.environ.get('score_block_rows', 10000))
+# dedup_rows=true scores each distinct feature vector of a block once (in-process scoring with score_records only).
+# dedup_memo_file names a sqlite file that keeps outputs across jobs per model version; put it on a volume to keep it
+# across pods.
+dedup_rows = os.environ.get('dedup_rows', 'false') == 'true'
+dedup_memo_file = os.environ.get('dedup_memo_file') or None
+
+current_dir = os.getcwd()
+os.chdir(subfolder)
+score_file_name = find_score_file()
+model_file_name = find_model_file()
+os.chdir(current_dir)
+
+scorer = None
+if scoring_mode != 'subprocess':
+    # score code may open files relative to the model folder while loading
+    os.chdir(subfolder)
+    sys.path.insert(0, subfolder)
+    try:
+        model_path = os.path.join(subfolder, model_file_name) if model_file_name is not None else None
+        deduplicator = None
+        if dedup_rows:
+            deduplicator = RowDeduplicator(find_input_variables('inputVar.json'), dedup_memo_file,
+                                           model_zip_checksum)
+            app.logger.info("Row deduplication on. Memo file: " + str(dedup_memo_file))
+        scorer = InProcessScorer(score_file_name, model_path, score_block_rows, deduplicator)
+        app.logger.info("In-process scoring with " + score_file_name)
+    except (Exception, SystemExit):
+        # score code that parses its command line when imported exits with SystemExit; run it as a subprocess
+        if scoring_mode == 'inprocess':
+            raise
+        app.logger.info("Can't score in-process with " + score_file_name + ". Using subprocess mode.\n" + traceback.format_exc())
+    finally:
+        os.chdir(current_dir)
+
+print("Completed Initialization!")
+
+
+test_id_lock = threading.Lock()
+last_test_id = [0.0]
+
+
+# test_id based on current timestamp. Made unique since jobs now come in concurrently.
+def new_test_id():
+    with test_id_lock:
+        timestamp = max(time.time(), last_test_id[0] + 0.000001)
+        last_test_id[0] = timestamp
+    return '%.6f' % timestamp
+
+
+# return (test_id, succeeded)
+# the result file will be <test_id>.csv (or .parquet/.arrow for those output formats). None when scoring failed.
+def score(filename, test_id=None, remove_input=False, output_format='csv'):
+    app.logger.debug(filename)
+
+    if test_id is None:
+        test_id = new_test_id()
+    input_format = file_format(filename)
+    output_file = test_id + output_extensions[output_format]
+    # score into a temporary name. /query must not hand out a file that is still being written.
+    inprogress_file = test_id + '.inprogress' + output_extensions[output_format]
+    log_file = test_id + '.log'
+    app.logger.debug(output_file)
+    if os.path.isfile(filename):
+        metrics.inc('scoring_input_bytes_total', os.path.getsize(filename))
+
+    if input_format == 'csv' and output_format == 'csv':
+        if scorer is not None:
+            succeeded = score_inprocess(filename, inprogress_file, log_file)
+        else:
+            succeeded = score_subprocess(filename, inprogress_file, log_file)
+    elif scorer is not None and scorer.can_score_records():
+        succeeded = score_inprocess(filename, inprogress_file, log_file, input_format, output_format)
+    else:
+        succeeded = score_converted(filename, input_format, inprogress_file, output_format, log_file)
+
+    # scoring scripts may report errors only in the log. No output file is a failure too.
+    succeeded = succeeded and os.path.isfile(os.path.join(subfolder, inprogress_file))
+    if succeeded:
+        metrics.inc('scoring_output_bytes_total', os.path.getsize(os.path.join(subfolder, inprogress_file)))
+        os.replace(os.path.join(subfolder, inprogress_file), os.path.join(subfolder, output_file))
+    else:
+        remove_partial_output(inprogress_file)
+    if remove_input and os.path.isfile(filename):
+        os.remove(filename)
+
+    return test_id, succeeded
+
+
+def remove_partial_output(output_file):
+    # what a failed scoring run left behind must never be served as a result
+    if os.path.isfile(os.path.join(subfolder, output_file)):
+        os.remove(os.path.join(subfolder, output_file))
+
+
+def score_converted(filename, input_format, output_file, output_format, log_file):
+    # score code that only reads and writes csv (score_file or subprocess). Convert on the way in and out.
+    # True when output_file is complete.
+    csv_input = filename if input_format == 'csv' else filename + '.converted.csv'
+    csv_output = output_file if output_format == 'csv' else output_file + '.scored.csv'
+    succeeded = False
+    try:
+        if input_format != 'csv':
+            convert_file_format(filename, input_format, csv_input, 'csv')
+        if scorer is not None:
+            succeeded = score_inprocess(csv_input, csv_output, log_file)
+        else:
+            succeeded = score_subprocess(csv_input, csv_output, log_file)
+        if succeeded and output_format != 'csv':
+            convert_file_format(os.path.join(subfolder, csv_output), 'csv', os.path.join(subfolder, output_file), output_format)
+    except Exception:
+        succeeded = False
+        app.logger.info("Format conversion failed for " + filename)
+        with open(os.path.join(subfolder, log_file), "a") as f:
+            f.write(traceback.format_exc())
+    finally:
+        for converted_file in (csv_input if csv_input != filename else None,
+                               os.path.join(subfolder, csv_output) if csv_output != output_file else None):
+            if converted_file is not None and os.path.isfile(converted_file):
+                os.remove(converted_file)
+    if not succeeded:
+        remove_partial_output(output_file)
+    return succeeded
+
+
+def score_inprocess(filename, output_file, log_file, input_format='csv', output_format='csv'):
+    full_log_file = os.path.join(subfolder, log_file)
+    with open(full_log_file, "w+") as f:
+        f.write("Scoring...\n")
+        f.write(" in-process " + score_file_name + " -i " + filename + " -o " + output_file + "\n")
+
+    # True when output_file is complete. On failure the partly written output is removed.
+    succeeded = False
+    try:
+        if input_format == 'csv' and output_format == 'csv':
+            scorer.score_file(filename, os.path.join(subfolder, output_file))
+        else:
+            scorer.score_arrow_file(filename, input_format, os.path.join(subfolder, output_file), output_format)
+        succeeded = True
+    except Exception:
+        app.logger.info("In-process scoring failed for " + filename)
+        with open(full_log_file, "a") as f:
+            f.write(traceback.format_exc())
+        remove_partial_output(output_file)
+
+    with open(full_log_file, "a") as f:
+        f.write("\nCompleted!\n" if succeeded else "\nFailed!\n")
+    return succeeded
+
+
+def score_subprocess(filename, output_file, log_file):
+    full_log_file = os.path.join(subfolder, log_file)
+
+    model_param = ''
+    if model_file_name is not None:
+        model_param = ' -m ' + model_file_name
+
+    command_str = 'python -W ignore ' + score_file_name + model_param + ' -i ' + filename+' -o ' + output_file 
+
+    f = open(full_log_file,"w+")
+    f.write("Scoring...\n")
+    f.write(" "+command_str+"\n")
+    f.close()
+
+    command_str = command_str + ' >> '+log_file + ' 2>&1'
+
+    app.logger.info(command_str)
+    # run from the model folder. No os.chdir as jobs run on several worker threads.
+    # True when the script exited 0 and wrote output_file; what a failing script wrote is removed.
+    succeeded = subprocess.call(command_str, shell=True, cwd=subfolder) == 0 and \
+        os.path.isfile(os.path.join(subfolder, output_file))
+    if not succeeded:
+        remove_partial_output(output_file)
+
+    f = open(full_log_file,"a")
+    f.write("\nCompleted!\n" if succeeded else "\nFailed!\n")
+    f.close()
+    return succeeded
+
+
+def score_job(test_id, input_file, remove_input, output_format='csv'):
+    test_id, succeeded = score(input_file, test_id=test_id, remove_input=remove_input, output_format=output_format)
+    return succeeded
+
+
+class MultipartFileBody(object):
+    """
+    multipart/form-data body of a presigned S3 POST: the policy fields, then the file. read() streams the file
+    from disk, so a multi-GB output never sits in memory, and len() gives the Content-Length S3 insists on
+    (it does not take chunked POST uploads).
+    """
+
+    def __init__(self, fields, filename, file):
+        boundary = uuid.uuid4().hex
+        head = ''.join('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value)
+                       for name, value in fields.items())
+        head += '--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n' \
+                'Content-Type: application/octet-stream\r\n\r\n' % (boundary, filename)
+        tail = '\r\n--%s--\r\n' % boundary
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        self.length = len(head.encode('utf-8')) + os.fstat(file.fileno()).st_size + len(tail)
+        self.parts = [io.BytesIO(head.encode('utf-8')), file, io.BytesIO(tail.encode('utf-8'))]
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = b''
+        while self.parts and (size < 0 or len(data) < size):
+            chunk = self.parts[0].read(size - len(data) if size >= 0 else -1)
+            if not chunk:
+                self.parts.pop(0)
+            data += chunk
+        return data
+
+
+def remove_job_files(test_id):
+    # <test_id>.* the job left in subfolder: output, log and what scoring wrote next to them
+    for name in os.listdir(subfolder):
+        if name.startswith(test_id + '.'):
+            os.remove(os.path.join(subfolder, name))
+
+
+def score_s3_job(test_id, input_url, output_post, input_file, output_format='csv'):
+    # pod-side S3 I/O. Fetch input from a presigned GET, score, push output to a presigned POST.
+    # The caller only coordinates and no scoring bytes go through it.
+    full_log_file = os.path.join(subfolder, test_id + '.log')
+    try:
+        r = requests.get(input_url, stream=True, timeout=60)
+        r.raise_for_status()
+        with open(input_file, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+    except Exception:
+        with open(full_log_file, "w+") as f:
+            f.write("Downloading input failed\n" + traceback.format_exc())
+        if os.path.isfile(input_file):
+            os.remove(input_file)
+        return False
+
+    if not score_job(test_id, input_file, True, output_format):
+        return False
+
+    try:
+        output_file = find_output_file(test_id)
+        with open(os.path.join(subfolder, output_file), 'rb') as f:
+            body = MultipartFileBody(output_post['fields'], output_file, f)
+            r = requests.post(output_post['url'], data=body, headers={'Content-Type': body.content_type}, timeout=60)
+        r.raise_for_status()
+    except Exception:
+        with open(full_log_file, "a") as f:
+            f.write("Uploading output failed\n" + traceback.format_exc())
+        return False
+
+    # the result is in S3 now. Nothing of the job needs the pod's disk any more.
+    remove_job_files(test_id)
+    return True
+
+
+class ScoringJobQueue(object):
+    """
+    Bounded queue of scoring jobs run by a fixed pool of worker threads.
+    /executions enqueues and returns the job id right away; clients follow the job on /status/<test_id>
+    and fetch the result from /query/<test_id>.
+    Job states: queued -> running -> succeeded | failed
+    """
+
+    # finished jobs are forgotten after this many secs. /status then works it out from the files on disk.
+    status_retention = 3600
+
+    def __init__(self, workers, depth):
+        self.jobs = queue.Queue(maxsize=depth)
+        self.status = {}
+        self.status_changed = threading.Condition()
+        self.active = 0
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name='scoring-worker-' + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, test_id, job):
+        # job() runs on a worker thread and returns True when it succeeded.
+        # False when the queue is full. Caller tells the client to come back later.
+        self._set_status(test_id, 'queued')
+        try:
+            self.jobs.put_nowait((test_id, job))
+            return True
+        except queue.Full:
+            with self.status_changed:
+                del self.status[test_id]
+            return False
+
+    def depth(self):
+        return self.jobs.qsize()
+
+    def running(self):
+        with self.status_changed:
+            return self.active
+
+    def get_status(self, test_id):
+        with self.status_changed:
+            job_status = self.status.get(test_id)
+            if job_status is not None:
+                return dict(job_status)
+        return self._status_from_files(test_id)
+
+    def wait_for_change(self, test_id, known_state, timeout):
+        # long-poll. Return as soon as the job leaves known_state or timeout secs have passed.
+        deadline = time.time() + timeout
+        job_status = self.get_status(test_id)
+        while job_status is not None and job_status['status'] == known_state and time.time() < deadline:
+            with self.status_changed:
+                self.status_changed.wait(min(deadline - time.time(), 1.0))
+            job_status = self.get_status(test_id)
+        return job_status
+
+    def _status_from_files(self, test_id):
+        # jobs this process does not know about (forgotten, or from before a restart)
+        if find_output_file(test_id) is not None:
+            return {'id': test_id, 'status': 'succeeded'}
+        if os.path.isfile(os.path.join(subfolder, test_id + '.log')):
+            if find_output_file(test_id + '.inprogress') is not None:
+                return {'id': test_id, 'status': 'running'}
+            return {'id': test_id, 'status': 'failed'}
+        return None
+
+    def _set_status(self, test_id, state):
+        with self.status_changed:
+            job_status = self.status.setdefault(test_id, {'id': test_id})
+            job_status['status'] = state
+            job_status[state] = time.time()
+            self.status_changed.notify_all()
+
+    def _forget_finished_jobs(self):
+        cutoff = time.time() - self.status_retention
+        with self.status_changed:
+            for test_id in [k for k, v in self.status.items() if v.get('succeeded', v.get('failed', time.time())) < cutoff]:
+                del self.status[test_id]
+
+    def _worker(self):
+        while True:
+            test_id, job = self.jobs.get()
+            self._set_status(test_id, 'running')
+            with self.status_changed:
+                self.active += 1
+            started = time.time()
+            succeeded = False
+            try:
+                succeeded = job()
+            except Exception:
+                app.logger.info("Scoring job " + test_id + " failed\n" + traceback.format_exc())
+            finally:
+                with self.status_changed:
+                    self.active -= 1
+                metrics.observe('scoring_job_duration_seconds', time.time() - started,
+                                outcome='succeeded' if succeeded else 'failed')
+                if not succeeded:
+                    metrics.inc('scoring_errors_total', kind='job')
+                self._set_status(test_id, 'succeeded' if succeeded else 'failed')
+                self._forget_finished_jobs()
+                self.jobs.task_done()
+
+
+# worker threads scoring jobs in this container and how many jobs may wait for a free worker.
+# A full queue answers 429 with Retry-After of scoring_retry_after secs.
+# The workers are threads of the one gunicorn process. They score in parallel in subprocess mode (each job is its
+# own python process) and while in-process score code sits in numpy/pandas/native model calls that release the
+# GIL. Pure python score_records code scores one job at a time whatever scoring_workers is; extra workers then
+# only keep short jobs from waiting behind a long one. For CPU parallelism with such models run more replicas
+# (or scoring_mode=subprocess).
+scoring_workers = int(os.environ.get('scoring_workers', os.cpu_count() or 1))
+scoring_queue_depth = int(os.environ.get('scoring_queue_depth', 16))
+scoring_retry_after = int(os.environ.get('scoring_retry_after', 5))
+job_queue = ScoringJobQueue(scoring_workers, scoring_queue_depth)
+
+
+class RequestThreadBudget(object):
+    """
+    Request threads that long-held requests (/status long-polls, both halves of a streaming session) may
+    occupy. The rest stay free for /ready, /score, /query and uploads whatever clients do.
+    """
+
+    def __init__(self, threads):
+        self.free = threads
+        self.lock = threading.Lock()
+
+    def try_acquire(self, threads=1):
+        with self.lock:
+            if self.free < threads:
+                return False
+            self.free -= threads
+            return True
+
+    def release(self, threads=1):
+        with self.lock:
+            self.free += threads
+
+
+# gunicorn serves requests with GUNICORN_THREADS threads (startServer.sh). reserved_request_threads of them
+# never wait on a long-poll or a stream.
+request_threads = int(os.environ.get('GUNICORN_THREADS', 8))
+reserved_request_threads = int(os.environ.get('reserved_request_threads', 3))
+long_request_budget = RequestThreadBudget(max(request_threads - reserved_request_threads, 0))
+
+
+# Compressed transfer. Uploads to /executions may carry a gzip/zstd compressed file (part content type
+# application/gzip or application/zstd), stream uploads a Content-Encoding header. Either is decompressed while it is
+# written. /query results are compressed on the fly when the client's Accept-Encoding allows it.
+# The ping response lists what we decode so clients know compressing is safe with this image.
+transfer_encodings = (['zstd'] if zstandard is not None else []) + ['gzip']
+upload_encoding_mimetypes = {'application/gzip': 'gzip', 'application/x-gzip': 'gzip', 'application/zstd': 'zstd'}
+transfer_compress_level = int(os.environ.get('transfer_compress_level', 6))
+transfer_chunk_size = 1024 * 1024
+
+
+def decompressing_reader(stream, encoding):
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    return stream
+
+
+def compressed_chunks(chunks, encoding):
+    if encoding == 'gzip':
+        # wbits 31 = gzip framing, what Content-Encoding: gzip means
+        compressor = zlib.compressobj(transfer_compress_level, zlib.DEFLATED, 31)
+    else:
+        compressor = zstandard.ZstdCompressor(level=min(transfer_compress_level, 22)).compressobj()
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def file_chunks(file_name):
+    with open(file_name, 'rb') as f:
+        while True:
+            chunk = f.read(transfer_chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def response_encoding():
+    # best encoding both sides have, None for plain
+    return request.accept_encodings.best_match(transfer_encodings)
+
+
+def requested_output_format(requested, input_file_name):
+    # (output_format, error). Default is the input's own format.
+    output_format = requested or file_format(input_file_name)
+    if output_format not in scoring_formats:
+        return None, "Output format " + output_format + " is not supported by this image (" + ', '.join(scoring_formats) + ")."
+    if file_format(input_file_name) not in scoring_formats:
+        return None, "Input format " + file_format(input_file_name) + " needs pyarrow in this image."
+    return output_format, None
+
+
+# warmup=true (default) scores sample.csv once in the background at startup, so imports, model load and first call
+# costs are paid before the first real file. / answers right away (liveness); /ready only once warmup succeeded
+# and is what the deployments use as readiness probe. Without sample.csv there is nothing to warm up with.
+warmup_enabled = os.environ.get('warmup', 'true') == 'true'
+readiness = {'status': 'warming_up'}
+
+
+def warmup():
+    sample_file = os.path.join(subfolder, 'sample.csv')
+    if not warmup_enabled or not os.path.isfile(sample_file):
+        readiness['status'] = 'ready'
+        return
+    start = time.time()
+    output_file = '.warmup.csv'
+    if scorer is not None:
+        succeeded = score_inprocess(sample_file, output_file, '.warmup.log')
+    else:
+        succeeded = score_subprocess(sample_file, output_file, '.warmup.log')
+    # warmup output is thrown away either way
+    remove_partial_output(output_file)
+    if succeeded:
+        app.logger.info("Warmup done in " + str(round(time.time() - start, 2)) + " secs")
+        readiness['status'] = 'ready'
+    else:
+        app.logger.info("Warmup scoring of sample.csv failed. See " + os.path.join(subfolder, '.warmup.log'))
+        readiness['status'] = 'warmup_failed'
+
+
+threading.Thread(target=warmup, daemon=True).start()
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    readiness: 200 once warmup scored sample.csv, 503 while it runs or after it failed
+    """
+    if readiness['status'] == 'ready':
+        return jsonify({'status': 'ready'})
+    resp = jsonify({'status': readiness['status']})
+    resp.status_code = 503
+    return resp
+
+
+@app.route('/', methods=['GET'])
+def ping():
+    resp = return_text("pong")
+    resp.headers['X-Upload-Encodings'] = ', '.join(transfer_encodings)
+    resp.headers['X-Scoring-Formats'] = ', '.join(scoring_formats)
+    return resp
+
+
+# Real-time scoring. /score takes one JSON record (object) or a small array of them and returns the scores inline, from
+# the model loaded at startup. No files, no job queue and no /query round trip. Needs in-process scoring with
+# score_records; dedup_rows applies as for files. score_max_records caps the array so a big batch cannot hold a
+# request thread for long - files go through /executions.
+score_max_records = int(os.environ.get('score_max_records', 1000))
+
+
+class MicroBatcher(object):
+    """
+    Scores /score requests that arrive together as one score_records call, so per call overhead (python dispatch,
+    dataframe construction, model predict setup) is paid once per batch instead of once per row.
+    A single worker thread takes the first waiting request and adds more until max_rows rows. It only waits for more,
+    at most window secs, while requests keep coming in concurrently (the last batch had more than one), so a lone
+    caller never pays the window. Each caller gets its own slice of the outputs back.
+    """
+
+    # upper bounds of the achieved batch size (rows) histogram
+    batch_rows_buckets = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, float('inf')]
+
+    def __init__(self, score_fn, max_rows, window):
+        self.score_fn = score_fn
+        self.max_rows = max_rows
+        self.window = window
+        self.pending = queue.Queue()
+        self.carry = None
+        self.concurrent = False
+
+        self.stats_lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.rows = 0
+        self.wait_seconds = 0.0
+        self.batch_rows_counts = [0] * len(self.batch_rows_buckets)
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def score_records(self, records):
+        # blocks until the batch holding these records is scored. Raises what scoring them raised.
+        item = {'records': records, 'submitted': time.time(), 'done': threading.Event(), 'outputs': None, 'error': None}
+        self.pending.put(item)
+        item['done'].wait()
+        if item['error'] is not None:
+            raise item['error']
+        return item['outputs']
+
+    def stats(self):
+        with self.stats_lock:
+            return {'batches': self.batches, 'requests': self.requests, 'rows': self.rows,
+                    'wait_seconds': self.wait_seconds,
+                    'batch_rows_buckets': list(zip(self.batch_rows_buckets, self.batch_rows_counts))}
+
+    def _next_item(self, deadline):
+        if self.carry is not None:
+            item, self.carry = self.carry, None
+            return item
+        if deadline is None:
+            return self.pending.get_nowait()
+        return self.pending.get(timeout=max(0.0, deadline - time.time()))
+
+    def _collect(self):
+        if self.carry is not None:
+            batch, self.carry = [self.carry], None
+        else:
+            batch = [self.pending.get()]
+        rows = len(batch[0]['records'])
+        deadline = time.time() + self.window if self.concurrent and self.window > 0 else None
+        while rows < self.max_rows:
+            try:
+                item = self._next_item(deadline)
+            except queue.Empty:
+                break
+            if rows + len(item['records']) > self.max_rows:
+                # goes first into the next batch
+                self.carry = item
+                break
+            batch.append(item)
+            rows += len(item['records'])
+        return batch, rows
+
+    def _worker(self):
+        while True:
+            batch, rows = self._collect()
+            self.concurrent = len(batch) > 1 or self.carry is not None or not self.pending.empty()
+            started = time.time()
+            self._score_batch(batch)
+            with self.stats_lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.rows += rows
+                self.wait_seconds += sum(started - item['submitted'] for item in batch)
+                for bucket, upper in enumerate(self.batch_rows_buckets):
+                    if rows <= upper:
+                        self.batch_rows_counts[bucket] += 1
+                        break
+            for item in batch:
+                item['done'].set()
+
+    def _score_batch(self, batch):
+        try:
+            outputs = self.score_fn([record for item in batch for record in item['records']])
+            offset = 0
+            for item in batch:
+                item['outputs'] = outputs[offset:offset + len(item['records'])]
+                offset += len(item['records'])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0]['error'] = e
+                return
+            # one bad record must not fail the other callers. Score them one by one to find out whose it is.
+            for item in batch:
+                self._score_batch([item])
+
+
+# microbatch_max_rows: rows scored together at most, 1 scores every request on its own thread as before.
+# microbatch_window_ms: how long a batch waits for more requests under concurrent load. Larger windows give bigger
+# batches (throughput) at the cost of up to that much added latency per request.
+microbatch_max_rows = int(os.environ.get('microbatch_max_rows', 64))
+microbatch_window_ms = float(os.environ.get('microbatch_window_ms', 2))
+micro_batcher = None
+if scorer is not None and scorer.can_score_records() and microbatch_max_rows > 1:
+    micro_batcher = MicroBatcher(scorer.score_records, microbatch_max_rows, microbatch_window_ms / 1000.0)
+
+
+def json_scalar(value):
+    # numpy scalars (and anything else json can't encode) as returned by score code
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+@app.route('/score', methods=['POST'])
+def score_realtime():
+    """
+    one record:   {"LOAN": 1100, "VALUE": 39025, ...}        -> {"EM_CLASSIFICATION": "1", ...}
+    small batch:  [{"LOAN": 1100, ...}, {"LOAN": 1300, ...}] -> [{...}, {...}], in the same order
+    """
+    if scorer is None or not scorer.can_score_records():
+        resp = jsonify({'status': 501, 'message': 'Real-time scoring needs in-process scoring with score_records in ' +
+                        str(score_file_name) + '. Use /executions.'})
+        resp.status_code = 501
+        return resp
+
+    started = time.time()
+    payload = request.get_json(silent=True)
+    records = [payload] if isinstance(payload, dict) else payload
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        return bad_request("Expected a JSON object or an array of objects.")
+    if len(records) > score_max_records:
+        return bad_request(str(len(records)) + " records. At most " + str(score_max_records) + " per request; use /executions for files.")
+
+    try:
+        outputs = (micro_batcher or scorer).score_records(records) if records else []
+    except Exception:
+        app.logger.info("Real-time scoring failed.\n" + traceback.format_exc())
+        metrics.inc('scoring_errors_total', kind='realtime')
+        resp = jsonify({'status': 500, 'message': 'Scoring failed: ' + traceback.format_exc(limit=1)})
+        resp.status_code = 500
+        return resp
+    result = json.dumps(outputs[0] if isinstance(payload, dict) else outputs, default=json_scalar)
+    metrics.inc('scoring_input_bytes_total', request.content_length or 0)
+    metrics.inc('scoring_output_bytes_total', len(result))
+    metrics.observe('scoring_realtime_duration_seconds', time.time() - started)
+    return Response(result, status=200, mimetype='application/json')
+
+
+@app.route('/score/stats', methods=['GET'])
+def score_stats():
+    """
+    achieved micro-batch sizes: batches, requests, rows, summed queue wait and batch rows histogram (upper bound, count)
+    """
+    if micro_batcher is None:
+        return jsonify({'microbatch': False})
+    stats = micro_batcher.stats()
+    stats['batch_rows_buckets'] = [['+Inf' if upper == float('inf') else upper, count]
+                                   for upper, count in stats['batch_rows_buckets']]
+    return jsonify(dict(stats, microbatch=True, max_rows=microbatch_max_rows, window_ms=microbatch_window_ms))
+
+
+def process_rss_bytes():
+    # resident set size from /proc (linux, as in the scoring images). None elsewhere.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def gauge_lines(name, help_text, value, metric_type='gauge'):
+    if value is None:
+        return []
+    return ['# HELP ' + name + ' ' + help_text, '# TYPE ' + name + ' ' + metric_type, name + ' ' + str(value)]
+
+
+def metrics_text():
+    lines = metrics.text()
+    lines += gauge_lines('scoring_queue_depth', 'Scoring jobs waiting for a worker.', job_queue.depth())
+    lines += gauge_lines('scoring_active_jobs', 'Scoring jobs running now.', job_queue.running())
+    lines += gauge_lines('scoring_workers', 'Worker threads for scoring jobs.', scoring_workers)
+    lines += gauge_lines('scoring_ready', '1 once warmup succeeded (/ready answers 200).', int(readiness['status'] == 'ready'))
+    lines += gauge_lines('process_resident_memory_bytes', 'Resident memory size in bytes.', process_rss_bytes())
+    if scorer is not None and scorer.deduplicator is not None:
+        with scorer.deduplicator.stats_lock:
+            rows_seen, rows_scored = scorer.deduplicator.rows_seen, scorer.deduplicator.rows_scored
+        lines += gauge_lines('scoring_dedup_rows_seen_total', 'Rows that went through row deduplication.', rows_seen, 'counter')
+        lines += gauge_lines('scoring_dedup_rows_scored_total', 'Rows score code actually scored after deduplication.', rows_scored, 'counter')
+    if micro_batcher is not None:
+        stats = micro_batcher.stats()
+        lines += gauge_lines('scoring_microbatch_requests_total', '/score requests scored through micro-batches.', stats['requests'], 'counter')
+        lines += gauge_lines('scoring_microbatch_wait_seconds_total', 'Time /score requests waited for their micro-batch.', stats['wait_seconds'], 'counter')
+        lines += ['# HELP scoring_microbatch_rows Rows per micro-batch.', '# TYPE scoring_microbatch_rows histogram']
+        lines += histogram_lines('scoring_microbatch_rows', (), [upper for upper, count in stats['batch_rows_buckets']],
+                                 [count for upper, count in stats['batch_rows_buckets']], stats['rows'])
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus text format: job durations, rows, bytes in/out, queue depth, active jobs, errors, RSS, micro-batches
+    """
+    return Response(metrics_text(), status=200, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/executions', methods=['POST'])
+def batch():
+    """
+ * Accept input data in csv file and store it to subdirectory <model repo dir>/<job definition id>
+ * Try sample.csv if there's no input data file;
+ * execute the python program (under the anaconda environment)
+ * extract score filename from fileMetadata.json if any, otherwise assume the first python script ending with 'score.py'. Default script is _score.py
+ * execution
+   - cd <model repo dir>/<job definition id>
+   - python score.py -i <inputdata.csv> -o <timestamp>.csv
+   - or, in in-process mode, call the score module loaded at startup (see InProcessScorer)
+ * scoring runs on a worker thread. Return the job id right away; clients follow it on /status/<test_id>
+ * return 429 with Retry-After when scoring_queue_depth jobs are already waiting
+ * the file may come gzip or zstd compressed (part content type application/gzip or application/zstd)
+ * csv, parquet (.parquet/.pq) or Arrow IPC (.arrow/.feather/.ipc) input by file extension. Form field output_format
+   (csv, parquet or arrow) picks the result format, default the input's. Needs pyarrow for anything but csv
+ * a few records scored synchronously go to POST /score instead
+    """
+    test_id = new_test_id()
+    file = request.files.get('file')
+    if file is not None:
+        # prefix with test_id. Queued jobs keep their input around and clients often send the same file name.
+        input_file_name = test_id + '_' + secure_filename(file.filename)
+        input_file = os.path.join(subfolder, input_file_name)
+        encoding = upload_encoding_mimetypes.get(file.mimetype)
+        if encoding not in transfer_encodings + [None]:
+            return bad_request("Upload encoding " + encoding + " is not supported by this image.")
+        try:
+            with open(input_file, 'wb') as f:
+                shutil.copyfileobj(decompressing_reader(file.stream, encoding), f, transfer_chunk_size)
+        except Exception:
+            app.logger.info("Upload " + input_file_name + " could not be saved\n" + traceback.format_exc())
+            if os.path.isfile(input_file):
+                os.remove(input_file)
+            return bad_request("Upload could not be read or decompressed.")
+        remove_input = True
+    else:
+        input_file_name = 'sample.csv'
+        input_file = os.path.join(subfolder, input_file_name)
+        if not os.path.isfile(input_file):
+            return bad_request("Can't find sample.csv in the model zip file!")
+        remove_input = False
+
+    output_format, error = requested_output_format(request.form.get('output_format'), input_file_name)
+    if error is not None:
+        if remove_input:
+            os.remove(input_file)
+        return bad_request(error)
+
+    if not job_queue.submit(test_id, lambda: score_job(test_id, input_file, remove_input, output_format)):
+        if remove_input:
+            os.remove(input_file)
+        return too_many_requests("Scoring queue is full (" + str(scoring_queue_depth) + " jobs). Retry later.")
+    return created_request(test_id)
+
+
+@app.route('/executions/s3', methods=['POST'])
+def batch_s3():
+    """
+ * JSON body {"input_url": <presigned GET>, "output_post": {"url": ..., "fields": {...}}, "filename": <optional>,
+   "output_format": <optional, csv|parquet|arrow>}. filename extension gives the input format
+ * the job fetches the input itself, scores it and uploads the scored output with the presigned POST
+ * job only succeeds once the upload did, so /status/<test_id> covers the whole transfer
+ * return the job id right away, 429 when the queue is full
+    """
+    if requests is None:
+        return bad_request("requests package is not installed in this image. Use /executions.")
+    body = request.get_json(silent=True)
+    if body is None or 'input_url' not in body or 'output_post' not in body:
+        return bad_request("Expected JSON with input_url and output_post.")
+
+    input_file_name = secure_filename(body.get('filename', 'input.csv'))
+    output_format, error = requested_output_format(body.get('output_format'), input_file_name)
+    if error is not None:
+        return bad_request(error)
+
+    test_id = new_test_id()
+    input_file = os.path.join(subfolder, test_id + '_' + input_file_name)
+    if not job_queue.submit(test_id, lambda: score_s3_job(test_id, body['input_url'], body['output_post'], input_file,
+                                                          output_format)):
+        return too_many_requests("Scoring queue is full (" + str(scoring_queue_depth) + " jobs). Retry later.")
+    return created_request(test_id)
+
+
+class StreamingScoringSession(object):
+    """
+    One streaming scoring job. PUT /executions/stream/<id> feeds the request body through score_csv_stream
+    and GET /query/<id>/stream drains the scored chunks as they come. The bounded buffer in between applies
+    back pressure so neither memory nor disk grows with the size of the file.
+    """
+
+    def __init__(self, test_id, buffer_blocks, stall_timeout):
+        self.test_id = test_id
+        self.chunks = queue.Queue(maxsize=buffer_blocks)
+        self.stall_timeout = stall_timeout
+        self.created = time.time()
+
+    def feed(self, text_stream):
+        # runs in the PUT request. A reader that went away shows up as a full buffer that never drains.
+        try:
+            for chunk in scorer.score_csv_stream(text_stream):
+                self.chunks.put(chunk, timeout=self.stall_timeout)
+        except Exception:
+            app.logger.info("Streaming scoring " + self.test_id + " failed\n" + traceback.format_exc())
+            metrics.inc('scoring_errors_total', kind='stream')
+            self._close(False)
+            raise
+        self._close(True)
+
+    def drain(self):
+        # runs in the GET request. Ends on the marker feed() leaves behind. A failed or stalled job raises, which
+        # aborts the chunked response: the reader sees a broken transfer, never a complete looking truncated file.
+        while True:
+            try:
+                chunk = self.chunks.get(timeout=self.stall_timeout)
+            except queue.Empty:
+                app.logger.info("Streaming scoring " + self.test_id + " stalled. No input for " + str(self.stall_timeout) + " secs")
+                raise RuntimeError("Streaming scoring " + self.test_id + " stalled")
+            if chunk is None:
+                return
+            if chunk is False:
+                raise RuntimeError("Streaming scoring " + self.test_id + " failed")
+            metrics.inc('scoring_output_bytes_total', len(chunk))
+            yield chunk
+
+    def _close(self, succeeded):
+        try:
+            self.chunks.put(None if succeeded else False, timeout=self.stall_timeout)
+        except queue.Full:
+            pass
+
+
+# rows per scored block come from score_block_rows. stream_buffer_blocks blocks may wait for the reader.
+stream_buffer_blocks = int(os.environ.get('stream_buffer_blocks', 4))
+stream_stall_timeout = int(os.environ.get('stream_stall_timeout', 300))
+streaming_sessions = {}
+streaming_sessions_lock = threading.Lock()
+
+
+@app.route('/executions/stream', methods=['POST'])
+def stream_open():
+    """
+    open a streaming scoring job and return its id. Then, concurrently,
+    * PUT /executions/stream/<id> with the csv as request body (chunked transfer is fine)
+    * GET /query/<id>/stream to read scored rows while the input is still uploading
+    Both calls have to reach the same pod (ingress cookie). Needs in-process scoring with score_records.
+    """
+    if scorer is None or not scorer.can_score_records():
+        return bad_request("Streaming needs in-process scoring with a score_records entry point.")
+
+    # sessions a client never used would pile up otherwise
+    with streaming_sessions_lock:
+        stale_ids = [k for k, v in streaming_sessions.items() if time.time() - v.created > stream_stall_timeout]
+    for stale_id in stale_ids:
+        close_streaming_session(stale_id)
+
+    # the upload and the download each hold a request thread until the session ends
+    if not long_request_budget.try_acquire(2):
+        return too_many_requests("No request threads left for another streaming session.")
+    test_id = new_test_id()
+    with streaming_sessions_lock:
+        streaming_sessions[test_id] = StreamingScoringSession(test_id, stream_buffer_blocks, stream_stall_timeout)
+    return created_request(test_id)
+
+
+def close_streaming_session(test_id):
+    with streaming_sessions_lock:
+        session = streaming_sessions.pop(test_id, None)
+    if session is not None:
+        long_request_budget.release(2)
+
+
+@app.route('/executions/stream/<test_id>', methods=['PUT'])
+def stream_input(test_id):
+    with streaming_sessions_lock:
+        session = streaming_sessions.get(test_id.lower())
+    if session is None:
+        return not_found(test_id)
+
+    encoding = request.headers.get('Content-Encoding')
+    if encoding not in transfer_encodings + [None]:
+        return bad_request("Content-Encoding " + encoding + " is not supported by this image.")
+
+    try:
+        session.feed(io.TextIOWrapper(decompressing_reader(request.stream, encoding), encoding='utf-8', newline=''))
+    except Exception:
+        return bad_request("Streaming scoring failed. See /system/log.")
+    return jsonify({'status': 200, 'id': session.test_id})
+
+
+@app.route('/query/<test_id>/stream', methods=['GET'])
+def stream_output(test_id):
+    with streaming_sessions_lock:
+        session = streaming_sessions.get(test_id.lower())
+    if session is None:
+        return not_found(test_id)
+
+    def generate():
+        try:
+            for chunk in session.drain():
+                yield chunk
+        finally:
+            close_streaming_session(session.test_id)
+
+    encoding = response_encoding()
+    if encoding is None:
+        return Response(generate(), status=200, mimetype='text/csv')
+    return Response(compressed_chunks(generate(), encoding), status=200, mimetype='text/csv',
+                    headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
+
+
+# longest a /status long-poll may hold the connection. Short next to the readiness probe (2s period, 3 failures)
+# and the ingress proxy read timeout (60s on nginx); clients poll again.
+status_max_wait = int(os.environ.get('status_max_wait', 5))
+
+
+@app.route('/status/<test_id>', methods=['GET'])
+def status(test_id):
+    """
+    report job state: queued, running, succeeded or failed
+    * wait=<secs> long-polls until the state changes from the one the client knows (state=<state>,
+      default the state at the time of the call) or wait secs have passed
+    * waited in the reply is false when the call did not long-poll (no request thread to spare, or nothing to
+      wait for). Clients back off before they ask again.
+    """
+    test_id = test_id.lower()
+    try:
+        wait = min(float(request.args.get('wait', 0)), status_max_wait)
+    except ValueError:
+        return bad_request("wait must be a number of seconds")
+
+    job_status = job_queue.get_status(test_id)
+    if job_status is None:
+        return not_found(test_id)
+
+    # no request thread to spare: answer right away, the client polls again
+    waited = False
+    if wait > 0 and job_status['status'] not in ('succeeded', 'failed') and long_request_budget.try_acquire():
+        waited = True
+        try:
+            known_state = request.args.get('state', job_status['status'])
+            job_status = job_queue.wait_for_change(test_id, known_state, wait)
+        finally:
+            long_request_budget.release()
+        if job_status is None:
+            return not_found(test_id)
+
+    job_status['queue_depth'] = job_queue.depth()
+    job_status['waited'] = waited
+    return jsonify(job_status)
+
+
+# /status/<test_id> reports progress. This call retrieves the csv file once the job succeeded
+@app.route('/query/<test_id>', methods=['GET'])
+def query(test_id):
+    """
+    read result file from <test_id>.csv (or .parquet/.arrow) as an attachment
+    """
+    test_id = test_id.lower()
+    if os.path.splitext(test_id)[1] in output_extensions.values():
+        output_file = test_id
+    else:
+        output_file = find_output_file(test_id) or test_id + '.csv'
+
+    full_output_file = os.path.join(subfolder, output_file)
+    if not os.path.isfile(full_output_file):
+        return not_found(full_output_file)
+
+    output_format = file_format(output_file)
+    encoding = response_encoding()
+    # parquet pages are compressed already
+    if encoding is None or output_format == 'parquet':
+        return send_from_directory(subfolder, output_file, as_attachment=True, mimetype=output_mimetypes[output_format])
+    # compressed as it is read. No Content-Length since the compressed size is not known up front.
+    return Response(compressed_chunks(file_chunks(full_output_file), encoding), status=200,
+                    mimetype=output_mimetypes[output_format],
+                    headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding',
+                             'Content-Disposition': 'attachment; filename=' + output_file})
+
+
+# return <test_id>.log
+@app.route('/query/<test_id>/log', methods=['GET'])
+def querylog(test_id):
+    """
+    read log file from <test_id>.log as an attachment
+    """
+    test_id = test_id.lower()
+    output_file = test_id + '.log'
+
+    full_output_file = os.path.join(subfolder, output_file)
+    if not os.path.isfile(full_output_file):
+        return not_found(full_output_file)
+
+    return send_from_directory(subfolder, output_file, as_attachment=True)
+
+
+# get gunicorn log
+@app.route('/system/log', methods=['GET'])
+def systemlog():
+
+    full_log_file = "/var/log/gunicorn.log"
+    if not os.path.isfile(full_log_file):
+        return not_found(full_log_file)
+
+    return send_from_directory('/var/log', 'gunicorn.log', as_attachment=True)
+
+
+def return_text(text):
+    return Response(text, status=200, mimetype='text/plain')
+
+
+def created_request(msg=None):
+    message = {
+        'status': 201,
+        'id': msg
+    }
+    resp = jsonify(message)
+    resp.status_code = 201
+
+    return resp
+
+
+def too_many_requests(msg=None):
+    message = {
+        'status': 429,
+        'message': 'Too Many Requests: ' + request.url + '--> ' + msg,
+    }
+    resp = jsonify(message)
+    resp.status_code = 429
+    resp.headers['Retry-After'] = str(scoring_retry_after)
+
+    return resp
+
+
+@app.errorhandler(400)
+def bad_request(error=None):
+    message = {
+        'status': 400,
+        'message': 'Bad Request: ' + request.url + '--> Please check your data payload...' + error,
+    }
+    resp = jsonify(message)
+    resp.status_code = 400
+
+    return resp
+
+
+@app.errorhandler(404)
+def not_found(filename=None):
+    message = {
+        'status': 404,
+        'message': 'Bad Request: ' + request.url + '--> Please check your input...' + filename,
+    }
+    resp = jsonify(message)
+    resp.status_code = 404
+
+    return resp
@@ -4,7 +4,13 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
+# one worker process (scoring jobs, their queue and worker threads live in it) with threads to keep
+# answering /query and / while jobs are scoring. Scoring concurrency is set by scoring_workers.
+# server.py reads GUNICORN_THREADS too: long-polls and streams may not take the last reserved_request_threads.
+export GUNICORN_THREADS=${GUNICORN_THREADS:-8}
 exec gunicorn --bind 0.0.0.0:8080 server:app \
+    --workers=1 \
+    --threads=${GUNICORN_THREADS} \
     --log-level=debug \
     --log-file=/var/log/gunicorn.log \
     --access-logfile=/var/log/gunicorn-access.log \
@@ -0,0 +1,62 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import zipfile
+
+import pytest
+import requests
+
+AWSDEST = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# score code of the test model: score_records entry point, so server.py scores in-process.
+SCORE_SCRIPT = '''
+def load_model(model_file):
+    return 2
+
+
+def score_records(model, records):
+    return [{'P_LOAN': (record['LOAN'] or 0) * model} for record in records]
+'''
+
+
+def make_model_repository(folder, score_script=SCORE_SCRIPT, sample_csv=None):
+    # model repository as the scoring image sees it: a folder holding the model zip.
+    os.makedirs(folder, exist_ok=True)
+    with zipfile.ZipFile(os.path.join(folder, 'model.zip'), 'w') as zf:
+        zf.writestr('test_score.py', score_script)
+        if sample_csv is not None:
+            zf.writestr('sample.csv', sample_csv)
+        zf.writestr('fileMetadata.json', '[{"role": "score", "name": "test_score.py"}]')
+    return str(folder)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_scoring_service(model_repository, env=None):
+    # one server.py process, like one scoring pod. Returns (process, url).
+    port = free_port()
+    process = subprocess.Popen([sys.executable, '-c', 'import server; server.app.run(host="127.0.0.1", port=%d, '
+                                'threaded=True)' % port], cwd=AWSDEST,
+                               env=dict(os.environ, model_repository=model_repository, **(env or {})),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:%d' % port
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(url + '/', timeout=1).text == 'pong':
+                return process, url
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("scoring service did not start")
+
+
+@pytest.fixture
+def model_repository(tmp_path):
+    return make_model_repository(tmp_path / 'model')
@@ -0,0 +1,146 @@
+import csv
+import importlib.machinery
+import importlib.util
+import itertools
+import os
+import sys
+import threading
+
+import pytest
+import requests
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+from conftest import AWSDEST, make_model_repository, start_scoring_service
+
+# lambda code imports its own utils package, a namespace package (no __init__.py) that the controller's regular
+# awsdest/utils package would win over whenever awsdest/ is on sys.path. Bind utils to it by path instead, so the
+# tests run from any directory.
+utils_spec = importlib.machinery.ModuleSpec('utils', None, is_package=True)
+utils_spec.submodule_search_locations = [os.path.join(AWSDEST, 'lambda_function_dependencies', 'utils')]
+sys.modules['utils'] = importlib.util.module_from_spec(utils_spec)
+from utils.lambdafunc_core_restapi_score import _score_downloaded_file, _score_partitioned
+
+HOP_BY_HOP_HEADERS = ('connection', 'content-encoding', 'content-length', 'transfer-encoding', 'host')
+
+
+class AffinityIngress(object):
+    """
+    Stands in for the nginx ingress in front of a deployment with several replicas: requests without the route
+    cookie go round robin and get the cookie of the replica they went to, requests with it stick to that replica.
+    """
+
+    def __init__(self, replica_urls):
+        self.replica_urls = replica_urls
+        self.next_replica = itertools.cycle(range(len(replica_urls)))
+        self.lock = threading.Lock()
+        self.executions = [0] * len(replica_urls)
+        self.status_polls = 0
+        self.jobs_not_found = 0
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        replica = request.cookies.get('route')
+        new_route = replica is None
+        if new_route:
+            with self.lock:
+                replica = next(self.next_replica)
+        replica = int(replica)
+        if request.path == '/executions':
+            with self.lock:
+                self.executions[replica] += 1
+        if request.path.startswith('/status/'):
+            with self.lock:
+                self.status_polls += 1
+
+        upstream = requests.request(request.method, self.replica_urls[replica] + request.full_path.rstrip('?'),
+                                    data=request.get_data(),
+                                    headers={k: v for k, v in request.headers if k.lower() not in HOP_BY_HOP_HEADERS})
+        if upstream.status_code == 404 and not request.path == '/executions':
+            with self.lock:
+                self.jobs_not_found += 1
+        response = Response(upstream.content, status=upstream.status_code,
+                            headers=[(k, v) for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS])
+        if new_route:
+            response.set_cookie('route', str(replica))
+        return response(environ, start_response)
+
+
+def serve_ingress(ingress):
+    server = make_server('127.0.0.1', 0, ingress, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+@pytest.fixture
+def two_replicas(tmp_path):
+    # own model repository each, like pods that share nothing
+    replicas = [start_scoring_service(make_model_repository(tmp_path / ('replica%d' % n))) for n in range(2)]
+    ingress = AffinityIngress([url for process, url in replicas])
+    server, ingress_url = serve_ingress(ingress)
+    yield ingress, ingress_url
+    server.shutdown()
+    for process, url in replicas:
+        process.kill()
+        process.wait()
+
+
+def test_partitions_scored_across_replicas(two_replicas):
+    ingress, ingress_url = two_replicas
+    unique_env_identifier = 'test-partitioned-%d' % os.getpid()
+    with open('/tmp/' + unique_env_identifier, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID', 'LOAN', 'ZIP'])
+        for row in range(2000):
+            writer.writerow([row, row * 10, '%05d' % row])
+
+    try:
+        status_code, message = _score_partitioned(ingress_url, unique_env_identifier, 60, 'input.csv', 4096)
+        assert status_code == 0, message
+        with open('/tmp/' + unique_env_identifier + '.scoreout', newline='') as f:
+            rows = list(csv.DictReader(f))
+    finally:
+        for tmp_file in ('/tmp/' + unique_env_identifier, '/tmp/' + unique_env_identifier + '.scoreout'):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    # partitions went to both replicas, and each one's /status and /query found its job on the first try
+    assert all(executions > 0 for executions in ingress.executions)
+    assert ingress.jobs_not_found == 0
+    assert [int(row['ID']) for row in rows] == list(range(2000))
+    assert all(int(row['P_LOAN']) == int(row['ID']) * 20 for row in rows)
+
+
+SLOW_SCORE_SCRIPT = '''
+import time
+
+
+def score_records(model, records):
+    time.sleep(3)
+    return [{'P_LOAN': record['LOAN']} for record in records]
+'''
+
+
+def test_status_polls_back_off_when_service_cannot_wait(tmp_path):
+    # every request thread reserved: /status answers at once, so the client has to pace itself
+    process, url = start_scoring_service(make_model_repository(tmp_path / 'model', SLOW_SCORE_SCRIPT),
+                                         env={'GUNICORN_THREADS': '3', 'reserved_request_threads': '3'})
+    ingress = AffinityIngress([url])
+    server, ingress_url = serve_ingress(ingress)
+    unique_env_identifier = 'test-backoff-%d' % os.getpid()
+    with open('/tmp/' + unique_env_identifier, 'w', newline='') as f:
+        f.write('ID,LOAN\n1,10\n')
+
+    try:
+        status_code, message = _score_downloaded_file(ingress_url, unique_env_identifier, 60, 'input.csv', 'csv')
+        assert status_code == 0, message
+    finally:
+        server.shutdown()
+        process.kill()
+        process.wait()
+        for tmp_file in ('/tmp/' + unique_env_identifier, '/tmp/' + unique_env_identifier + '.scoreout'):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    # 0.5, 1, 2 secs apart over the 3 secs of scoring rather than back to back
+    assert ingress.status_polls <= 6
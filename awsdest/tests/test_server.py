@@ -0,0 +1,178 @@
+import csv
+import io
+import threading
+import time
+
+import pytest
+import requests
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+from conftest import make_model_repository, start_scoring_service
+
+# fails on one row after earlier blocks were already written out
+FAILING_SCORE_SCRIPT = '''
+def score_records(model, records):
+    if any(record['LOAN'] == 999 for record in records):
+        raise ValueError("cannot score LOAN 999")
+    return [{'P_LOAN': record['LOAN']} for record in records]
+'''
+
+
+def _csv(rows):
+    return 'ID,LOAN\n' + ''.join('%d,%d\n' % (row, loan) for row, loan in rows)
+
+
+def test_failed_scoring_leaves_no_result(tmp_path):
+    process, url = start_scoring_service(make_model_repository(tmp_path / 'model', FAILING_SCORE_SCRIPT),
+                                         env={'score_block_rows': '10'})
+    try:
+        data = _csv((row, 999 if row == 50 else row) for row in range(100))
+        test_id = requests.post(url + '/executions', files={'file': ('input.csv', data)}).json()['id']
+        job_status = requests.get(url + '/status/' + test_id, params={'wait': 10}).json()
+        while job_status['status'] in ('queued', 'running'):
+            job_status = requests.get(url + '/status/' + test_id, params={'wait': 10}).json()
+
+        assert job_status['status'] == 'failed'
+        # the first blocks were written before the failure. They must not be served as the result.
+        assert requests.get(url + '/query/' + test_id).status_code == 404
+    finally:
+        process.kill()
+        process.wait()
+
+
+def test_failed_warmup_is_not_ready(tmp_path):
+    process, url = start_scoring_service(make_model_repository(tmp_path / 'model', FAILING_SCORE_SCRIPT,
+                                                               _csv((row, 999) for row in range(5))))
+    try:
+        deadline = time.time() + 10
+        ready = requests.get(url + '/ready')
+        while ready.json()['status'] == 'warming_up' and time.time() < deadline:
+            time.sleep(0.1)
+            ready = requests.get(url + '/ready')
+
+        assert ready.status_code == 503
+        assert ready.json()['status'] == 'warmup_failed'
+    finally:
+        process.kill()
+        process.wait()
+
+
+# reports what the score code was given for ID
+TYPE_SCORE_SCRIPT = '''
+def score_records(model, records):
+    return [{'ID_TYPE': type(record['ID']).__name__} for record in records]
+'''
+
+
+def test_csv_values_keep_their_text(tmp_path):
+    process, url = start_scoring_service(make_model_repository(tmp_path / 'model', TYPE_SCORE_SCRIPT))
+    try:
+        ids = ['007', '02134', ' 5', 'nan', 'inf', '1e5', '1.50', '46236', '-3', '0.25']
+        data = 'ID\n' + ''.join(value + '\n' for value in ids)
+        test_id = requests.post(url + '/executions', files={'file': ('input.csv', data)}).json()['id']
+        job_status = requests.get(url + '/status/' + test_id, params={'wait': 10}).json()
+        while job_status['status'] in ('queued', 'running'):
+            job_status = requests.get(url + '/status/' + test_id, params={'wait': 10}).json()
+        assert job_status['status'] == 'succeeded'
+
+        result = list(csv.DictReader(io.StringIO(requests.get(url + '/query/' + test_id).text)))
+        assert [row['ID_TYPE'] for row in result] == ['str'] * 7 + ['int', 'int', 'float']
+    finally:
+        process.kill()
+        process.wait()
+
+
+def test_score_code_exiting_on_import_falls_back_to_subprocess(tmp_path):
+    # argparse in score code run as a script exits when imported without its arguments
+    process, url = start_scoring_service(make_model_repository(tmp_path / 'model', 'import sys\nsys.exit(2)\n'))
+    try:
+        assert requests.get(url + '/').text == 'pong'
+    finally:
+        process.kill()
+        process.wait()
+
+
+SLOW_SCORE_SCRIPT = '''
+import time
+
+
+def score_records(model, records):
+    time.sleep(2)
+    return [{'P_LOAN': record['LOAN']} for record in records]
+'''
+
+
+def test_long_requests_leave_reserved_threads(tmp_path):
+    # three request threads, all reserved: no long-poll waits and no streaming session opens
+    process, url = start_scoring_service(make_model_repository(tmp_path / 'model', SLOW_SCORE_SCRIPT),
+                                         env={'GUNICORN_THREADS': '3', 'reserved_request_threads': '3'})
+    try:
+        test_id = requests.post(url + '/executions', files={'file': ('input.csv', _csv([(1, 1)]))}).json()['id']
+        start = time.time()
+        job_status = requests.get(url + '/status/' + test_id, params={'wait': 5}).json()
+        assert job_status['status'] in ('queued', 'running')
+        assert time.time() - start < 1
+
+        assert requests.post(url + '/executions/stream').status_code == 429
+    finally:
+        process.kill()
+        process.wait()
+
+
+def test_s3_job_streams_output_to_presigned_post(tmp_path, model_repository):
+    # stands in for S3: presigned GET of the input, presigned POST of the output
+    uploads = []
+
+    @Request.application
+    def fake_s3(request):
+        if request.method == 'GET':
+            return Response(_csv([(1, 10), (2, 20)]))
+        uploads.append((request.headers.get('Content-Length'), dict(request.form),
+                        request.files['file'].filename, request.files['file'].read().decode('utf-8')))
+        return Response(status=204)
+
+    s3 = make_server('127.0.0.1', 0, fake_s3, threaded=True)
+    threading.Thread(target=s3.serve_forever, daemon=True).start()
+    s3_url = 'http://127.0.0.1:%d' % s3.server_port
+    process, url = start_scoring_service(model_repository)
+    try:
+        job = {'input_url': s3_url + '/input.csv', 'filename': 'input.csv',
+               'output_post': {'url': s3_url + '/', 'fields': {'key': 'out/input.csv.scoreout', 'policy': 'p'}}}
+        test_id = requests.post(url + '/executions/s3', json=job).json()['id']
+        job_status = requests.get(url + '/status/' + test_id, params={'wait': 10}).json()
+        while job_status['status'] in ('queued', 'running'):
+            job_status = requests.get(url + '/status/' + test_id, params={'wait': 10}).json()
+        assert job_status['status'] == 'succeeded'
+
+        content_length, fields, filename, scored = uploads[0]
+        assert content_length is not None
+        assert fields == {'key': 'out/input.csv.scoreout', 'policy': 'p'}
+        assert scored.splitlines() == ['ID,LOAN,P_LOAN', '1,10,20', '2,20,40']
+        # uploaded, so nothing of the job is left on the pod
+        assert requests.get(url + '/query/' + test_id).status_code == 404
+        assert requests.get(url + '/query/' + test_id + '/log').status_code == 404
+    finally:
+        s3.shutdown()
+        process.kill()
+        process.wait()
+
+
+def test_failed_stream_breaks_the_download(tmp_path):
+    process, url = start_scoring_service(make_model_repository(tmp_path / 'model', FAILING_SCORE_SCRIPT),
+                                         env={'score_block_rows': '10'})
+    try:
+        test_id = requests.post(url + '/executions/stream').json()['id']
+        data = _csv((row, 999 if row == 50 else row) for row in range(100))
+        uploader = threading.Thread(target=requests.put, args=(url + '/executions/stream/' + test_id,),
+                                    kwargs={'data': data})
+        uploader.start()
+        response = requests.get(url + '/query/' + test_id + '/stream', stream=True)
+        # blocks before the failure were already sent. The transfer must not end as if it was complete.
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            for chunk in response.iter_content(chunk_size=1024):
+                pass
+        uploader.join()
+    finally:
+        process.kill()
+        process.wait()
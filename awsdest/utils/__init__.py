@@ -1 +1 @@
-#!/usr/bin/env python
+#!/usr/bin/env python
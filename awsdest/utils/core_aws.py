@@ -1,172 +1,363 @@
-import configparser
-from urllib.parse import urlparse
-import boto3
-import json
-from botocore.exceptions import ClientError
-
-########
-##
-def init_config():
-    config_file_name = "config.properties"
-    print("Loading config properties..")
-    try:
-        config = configparser.RawConfigParser()
-        config.read(config_file_name)
-        awsconfig = {'aws_access_key_id':config.get('AWS', 'access.key.id'), 'aws_secret_access_key': config.get('AWS', 'secret.access.key'),
-                 'aws_region': config.get('AWS','region'),'aws_eks_cluster_name': config.get('AWS','eks.cluster.name'),
-                     'ingress_controller_url': config.get('AWS', 'ingress.controller.url', fallback=None)
-                 }
-        k8sconfig= {'k8s_deployment_name': config.get('K8S', 'k8s.deployment.name'),
-                 'k8s_service_name': config.get('K8S', 'k8s.service.name'),
-                 'k8s_lbalancer_name': config.get('K8S', 'k8s.lbalancer.name', fallback=None),
-                 'k8s_ingress_name': config.get('K8S','k8s.ingress.name', fallback=None ),
-                 'k8s_namespace': config.get('K8S', 'k8s.namespace'),
-                 'k8s_kubeconfig_path':config.get('K8S','k8s.kubeconfig.path')
-                 }
-        siteconfig={'python_client_network_cidr':config.get('site-specific','python.client.network.cidr'),
-                 'k8s_pods_creation_timeout':int(config.get('site-specific','k8s.pods.creation.timeout')),
-                 'time.limit.on.scoring':int(config.get('site-specific','time.limit.on.scoring'))
-                 }
-        if 'lambda' in config:
-            lambdaconfig={
-                  'lambda_execution_arn_role' : config.get('lambda', 'lambda.execution.arn.role'),
-                'lambda_function_name': config.get('lambda', 'lambda.function.name'),
-                'lambda_layer_arn': config.get('lambda','lambda.layer.arn', fallback=None),
-                'lambda_layer_version': config.get('lambda', 'lambda.layer.version', fallback=None)
-                 }
-        else:
-            lambdaconfig = None
-
-        return (awsconfig, k8sconfig, siteconfig, lambdaconfig)
-    except:
-        print("Error loading configuration from config.properties file! ")
-        print(traceback.format_exc())
-        return 1
-
-########
-#
-# returns number of files in s3 folder. Excludes parent directory and returns number of files
-def number_of_files_s3folder(awsconfig, s3folderin):
-    parsed = urlparse(s3folderin, allow_fragments=False)
-    bucketin = parsed.netloc
-    prefix = parsed.path.lstrip('/')
-    try:
-        s3_client = boto3.client('s3', aws_access_key_id=awsconfig['aws_access_key_id'], aws_secret_access_key=awsconfig['aws_secret_access_key'])
-        kwargs = {'Bucket': bucketin, 'Prefix': prefix}
-        response = s3_client.list_objects_v2(**kwargs)
-        # print("s3 response for folder", s3folderin, response)
-        return (response['KeyCount'] - 1)  # Subtract 1 to remove the parent folder from list
-    except ClientError as e:
-        print("Unexpected error while trying to check on S3 Buckets: %s" % e)
-        return -1
-
-
-########
-####
-def validate_exist_scoringimg_eks_files(awsconfig, s3folderin, s3folderout, model_imagename):
-
-    # Validate S3 Input folder
-    if number_of_files_s3folder(awsconfig,s3folderin) <= 0:
-        print("S3 input folder non existent or empty folder with no files to score")
-        return False
-
-    #  validate S3 output folder
-    if number_of_files_s3folder(awsconfig, s3folderout) < 0:
-        print("S3 output folder non existent.")
-        return False
-
-    # check if ECR image is available
-    try:
-        ecr_client = boto3.client('ecr', aws_access_key_id=awsconfig['aws_access_key_id'],
-                             aws_secret_access_key=awsconfig['aws_secret_access_key'], region_name=awsconfig['aws_region'])
-        response = ecr_client.describe_images(repositoryName=model_imagename)
-        if (response['ResponseMetadata']['HTTPStatusCode'] != 200):
-            print("Image not found or something else wrong with repo")
-            return False
-    except ClientError as e:
-        print("Unexpected error while trying to check on Model image presence: %s" % e)
-        return False
-
-    # check if EKS cluster is running and active
-    try:
-        eks_client = boto3.client('eks', aws_access_key_id=awsconfig['aws_access_key_id'],
-                             aws_secret_access_key=awsconfig['aws_secret_access_key'], region_name=awsconfig['aws_region'])
-        response = eks_client.describe_cluster(name = awsconfig['aws_eks_cluster_name'] )
-        if (response['ResponseMetadata']['HTTPStatusCode'] != 200) or (response['cluster']['status'] != 'ACTIVE'):
-            print("EKS cluster is not Active:", awsconfig['aws_eks_cluster_name'])
-            print(response)
-            return False
-    except ClientError as e:
-        print("Unexpected error while trying to check on EKS cluster: %s" % e)
-        return False
-    #print("S3 folders exist")
-    #print("Validated Model Image available on ECR. Validated EKS Cluster to be Active")
-    #print("All environment check out passed. Proceeding to next step")
-    return True
-
-
-def allow_python_client_CIDR_to_EKSloadBalancer(awsconfig, k8s_cluster_url_for_scoring, python_client_network_cidr):
-    k8s_elb_sg_groupname = "k8s-elb-" + k8s_cluster_url_for_scoring.lstrip("http://").rsplit("-")[0]  # Bad coding. Replace [0] with list iterate but again it is supposed to give just 1 item - Sudhir Reddy
-
-    try:
-        ec2_client = boto3.client('ec2', aws_access_key_id=awsconfig['aws_access_key_id'],
-                              aws_secret_access_key=awsconfig['aws_secret_access_key'],
-                              region_name=awsconfig['aws_region'])
-        http_resp = ec2_client.authorize_security_group_ingress(GroupName=k8s_elb_sg_groupname,
-                                                                IpPermissions=[
-                                                                  {
-                                                                    'IpProtocol' : '-1',
-                                                                    'IpRanges': [
-                                                                        {
-                                                                            'CidrIp' : python_client_network_cidr,
-                                                                            'Description' : "Allow Python scoring client to EKS ELB"
-                                                                        }
-                                                                    ]
-                                                                  }
-                                                                ]
-        )
-        #print(http_resp)
-
-    except ClientError as e:
-        print("Unexpected error while trying to add a Ingress rule to EC2 security group: %s" % e)
-        return False
-
-def generate_presigned_url_for_list(awsconfig, s3folder):
-    parsed = urlparse(s3folder, allow_fragments=False)
-    bucketin = parsed.netloc
-    prefix = parsed.path.lstrip('/')
-    try:
-        s3_client = boto3.client('s3', aws_access_key_id=awsconfig['aws_access_key_id'],
-                                 aws_secret_access_key=awsconfig['aws_secret_access_key'])
-        kwargs = {'Bucket': bucketin, 'Prefix': prefix}
-        return s3_client.generate_presigned_url(ClientMethod='list_objects_v2',Params=kwargs)
-    except ClientError as e:
-        print("Unexpected error while generating presigned url for s3 : %s" % e)
-        return -1
-
-def generate_presigned_url_for_getobject(awsconfig, client_method_name,s3folder, objectkey):
-    parsed = urlparse(s3folder, allow_fragments=False)
-    bucketin = parsed.netloc
-    prefix = parsed.path.lstrip('/')
-    try:
-        s3_client = boto3.client('s3', aws_access_key_id=awsconfig['aws_access_key_id'],
-                                 aws_secret_access_key=awsconfig['aws_secret_access_key'])
-        kwargs = {'Bucket': bucketin, 'Key': objectkey}
-        return s3_client.generate_presigned_url(ClientMethod=client_method_name, Params=kwargs)
-    except ClientError as e:
-        print("Unexpected error while generating presigned url for s3 get: %s" % e)
-        return -1
-
-
-def generate_presigned_url_for_postobject(awsconfig,s3folder,objectkey):
-    parsed = urlparse(s3folder, allow_fragments=False)
-    bucketin = parsed.netloc
-    prefix = parsed.path.lstrip('/')
-    try:
-        s3_client = boto3.client('s3', aws_access_key_id=awsconfig['aws_access_key_id'],
-                                 aws_secret_access_key=awsconfig['aws_secret_access_key'])
-        return s3_client.generate_presigned_post(bucketin,objectkey)
-    except ClientError as e:
-        print("Unexpected error while generating presigned url for s3 post object: %s" % e)
-        return -1
-###############
+import configparser
+from urllib.parse import urlparse
+import boto3
+import json
+import threading
+import concurrent.futures
+from botocore.exceptions import ClientError
+
+########
+##
+# One boto3 session per set of credentials and one client per (service, region, credentials) for the whole process.
+# Creating a client reloads botocore endpoint and service models, which adds up quickly in the per-file loops.
+# boto3 clients are thread safe once created; sessions are not, so creation happens under the lock.
+_aws_sessions = {}
+_aws_clients = {}
+_aws_registry_lock = threading.Lock()
+
+
+def get_aws_session(awsconfig, region_name=None):
+    key = (awsconfig['aws_access_key_id'], awsconfig['aws_secret_access_key'], region_name)
+    with _aws_registry_lock:
+        if key not in _aws_sessions:
+            _aws_sessions[key] = boto3.session.Session(aws_access_key_id=awsconfig['aws_access_key_id'],
+                                                       aws_secret_access_key=awsconfig['aws_secret_access_key'],
+                                                       region_name=region_name)
+        return _aws_sessions[key]
+
+
+def get_aws_client(awsconfig, service, region_name=None):
+    key = (service, region_name, awsconfig['aws_access_key_id'], awsconfig['aws_secret_access_key'])
+    aws_client = _aws_clients.get(key)
+    if aws_client is None:
+        session = get_aws_session(awsconfig)
+        with _aws_registry_lock:
+            if key not in _aws_clients:
+                _aws_clients[key] = session.client(service, region_name=region_name)
+            aws_client = _aws_clients[key]
+    return aws_client
+
+########
+##
+def init_config():
+    config_file_name = "config.properties"
+    print("Loading config properties..")
+    try:
+        config = configparser.RawConfigParser()
+        config.read(config_file_name)
+        awsconfig = {'aws_access_key_id':config.get('AWS', 'access.key.id'), 'aws_secret_access_key': config.get('AWS', 'secret.access.key'),
+                 'aws_region': config.get('AWS','region'),'aws_eks_cluster_name': config.get('AWS','eks.cluster.name'),
+                     'ingress_controller_url': config.get('AWS', 'ingress.controller.url', fallback=None)
+                 }
+        k8sconfig= {'k8s_deployment_name': config.get('K8S', 'k8s.deployment.name'),
+                 'k8s_service_name': config.get('K8S', 'k8s.service.name'),
+                 'k8s_lbalancer_name': config.get('K8S', 'k8s.lbalancer.name', fallback=None),
+                 'k8s_ingress_name': config.get('K8S','k8s.ingress.name', fallback=None ),
+                 'k8s_namespace': config.get('K8S', 'k8s.namespace'),
+                 'k8s_kubeconfig_path':config.get('K8S','k8s.kubeconfig.path')
+                 }
+        siteconfig={'python_client_network_cidr':config.get('site-specific','python.client.network.cidr'),
+                 'k8s_pods_creation_timeout':int(config.get('site-specific','k8s.pods.creation.timeout')),
+                 'k8s_readiness_probe_path':config.get('site-specific','k8s.readiness.probe.path', fallback=None),
+                 'k8s_prepull_images':int(config.get('site-specific','k8s.prepull.images', fallback='0')),
+                 'time.limit.on.scoring':int(config.get('site-specific','time.limit.on.scoring')),
+                 'scoring_max_inflight_files':int(config.get('site-specific','scoring.max.inflight.files', fallback='16')),
+                 'scoring_direct_s3_io':config.getboolean('site-specific','scoring.direct.s3.io', fallback=False),
+                 'scoring_streaming':config.getboolean('site-specific','scoring.streaming', fallback=False),
+                 'scaling_policy':config.get('site-specific','scaling.policy', fallback='simple-total-file-based'),
+                 'scaling_max_replicas':int(config.get('site-specific','scaling.max.replicas', fallback='50')),
+                 'scaling_bytes_per_replica':int(config.get('site-specific','scaling.bytes.per.replica', fallback='1073741824')),
+                 'scaling_history_file':config.get('site-specific','scaling.history.file', fallback='tmp/scaling_history.json'),
+                 's3_multipart_threshold':int(config.get('site-specific','s3.multipart.threshold', fallback='67108864')),
+                 's3_multipart_part_size':int(config.get('site-specific','s3.multipart.part.size', fallback='33554432')),
+                 's3_multipart_concurrency':int(config.get('site-specific','s3.multipart.concurrency', fallback='8')),
+                 's3_multipart_part_retries':int(config.get('site-specific','s3.multipart.part.retries', fallback='3')),
+                 'scoring_output_format':config.get('site-specific','scoring.output.format', fallback='input'),
+                 'scoring_partition_size':int(config.get('site-specific','scoring.partition.size', fallback='0')),
+                 'scoring_cache_enabled':config.getboolean('site-specific','scoring.cache.enabled', fallback=False),
+                 'scoring_cache_max_age':int(config.get('site-specific','scoring.cache.max.age', fallback='604800')),
+                 'scoring_cache_max_bytes':int(config.get('site-specific','scoring.cache.max.bytes', fallback='107374182400'))
+                 }
+        if 'lambda' in config:
+            lambdaconfig={
+                  'lambda_execution_arn_role' : config.get('lambda', 'lambda.execution.arn.role'),
+                'lambda_function_name': config.get('lambda', 'lambda.function.name'),
+                'lambda_layer_arn': config.get('lambda','lambda.layer.arn', fallback=None),
+                'lambda_layer_version': config.get('lambda', 'lambda.layer.version', fallback=None),
+                'lambda_pool_min_size': config.get('lambda', 'lambda.pool.min.size', fallback='0'),
+                'lambda_pool_max_size': config.get('lambda', 'lambda.pool.max.size', fallback='0'),
+                'lambda_pool_idle_timeout': config.get('lambda', 'lambda.pool.idle.timeout', fallback='900'),
+                'lambda_streaming_scoring': config.get('lambda', 'lambda.streaming.scoring', fallback='false'),
+                'lambda_direct_s3_io': config.get('lambda', 'lambda.direct.s3.io', fallback='false'),
+                'lambda_max_concurrent_records': config.get('lambda', 'lambda.max.concurrent.records', fallback='4'),
+                'lambda_s3_multipart_threshold': config.get('lambda', 'lambda.s3.multipart.threshold', fallback='67108864'),
+                'lambda_s3_multipart_part_size': config.get('lambda', 'lambda.s3.multipart.part.size', fallback='33554432'),
+                'lambda_s3_multipart_concurrency': config.get('lambda', 'lambda.s3.multipart.concurrency', fallback='8'),
+                'lambda_scoring_output_format': config.get('lambda', 'lambda.scoring.output.format', fallback='input'),
+                'lambda_partition_size': config.get('lambda', 'lambda.partition.size', fallback='0'),
+                'lambda_partition_max_replicas': config.get('lambda', 'lambda.partition.max.replicas', fallback='8'),
+                'lambda_cache_enabled': config.get('lambda', 'lambda.cache.enabled', fallback='false'),
+                'lambda_cache_max_age': config.get('lambda', 'lambda.cache.max.age', fallback='604800'),
+                'lambda_cache_max_bytes': config.get('lambda', 'lambda.cache.max.bytes', fallback='107374182400'),
+                'lambda_cache_evict_every': config.get('lambda', 'lambda.cache.evict.every', fallback='100'),
+                'lambda_readiness_probe_path': config.get('lambda', 'lambda.readiness.probe.path', fallback=''),
+                'lambda_prepull_images': config.get('lambda', 'lambda.prepull.images', fallback='0')
+                 }
+        else:
+            lambdaconfig = None
+
+        return (awsconfig, k8sconfig, siteconfig, lambdaconfig)
+    except:
+        print("Error loading configuration from config.properties file! ")
+        print(traceback.format_exc())
+        return 1
+
+########
+#
+# generator over every object in s3 folder. list_objects_v2 returns at most 1000 keys a call so follow continuation
+# tokens; the next page is fetched on a background thread while the caller works through the current one.
+# yields {'Key', 'Size', 'ETag'}. Folder placeholder keys (ending with /) only with include_folders.
+# page_size (MaxKeys) is for callers that stop early: such pages are fetched one by one without prefetch.
+def iter_s3folder_objects(awsconfig, s3folder, include_folders=False, page_size=None):
+    parsed = urlparse(s3folder, allow_fragments=False)
+    bucketin = parsed.netloc
+    prefix = parsed.path.lstrip('/')
+    s3_client = get_aws_client(awsconfig, 's3')
+    kwargs = {'Bucket': bucketin, 'Prefix': prefix}
+    if page_size is not None:
+        kwargs['MaxKeys'] = page_size
+
+    def list_page(continuation_token=None):
+        if continuation_token is None:
+            return s3_client.list_objects_v2(**kwargs)
+        return s3_client.list_objects_v2(ContinuationToken=continuation_token, **kwargs)
+
+    def page_objects(response):
+        for s3object in response.get('Contents', []):
+            if s3object['Key'][-1] == "/" and not include_folders:
+                continue
+            yield {'Key': s3object['Key'], 'Size': s3object['Size'], 'ETag': s3object['ETag'].strip('"'),
+                   'LastModified': s3object['LastModified']}
+
+    if page_size is not None:
+        response = list_page()
+        yield from page_objects(response)
+        while response.get('IsTruncated'):
+            response = list_page(response['NextContinuationToken'])
+            yield from page_objects(response)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_page = prefetcher.submit(list_page)
+        while next_page is not None:
+            response = next_page.result()
+            next_page = None
+            if response.get('IsTruncated'):
+                next_page = prefetcher.submit(list_page, response['NextContinuationToken'])
+            yield from page_objects(response)
+
+
+########
+#
+# returns number of files in s3 folder. Excludes parent directory and returns number of files
+# -1 when there is nothing at all under the folder (not even its placeholder), ie. folder does not exist.
+# max_files stops counting there; callers that only check the folder exists / has files pass 1 and list one
+# small page instead of the whole folder.
+def number_of_files_s3folder(awsconfig, s3folderin, max_files=None):
+    try:
+        objects = 0
+        files = 0
+        # one more key than max_files for the folder's own placeholder
+        page_size = max_files + 1 if max_files is not None else None
+        for s3object in iter_s3folder_objects(awsconfig, s3folderin, include_folders=True, page_size=page_size):
+            objects += 1
+            if not s3object['Key'][-1] == "/":
+                files += 1
+                if max_files is not None and files >= max_files:
+                    break
+        # print("s3 objects for folder", s3folderin, objects, files)
+        if objects == 0:
+            return -1
+        return files
+    except ClientError as e:
+        print("Unexpected error while trying to check on S3 Buckets: %s" % e)
+        return -1
+
+
+########
+####
+def validate_exist_scoringimg_eks_files(awsconfig, s3folderin, s3folderout, model_imagename):
+
+    # Validate S3 Input folder
+    if number_of_files_s3folder(awsconfig, s3folderin, max_files=1) <= 0:
+        print("S3 input folder non existent or empty folder with no files to score")
+        return False
+
+    #  validate S3 output folder
+    if number_of_files_s3folder(awsconfig, s3folderout, max_files=1) < 0:
+        print("S3 output folder non existent.")
+        return False
+
+    # check if ECR image is available
+    try:
+        ecr_client = get_aws_client(awsconfig, 'ecr', awsconfig['aws_region'])
+        response = ecr_client.describe_images(repositoryName=model_imagename)
+        if (response['ResponseMetadata']['HTTPStatusCode'] != 200):
+            print("Image not found or something else wrong with repo")
+            return False
+    except ClientError as e:
+        print("Unexpected error while trying to check on Model image presence: %s" % e)
+        return False
+
+    # check if EKS cluster is running and active
+    try:
+        eks_client = get_aws_client(awsconfig, 'eks', awsconfig['aws_region'])
+        response = eks_client.describe_cluster(name = awsconfig['aws_eks_cluster_name'] )
+        if (response['ResponseMetadata']['HTTPStatusCode'] != 200) or (response['cluster']['status'] != 'ACTIVE'):
+            print("EKS cluster is not Active:", awsconfig['aws_eks_cluster_name'])
+            print(response)
+            return False
+    except ClientError as e:
+        print("Unexpected error while trying to check on EKS cluster: %s" % e)
+        return False
+    #print("S3 folders exist")
+    #print("Validated Model Image available on ECR. Validated EKS Cluster to be Active")
+    #print("All environment check out passed. Proceeding to next step")
+    return True
+
+
+def _describe_model_image(awsconfig, model_imagename, image_digest=None):
+    # imageDetails of the image with image_digest, by default of the one :latest points at right now. None when it
+    # cannot be read.
+    image_id = {'imageTag': 'latest'} if image_digest is None else {'imageDigest': image_digest}
+    try:
+        ecr_client = get_aws_client(awsconfig, 'ecr', awsconfig['aws_region'])
+        response = ecr_client.describe_images(repositoryName=model_imagename, imageIds=[image_id])
+        return response['imageDetails'][0]
+    except (ClientError, IndexError) as e:
+        print("Unexpected error while reading model image digest: %s" % e)
+        return None
+
+
+def get_model_image_digest(awsconfig, model_imagename):
+    # digest of the :latest image. Unlike the tag it changes with every push. None when it cannot be read.
+    # Resolve it once per run and pass it on (get_model_image_ecrpath, result cache): :latest may move in between.
+    image_details = _describe_model_image(awsconfig, model_imagename)
+    return None if image_details is None else image_details['imageDigest']
+
+
+def get_model_image_ecrpath(awsconfig, model_imagename, image_digest=None):
+    # <registry>/<image>@sha256:... for image_digest, by default for the image :latest points at right now. All
+    # replicas run the same image even if :latest is pushed while they start, and nodes that already hold that digest
+    # start them without a pull (digest references default to imagePullPolicy IfNotPresent, :latest to Always).
+    image_details = _describe_model_image(awsconfig, model_imagename, image_digest)
+    if image_details is None:
+        return None
+    return image_details['registryId'] + ".dkr.ecr." + awsconfig['aws_region'] + ".amazonaws.com/" + \
+        model_imagename + "@" + image_details['imageDigest']
+
+
+def allow_python_client_CIDR_to_EKSloadBalancer(awsconfig, k8s_cluster_url_for_scoring, python_client_network_cidr):
+    k8s_elb_sg_groupname = "k8s-elb-" + k8s_cluster_url_for_scoring.lstrip("http://").rsplit("-")[0]  # Bad coding. Replace [0] with list iterate but again it is supposed to give just 1 item - Sudhir Reddy
+
+    try:
+        ec2_client = get_aws_client(awsconfig, 'ec2', awsconfig['aws_region'])
+        http_resp = ec2_client.authorize_security_group_ingress(GroupName=k8s_elb_sg_groupname,
+                                                                IpPermissions=[
+                                                                  {
+                                                                    'IpProtocol' : '-1',
+                                                                    'IpRanges': [
+                                                                        {
+                                                                            'CidrIp' : python_client_network_cidr,
+                                                                            'Description' : "Allow Python scoring client to EKS ELB"
+                                                                        }
+                                                                    ]
+                                                                  }
+                                                                ]
+        )
+        #print(http_resp)
+
+    except ClientError as e:
+        print("Unexpected error while trying to add a Ingress rule to EC2 security group: %s" % e)
+        return False
+
+def generate_presigned_url_for_list(awsconfig, s3folder):
+    parsed = urlparse(s3folder, allow_fragments=False)
+    bucketin = parsed.netloc
+    prefix = parsed.path.lstrip('/')
+    try:
+        s3_client = get_aws_client(awsconfig, 's3')
+        kwargs = {'Bucket': bucketin, 'Prefix': prefix}
+        return s3_client.generate_presigned_url(ClientMethod='list_objects_v2',Params=kwargs)
+    except ClientError as e:
+        print("Unexpected error while generating presigned url for s3 : %s" % e)
+        return -1
+
+def generate_presigned_url_for_getobject(awsconfig, client_method_name,s3folder, objectkey):
+    parsed = urlparse(s3folder, allow_fragments=False)
+    bucketin = parsed.netloc
+    prefix = parsed.path.lstrip('/')
+    try:
+        s3_client = get_aws_client(awsconfig, 's3')
+        kwargs = {'Bucket': bucketin, 'Key': objectkey}
+        return s3_client.generate_presigned_url(ClientMethod=client_method_name, Params=kwargs)
+    except ClientError as e:
+        print("Unexpected error while generating presigned url for s3 get: %s" % e)
+        return -1
+
+
+def generate_presigned_url_for_postobject(awsconfig,s3folder,objectkey):
+    parsed = urlparse(s3folder, allow_fragments=False)
+    bucketin = parsed.netloc
+    prefix = parsed.path.lstrip('/')
+    try:
+        s3_client = get_aws_client(awsconfig, 's3')
+        return s3_client.generate_presigned_post(bucketin,objectkey)
+    except ClientError as e:
+        print("Unexpected error while generating presigned url for s3 post object: %s" % e)
+        return -1
+
+
+# S3 multipart upload with presigned UploadPart URLs. Parts are PUT by whoever holds the URLs (see core_s3_transfer.py),
+# only create/complete/abort need credentials. objectkey is the full key, s3folder only gives the bucket.
+def create_multipart_upload(awsconfig, s3folder, objectkey):
+    bucketout = urlparse(s3folder, allow_fragments=False).netloc
+    try:
+        s3_client = get_aws_client(awsconfig, 's3')
+        return s3_client.create_multipart_upload(Bucket=bucketout, Key=objectkey)['UploadId']
+    except ClientError as e:
+        print("Unexpected error while creating multipart upload for s3 : %s" % e)
+        return None
+
+
+def generate_presigned_urls_for_uploadpart(awsconfig, s3folder, objectkey, upload_id, number_of_parts, expires_in=3600):
+    bucketout = urlparse(s3folder, allow_fragments=False).netloc
+    s3_client = get_aws_client(awsconfig, 's3')
+    return [s3_client.generate_presigned_url(ClientMethod='upload_part', ExpiresIn=expires_in,
+                                             Params={'Bucket': bucketout, 'Key': objectkey, 'UploadId': upload_id,
+                                                     'PartNumber': part_number})
+            for part_number in range(1, number_of_parts + 1)]
+
+
+def complete_multipart_upload(awsconfig, s3folder, objectkey, upload_id, parts):
+    # parts: [{'ETag', 'PartNumber'}] in part number order
+    bucketout = urlparse(s3folder, allow_fragments=False).netloc
+    try:
+        s3_client = get_aws_client(awsconfig, 's3')
+        s3_client.complete_multipart_upload(Bucket=bucketout, Key=objectkey, UploadId=upload_id,
+                                            MultipartUpload={'Parts': parts})
+        return True
+    except ClientError as e:
+        print("Unexpected error while completing multipart upload for s3 : %s" % e)
+        return False
+
+
+def abort_multipart_upload(awsconfig, s3folder, objectkey, upload_id):
+    # parts already uploaded are billed as storage until the upload is aborted.
+    bucketout = urlparse(s3folder, allow_fragments=False).netloc
+    try:
+        s3_client = get_aws_client(awsconfig, 's3')
+        s3_client.abort_multipart_upload(Bucket=bucketout, Key=objectkey, UploadId=upload_id)
+    except ClientError as e:
+        print("Unexpected error while aborting multipart upload for s3 : %s" % e)
+###############
@@ -0,0 +1,94 @@
+import math
+import os
+import shutil
+
+########
+##
+# Partitioned scoring of large csv files. A file above scoring.partition.size is cut at row boundaries into partitions
+# of about that size, each starting with the header row, so one big file is scored by many replicas at once. Scored
+# partitions are merged back in the original row order into a single scoreout. 0 turns it off.
+# Quoted fields may hold newlines; quotes inside a field are doubled, so a row ends at the first line end with an even
+# number of quotes seen so far (quote parity).
+PARTITION_COPY_BLOCK = 1024 * 1024
+PARTITIONABLE_EXTENSIONS = ('', '.csv', '.txt')
+
+
+def is_partitionable(file, size, partition_size):
+    # csv only. Parquet/Arrow and compressed inputs go to one replica whole.
+    return partition_size > 0 and size > partition_size and \
+        os.path.splitext(file)[1].lower() in PARTITIONABLE_EXTENSIONS
+
+
+def partition_count(size, partition_size):
+    return max(1, int(math.ceil(size / partition_size)))
+
+
+def _read_row(f):
+    # one csv row, which may span several lines. b'' at end of file.
+    row = f.readline()
+    while row.count(b'"') % 2 == 1:
+        line = f.readline()
+        if not line:
+            break
+        row += line
+    return row
+
+
+def split_csv_file(filename, partition_size):
+    # returns partition file names in row order, <filename>.part00000 and up. Rows are copied in big blocks; only the
+    # tail of each partition is read line by line to find where the row ends.
+    partitions = []
+    with open(filename, 'rb') as src:
+        header = _read_row(src)
+        quotes_open = False
+        while True:
+            block = src.read(min(PARTITION_COPY_BLOCK, partition_size))
+            if not block:
+                break
+            partition_filename = filename + ".part%05d" % len(partitions)
+            partitions.append(partition_filename)
+            with open(partition_filename, 'wb') as dst:
+                dst.write(header)
+                written = 0
+                while block:
+                    dst.write(block)
+                    written += len(block)
+                    quotes_open ^= block.count(b'"') % 2 == 1
+                    if written >= partition_size:
+                        break
+                    block = src.read(min(PARTITION_COPY_BLOCK, partition_size - written))
+                # finish the row the last block stopped in
+                row_complete = not quotes_open and block.endswith(b'\n')
+                while not row_complete:
+                    line = src.readline()
+                    if not line:
+                        break
+                    dst.write(line)
+                    quotes_open ^= line.count(b'"') % 2 == 1
+                    row_complete = not quotes_open and line.endswith(b'\n')
+    if not partitions:
+        # header only. Score it as is.
+        partition_filename = filename + ".part00000"
+        shutil.copyfile(filename, partition_filename)
+        partitions.append(partition_filename)
+    return partitions
+
+
+def merge_csv_files(partition_outputs, output_filename):
+    # scored partitions in row order into output_filename. Header from the first one, skipped on the others.
+    with open(output_filename, 'wb') as dst:
+        ends_with_newline = True
+        for part_number, partition_output in enumerate(partition_outputs):
+            with open(partition_output, 'rb') as src:
+                header = _read_row(src)
+                if part_number == 0:
+                    dst.write(header)
+                    ends_with_newline = header.endswith(b'\n')
+                block = src.read(PARTITION_COPY_BLOCK)
+                if block and not ends_with_newline:
+                    # last row of the previous partition had no line end
+                    dst.write(b'\n')
+                while block:
+                    dst.write(block)
+                    ends_with_newline = block.endswith(b'\n')
+                    block = src.read(PARTITION_COPY_BLOCK)
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import time
+
+from kubernetes import client
+
+########
+##
+# Node pre-pull of model images. Every scoring deployment counts one use of its model image in an annotation on the
+# sasmm-model-prepull daemonset, and the daemonset runs the k8s.prepull.images most used images as init containers
+# on every node. The node then holds those images (by digest, see get_model_image_ecrpath) before scoring pods need
+# them, and pod start is container start rather than an ECR pull. Lambda keeps the same daemonset, see
+# lambdafunc_core_prepull.py. 0 turns it off.
+PREPULL_DAEMONSET_NAME = "sasmm-model-prepull"
+ANNOTATION_IMAGE_USAGE = "sasmm/image-usage"
+# the daemonset's own long running container. Model images only run as init containers that exit right away.
+PREPULL_PAUSE_IMAGE = "registry.k8s.io/pause:3.9"
+# usage of this many images at most is kept in the annotation (annotations are limited to 256KB in total).
+PREPULL_USAGE_ENTRIES = 50
+PREPULL_UPDATE_RETRIES = 3
+
+
+def _top_images(usage, prepull_images):
+    # most used first, most recently used breaks ties.
+    ranked = sorted(usage.items(), key=lambda item: (item[1]['uses'], item[1]['last_used']), reverse=True)
+    return ranked[:prepull_images]
+
+
+def _prepull_init_container(model_imagename, usage_entry):
+    # python is in every model image (server.py runs on it), so it is the cheapest command that exits 0 once the
+    # image is on the node.
+    return client.V1Container(
+        name="prepull-" + hashlib.sha1(model_imagename.encode('utf-8')).hexdigest()[:10],
+        image=usage_entry['image'],
+        image_pull_policy="IfNotPresent",
+        command=["python", "-c", "pass"],
+        resources=client.V1ResourceRequirements(requests={'cpu': '10m', 'memory': '16Mi'}))
+
+
+def _create_prepull_daemonset_object(usage, prepull_images):
+    template = client.V1PodTemplateSpec(
+        metadata=client.V1ObjectMeta(labels={"app": PREPULL_DAEMONSET_NAME}),
+        spec=client.V1PodSpec(
+            init_containers=[_prepull_init_container(model_imagename, usage_entry)
+                             for model_imagename, usage_entry in _top_images(usage, prepull_images)],
+            containers=[client.V1Container(name="pause", image=PREPULL_PAUSE_IMAGE,
+                                           resources=client.V1ResourceRequirements(
+                                               requests={'cpu': '10m', 'memory': '16Mi'}))],
+            # every node, tainted ones included, since scoring pods may land anywhere.
+            tolerations=[client.V1Toleration(operator="Exists")]))
+    return client.V1DaemonSet(
+        api_version="apps/v1",
+        kind="DaemonSet",
+        metadata=client.V1ObjectMeta(name=PREPULL_DAEMONSET_NAME,
+                                     annotations={ANNOTATION_IMAGE_USAGE: json.dumps(usage)}),
+        spec=client.V1DaemonSetSpec(selector={'matchLabels': {'app': PREPULL_DAEMONSET_NAME}}, template=template))
+
+
+def _record_use(usage, model_imagename, model_imagename_ecrpath):
+    usage_entry = usage.get(model_imagename, {'uses': 0})
+    usage[model_imagename] = {'uses': usage_entry['uses'] + 1, 'last_used': time.time(),
+                              'image': model_imagename_ecrpath}
+    for stale_imagename, stale_entry in _top_images(usage, len(usage))[PREPULL_USAGE_ENTRIES:]:
+        del usage[stale_imagename]
+
+
+def record_model_image_use(api_client, k8s_namespace, model_imagename, model_imagename_ecrpath, prepull_images):
+    # counts one use of the image and keeps the daemonset pulling the prepull_images most used ones. Its pod template,
+    # and with it a rollout across the nodes, only changes when that set of images changes. A failure here costs the
+    # pre-pull, never the scoring.
+    if prepull_images <= 0:
+        return True
+    apps_v1 = client.AppsV1Api(api_client)
+    for attempt in range(PREPULL_UPDATE_RETRIES):
+        try:
+            try:
+                daemonset = apps_v1.read_namespaced_daemon_set(name=PREPULL_DAEMONSET_NAME, namespace=k8s_namespace)
+                usage = json.loads((daemonset.metadata.annotations or {}).get(ANNOTATION_IMAGE_USAGE, '{}'))
+            except client.rest.ApiException as e:
+                if e.status != 404:
+                    raise e
+                daemonset = None
+                usage = {}
+            _record_use(usage, model_imagename, model_imagename_ecrpath)
+            wanted = _create_prepull_daemonset_object(usage, prepull_images)
+            if daemonset is None:
+                apps_v1.create_namespaced_daemon_set(namespace=k8s_namespace, body=wanted)
+            else:
+                daemonset.metadata.annotations = dict(daemonset.metadata.annotations or {})
+                daemonset.metadata.annotations[ANNOTATION_IMAGE_USAGE] = json.dumps(usage)
+                pulled = set(container.image for container in daemonset.spec.template.spec.init_containers or [])
+                if pulled != set(container.image for container in wanted.spec.template.spec.init_containers):
+                    daemonset.spec.template = wanted.spec.template
+                # daemonset still carries resourceVersion we read it with. A concurrent update => 409 and we redo ours.
+                apps_v1.replace_namespaced_daemon_set(name=PREPULL_DAEMONSET_NAME, namespace=k8s_namespace,
+                                                      body=daemonset)
+            return True
+        except client.rest.ApiException as e:
+            # 409 is also what a concurrent create of the daemonset gets
+            if e.status != 409:
+                print("Unexpected error while updating model image prepull daemonset: %s" % e)
+                return False
+    print("Model image prepull daemonset not updated, too many conflicting updates")
+    return False
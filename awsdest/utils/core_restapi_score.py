@@ -1,158 +1,628 @@
-from os import path
-from urllib.parse import urlparse
-
-import requests
-import json
-import yaml
-import xml.etree.ElementTree as ET
-import pickle
-import time
-import sys
-
-from awsdest.utils.core_aws import *
-
-def validate_pingpong_on_scoring(k8s_cluster_url_for_scoring):
-    try:
-        http_resp = requests.get(url=k8s_cluster_url_for_scoring,timeout=5)
-        #print("http response: ", http_resp )
-        if http_resp.text == "pong":
-            return True
-        else:
-            return False
-    except:
-        #print("No response from scoring service in validate_pingpong_on_scoring method:")
-        #print(http_resp)
-        return False
-
-def _get_s3file_list(awsconfig,s3folderin):
-    s3file_list = []
-    try:
-        response = requests.get(generate_presigned_url_for_list(awsconfig, s3folderin))
-        root = ET.fromstring(response.content)
-        for child in root.findall('{http://s3.amazonaws.com/doc/2006-03-01/}Contents'):
-            Key = child.find('{http://s3.amazonaws.com/doc/2006-03-01/}Key')
-            if (Key.text[-1] == "/"):  # skip directory level
-                continue
-            #print("Scoring File :", Key.text)
-            s3file_list.append(Key.text)
-        return s3file_list
-    except:
-        print("No response from AWS S3 predefined URL in _get_s3file_list method ")
-
-
-def _score_one_file(session_id, awsconfig, s3folderin, file, k8s_url_for_scoring):
-    s3file_downloadurl = generate_presigned_url_for_getobject(awsconfig, "get_object", s3folderin, file)
-    try:
-        r = requests.get(s3file_downloadurl,stream=True)
-        filename = path.basename(file)
-        with open("tmp/"+filename,"wb") as s3csv:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    s3csv.write(chunk)
-        filename1 = {"file": open("tmp/"+filename,'rb') }
-        http_response = session_id.post(url=k8s_url_for_scoring + "/executions",files=filename1)
-        return http_response.text
-    except:
-        print("No response from one of requests in _score_one_file ")
-
-def _get_scoring_result(session_id, file, scoring_token, k8s_url_for_scoring):
-    query_url = k8s_url_for_scoring + "/query/" + scoring_token
-    try:
-        r = session_id.get(query_url,stream=True)
-        if not r.status_code == 200 :
-            return "scoring_progress"
-        filename = path.basename(file)
-        with open("tmp/" + filename + ".scoreout", "wb") as s3csv:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    s3csv.write(chunk)
-        print("Retrieving scored output for :", file)
-        return "scoring_completed"
-    except:
-        print("Unexpected error:", sys.exc_info())
-        print("not proper response in _get_scoring_result method")
-        return "scoring_progress"
-
-
-def _upload_scoreout_one_file(session_id, awsconfig,s3folderout, file):
-    parsed = urlparse(s3folderout, allow_fragments=False)
-    prefix = parsed.path.lstrip('/')
-    objkey = prefix + path.basename(file)+".scoreout"
-    #print("objkey: ", objkey)
-    s3file_uploadurl = generate_presigned_url_for_postobject(awsconfig, s3folderout, objkey)
-    #print("s3 file upload URL", s3file_uploadurl)
-    try:
-        filename1 = {"file": open("tmp/"+path.basename(file)+".scoreout",'rb') }
-        http_response = requests.post(url=s3file_uploadurl['url'],data=s3file_uploadurl['fields'],files=filename1)
-        if not http_response.status_code in range(200,290):
-            print("file upload to s3 failed", http_response.status_code)
-            print("Full response:", http_response.text)
-        print("scored output put to S3:", objkey)
-        return http_response.status_code
-    except:
-        print("No response from one of requests _upload_scoreout_one_file to s3 ")
-        print ("http response from uploading to s3:", http_response.text)
-        return http_response.status_code
-
-def score_s3files_controller(awsconfig,s3folderin,s3folderout,k8s_url_for_scoring, maxtime_scoring):
-    # build a session_list structure that has 4 tuples for each entry. This 4 tuple helps us maintain control over job execution
-    # 1. session_id to help cookie and session affinity 2. file - name of file we are dealing
-    # 3. token - used to check back on status from scoring service 4. actual status of job
-
-    print("Scoring process started at ", time.ctime(time.time()))
-
-    sessions_list = []
-    s3file_list = _get_s3file_list(awsconfig,s3folderin)
-
-    # Phase1 - submit scoring job for each file. All scoring is done in parallel with a fire-and-forget approach
-    # but do save scoring_token from each submission. We need these to go back and retreive scored output in phase1
-    for file in s3file_list:
-        session_id = requests.session()
-        scoring_result = _score_one_file(session_id, awsconfig, s3folderin, file, k8s_url_for_scoring)
-        scoring_token = json.loads(scoring_result)["id"]
-        sessions_list.append((session_id, file, scoring_token, "scoring_started"))
-        print("Set for scoring file, scoring_token, sessionid :", file, scoring_token, session_id)
-
-    # for debug purposes save as pickle file and then reload
-    #print("session list:", sessions_list )
-    #with open("tmp/session_list.dat", "wb") as f:
-    #    pickle.dump(sessions_list, f)
-
-    # phase2 - check status of each scoring job. # wait on this until all jobs are complete.
-    jobs_pending = True
-    start = time.time()
-    while jobs_pending and (time.time() - start < maxtime_scoring):
-        jobs_pending = False # just set it to false if any of jobs is still in progress we will set it back to True
-        for session_item in range(len(sessions_list)):
-            session_id, file, scoring_token, scoring_status = sessions_list[session_item]
-            if not scoring_status == "scoring_completed":
-                scoring_status = _get_scoring_result(session_id, file, scoring_token, k8s_url_for_scoring)
-            if not scoring_status == "scoring_completed":
-                jobs_pending = True
-            sessions_list[session_item] = ( session_id, file, scoring_token, scoring_token)
-
-
-    if jobs_pending:
-        print("Went beyond allocated time. Aborting scoring ")
-        print("Time limit for scoring in secs: ",maxtime_scoring, "start time: ", time.ctime(start), "current time: ", time.ctime(time.time()))
-        return 1
-
-    # phase-3  upload each scored output file to s3
-    for session_item in range(len(sessions_list)):
-        session_id, file, scoring_token, scoring_status = sessions_list[session_item]
-        if not _upload_scoreout_one_file(session_id, awsconfig, s3folderout, file) in range (200,299):
-            return 1
-
-    print("Scoring process Ended at ", time.ctime(time.time()))
-
-
-
-if __name__ == '__main__':
-    validate_pingpong_on_scoring("http://ab9f8139f783911eabed40a902ea44af-1673116921.us-east-1.elb.amazonaws.com:8080/")
-
-
-
-
-
-
-
+from os import path
+from urllib.parse import urlparse
+
+import requests
+import json
+import yaml
+import xml.etree.ElementTree as ET
+import pickle
+import time
+import sys
+import os
+import threading
+import concurrent.futures
+import functools
+import gzip
+import shutil
+import zlib
+
+# zstandard is optional, gzip is used when it is missing
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from awsdest.utils.core_aws import *
+from awsdest.utils.core_s3_transfer import *
+from awsdest.utils.core_partition import *
+from awsdest.utils.core_result_cache import *
+
+# Compressed uploads. Scoring services list the encodings they decode in the ping response (X-Upload-Encodings);
+# images without it get plain uploads. Results come back compressed anyway since requests sends Accept-Encoding
+# and decodes the response transparently.
+_scoring_upload_encodings = {}
+UPLOAD_ENCODING_MIMETYPES = {'gzip': 'application/gzip', 'zstd': 'application/zstd'}
+
+
+def _upload_encoding(k8s_url_for_scoring):
+    encodings = _scoring_upload_encodings.get(k8s_url_for_scoring.rstrip('/'), [])
+    if zstandard is not None and 'zstd' in encodings:
+        return 'zstd'
+    if 'gzip' in encodings:
+        return 'gzip'
+    return None
+
+
+def _compress_file(filename, encoding):
+    # fastest levels. Compression has to keep up with the network to be worth it.
+    compressed_filename = filename + (".zst" if encoding == 'zstd' else ".gz")
+    with open(filename, 'rb') as src:
+        if encoding == 'zstd':
+            with open(compressed_filename, 'wb') as dst:
+                zstandard.ZstdCompressor(level=1).copy_stream(src, dst)
+        else:
+            with gzip.open(compressed_filename, 'wb', compresslevel=1) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+    return compressed_filename
+
+
+def _compressed_chunks(chunks, encoding):
+    compressor = zstandard.ZstdCompressor(level=1).compressobj() if encoding == 'zstd' else \
+        zlib.compressobj(1, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Input format by file extension, same mapping as the scoring service. Scored output is csv, parquet or arrow
+# (scoring.output.format, "input" keeps each file's own format) and the S3 key says which.
+INPUT_FORMAT_EXTENSIONS = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.ipc': 'arrow'}
+SCOREOUT_SUFFIXES = {'csv': '.scoreout', 'parquet': '.scoreout.parquet', 'arrow': '.scoreout.arrow'}
+
+
+def _output_format(file, output_format):
+    if output_format in (None, 'input'):
+        return INPUT_FORMAT_EXTENSIONS.get(path.splitext(file)[1].lower(), 'csv')
+    return output_format
+
+
+def validate_pingpong_on_scoring(k8s_cluster_url_for_scoring):
+    try:
+        http_resp = requests.get(url=k8s_cluster_url_for_scoring,timeout=5)
+        #print("http response: ", http_resp )
+        if http_resp.text == "pong":
+            encodings = http_resp.headers.get('X-Upload-Encodings', '')
+            _scoring_upload_encodings[k8s_cluster_url_for_scoring.rstrip('/')] = \
+                [encoding.strip() for encoding in encodings.split(',') if encoding.strip()]
+            return True
+        else:
+            return False
+    except:
+        #print("No response from scoring service in validate_pingpong_on_scoring method:")
+        #print(http_resp)
+        return False
+
+def _get_s3file_list(awsconfig,s3folderin):
+    # lazily, a page of 1000 keys at a time, so folders of any size are listed completely without holding them in memory
+    try:
+        for s3object in iter_s3folder_objects(awsconfig, s3folderin):
+            #print("Scoring File :", s3object['Key'])
+            yield s3object['Key']
+    except ClientError as e:
+        print("Unexpected error while listing S3 folder in _get_s3file_list method: %s" % e)
+
+
+def _download_one_file(awsconfig, s3folderin, file, transfer_config=None):
+    # large files come down as concurrent ranged GETs, see core_s3_transfer.py
+    s3file_downloadurl = generate_presigned_url_for_getobject(awsconfig, "get_object", s3folderin, file)
+    filename = path.basename(file)
+    if not download_file_ranged(s3file_downloadurl, "tmp/"+filename, transfer_config or DEFAULT_TRANSFER_CONFIG):
+        raise RuntimeError("Download from S3 failed or incomplete for file: " + file)
+
+
+def _submit_one_file(session_id, file, k8s_url_for_scoring, deadline=None, output_format='csv'):
+    # returns http response of /executions. Scoring service answers 429 while its job queue is full; wait as told and retry.
+    # Compressed when the scoring service said it can take it, see validate_pingpong_on_scoring.
+    filename = path.basename(file)
+    upload_filename = "tmp/"+filename
+    encoding = _upload_encoding(k8s_url_for_scoring)
+    if encoding is not None:
+        upload_filename = _compress_file(upload_filename, encoding)
+    try:
+        while True:
+            with open(upload_filename,'rb') as f:
+                upload = (filename, f, UPLOAD_ENCODING_MIMETYPES[encoding]) if encoding is not None else f
+                http_response = session_id.post(url=k8s_url_for_scoring + "/executions",files={"file": upload},
+                                                data={"output_format": output_format})
+            if not http_response.status_code == 429:
+                return http_response
+            retry_after = int(http_response.headers.get('Retry-After', 5))
+            if deadline is not None and time.time() + retry_after > deadline:
+                return http_response
+            time.sleep(retry_after)
+    finally:
+        if encoding is not None and path.exists(upload_filename):
+            os.remove(upload_filename)
+
+
+def _score_one_file(session_id, awsconfig, s3folderin, file, k8s_url_for_scoring):
+    try:
+        _download_one_file(awsconfig, s3folderin, file)
+        http_response = _submit_one_file(session_id, file, k8s_url_for_scoring)
+        return http_response.text
+    except:
+        print("No response from one of requests in _score_one_file ")
+
+def _score_one_file_streaming(session_id, awsconfig, s3folderin, file, k8s_url_for_scoring):
+    # input goes straight from S3 into the scoring pod and scored rows come back while the upload is still running.
+    # Neither this client nor the pod keeps the input on disk. Needs in-process scoring on the pod.
+    # "scoring_unavailable" when the pod does not take a streaming session (no score_records, or no request threads
+    # left for one); the caller scores the file the regular way then.
+    s3file_downloadurl = generate_presigned_url_for_getobject(awsconfig, "get_object", s3folderin, file)
+    upload_result = {}
+
+    def _stream_input(scoring_token, cookies):
+        try:
+            r = requests.get(s3file_downloadurl, stream=True)
+            chunks = r.iter_content(chunk_size=1024 * 1024)
+            headers = {}
+            encoding = _upload_encoding(k8s_url_for_scoring)
+            if encoding is not None:
+                chunks = _compressed_chunks(chunks, encoding)
+                headers['Content-Encoding'] = encoding
+            upload_result['response'] = requests.put(url=k8s_url_for_scoring + "/executions/stream/" + scoring_token,
+                                                     data=chunks, headers=headers, cookies=cookies)
+        except:
+            upload_result['error'] = sys.exc_info()
+
+    try:
+        http_response = session_id.post(url=k8s_url_for_scoring + "/executions/stream")
+        if not http_response.status_code == 201:
+            print("Streaming scoring not available on scoring service:", http_response.text)
+            return "scoring_unavailable"
+        scoring_token = json.loads(http_response.text)["id"]
+
+        # same cookies so the upload lands on the pod holding this streaming session
+        uploader = threading.Thread(target=_stream_input, args=(scoring_token, session_id.cookies.copy()))
+        uploader.start()
+
+        r = session_id.get(k8s_url_for_scoring + "/query/" + scoring_token + "/stream", stream=True)
+        filename = path.basename(file)
+        with open("tmp/" + filename + ".scoreout", "wb") as s3csv:
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                if chunk:
+                    s3csv.write(chunk)
+        uploader.join()
+
+        if 'error' in upload_result or not upload_result['response'].status_code == 200:
+            print("Streaming input to scoring service failed:", upload_result.get('error', upload_result.get('response').text))
+            return "scoring_failed"
+        print("Retrieving scored output for :", file)
+        return "scoring_completed"
+    except:
+        print("Unexpected error:", sys.exc_info())
+        print("not proper response in _score_one_file_streaming method")
+        return "scoring_failed"
+
+
+def _get_scoring_result(session_id, file, scoring_token, k8s_url_for_scoring):
+    query_url = k8s_url_for_scoring + "/query/" + scoring_token
+    try:
+        r = session_id.get(query_url,stream=True)
+        if not r.status_code == 200 :
+            return "scoring_progress"
+        filename = path.basename(file)
+        with open("tmp/" + filename + ".scoreout", "wb") as s3csv:
+            for chunk in r.iter_content(chunk_size=1024):
+                if chunk:
+                    s3csv.write(chunk)
+        print("Retrieving scored output for :", file)
+        return "scoring_completed"
+    except:
+        print("Unexpected error:", sys.exc_info())
+        print("not proper response in _get_scoring_result method")
+        return "scoring_progress"
+
+
+def _get_scoring_status(session_id, scoring_token, k8s_url_for_scoring, wait=0, state=None):
+    # returns (status, waited). status is queued, running, succeeded or failed; None if scoring service has no
+    # /status (older model images) and caller has to fall back to checking /query directly. Long-polls up to wait
+    # secs for the status to change from state. waited is False when the service answered without long-polling.
+    status_url = k8s_url_for_scoring + "/status/" + scoring_token
+    params = {'wait': wait}
+    if state is not None:
+        params['state'] = state
+    try:
+        r = session_id.get(status_url, params=params, timeout=wait + 30)
+        if not r.status_code == 200:
+            return (None, False)
+        job_status = json.loads(r.text)
+        # services from before waited always long-polled
+        return (job_status["status"], job_status.get("waited", True))
+    except:
+        print("Unexpected error:", sys.exc_info())
+        print("not proper response in _get_scoring_status method")
+        return (None, False)
+
+
+def _status_poll_backoff(job_status, last_status, waited, backoff):
+    # secs to sleep before the next /status poll: backoff doubling to 10 while polls come back unchanged without
+    # having waited on the service, 0 otherwise. Returns (sleep, next backoff).
+    if job_status is None or (job_status == last_status and not waited):
+        return (backoff, min(backoff * 2, 10))
+    return (0, 0.5)
+
+
+def _scoreout_objkey(s3folderout, file, output_format='csv'):
+    parsed = urlparse(s3folderout, allow_fragments=False)
+    prefix = parsed.path.lstrip('/')
+    return prefix + path.basename(file)+SCOREOUT_SUFFIXES[output_format]
+
+
+def _upload_scoreout_one_file(session_id, awsconfig,s3folderout, file, transfer_config=None, output_format='csv'):
+    objkey = _scoreout_objkey(s3folderout, file, output_format)
+    scoreout_filename = "tmp/"+path.basename(file)+".scoreout"
+    # large outputs go up as parallel multipart upload, see core_s3_transfer.py
+    if use_multipart_upload(scoreout_filename, transfer_config):
+        if upload_file_multipart(awsconfig, s3folderout, objkey, scoreout_filename, transfer_config):
+            print("scored output put to S3:", objkey)
+            return 200
+        return 500
+    #print("objkey: ", objkey)
+    s3file_uploadurl = generate_presigned_url_for_postobject(awsconfig, s3folderout, objkey)
+    #print("s3 file upload URL", s3file_uploadurl)
+    try:
+        filename1 = {"file": open(scoreout_filename,'rb') }
+        http_response = requests.post(url=s3file_uploadurl['url'],data=s3file_uploadurl['fields'],files=filename1)
+        if not http_response.status_code in range(200,290):
+            print("file upload to s3 failed", http_response.status_code)
+            print("Full response:", http_response.text)
+        print("scored output put to S3:", objkey)
+        return http_response.status_code
+    except:
+        print("No response from one of requests _upload_scoreout_one_file to s3 ")
+        print ("http response from uploading to s3:", http_response.text)
+        return http_response.status_code
+
+def _score_one_file_direct_s3(awsconfig, s3folderin, s3folderout, file, k8s_url_for_scoring, deadline,
+                              output_format=None):
+    # scoring pod downloads input and uploads output itself with presigned URLs. We only submit and wait.
+    session_id = requests.session()
+    output_format = _output_format(file, output_format)
+    job = {
+        'input_url': generate_presigned_url_for_getobject(awsconfig, "get_object", s3folderin, file),
+        'output_post': generate_presigned_url_for_postobject(awsconfig, s3folderout,
+                                                             _scoreout_objkey(s3folderout, file, output_format)),
+        'filename': path.basename(file),
+        'output_format': output_format
+    }
+    try:
+        while True:
+            http_response = session_id.post(url=k8s_url_for_scoring + "/executions/s3", json=job)
+            retry_after = int(http_response.headers.get('Retry-After', 5))
+            if not http_response.status_code == 429 or time.time() + retry_after > deadline:
+                break
+            time.sleep(retry_after)
+        if not http_response.status_code == 201:
+            print("Scoring submission failed for file:", file, http_response.status_code, http_response.text)
+            return False
+        scoring_token = json.loads(http_response.text)["id"]
+        print("Set for scoring file, scoring_token :", file, scoring_token)
+
+        last_status = None
+        backoff = 0.5
+        while time.time() < deadline:
+            job_status, waited = _get_scoring_status(session_id, scoring_token, k8s_url_for_scoring,
+                                                     wait=max(min(20, int(deadline - time.time())), 0),
+                                                     state=last_status)
+            if job_status == "succeeded":
+                print("scored output put to S3 by scoring service:", _scoreout_objkey(s3folderout, file, output_format))
+                return True
+            if job_status == "failed":
+                print("Scoring failed for file. See /query/" + scoring_token + "/log :", file)
+                return False
+            # None: network error or ingress 5xx. Ask again after a backoff, the job runs on regardless.
+            sleep, backoff = _status_poll_backoff(job_status, last_status, waited, backoff)
+            time.sleep(sleep)
+            last_status = job_status
+        print("Went beyond allocated time for file:", file)
+        return False
+    except:
+        print("Unexpected error:", sys.exc_info())
+        print("Scoring failed for file in _score_one_file_direct_s3:", file)
+        return False
+
+
+def _score_local_file(session_id, file, k8s_url_for_scoring, deadline, output_format):
+    # submit tmp/<file>, wait on /status and fetch the result into tmp/<file>.scoreout. True once it is there.
+    http_response = _submit_one_file(session_id, file, k8s_url_for_scoring, deadline, output_format)
+    if not http_response.status_code == 201:
+        print("Scoring submission failed for file:", file, http_response.status_code, http_response.text)
+        return False
+    scoring_token = json.loads(http_response.text)["id"]
+    print("Set for scoring file, scoring_token :", file, scoring_token)
+
+    scoring_status = "scoring_progress"
+    last_status = None
+    backoff = 0.5
+    while scoring_status == "scoring_progress" and time.time() < deadline:
+        job_status, waited = _get_scoring_status(session_id, scoring_token, k8s_url_for_scoring,
+                                                 wait=max(min(20, int(deadline - time.time())), 0),
+                                                 state=last_status)
+        if job_status == "failed":
+            print("Scoring failed for file. See /query/" + scoring_token + "/log :", file)
+            return False
+        if job_status in ("succeeded", None):
+            scoring_status = _get_scoring_result(session_id, file, scoring_token, k8s_url_for_scoring)
+        if scoring_status == "scoring_progress":
+            sleep, backoff = _status_poll_backoff(job_status, last_status, waited, backoff)
+            time.sleep(sleep)
+            last_status = job_status
+    if not scoring_status == "scoring_completed":
+        print("Went beyond allocated time for file:", file)
+        return False
+    return True
+
+
+def _score_partitioned(file, k8s_url_for_scoring, deadline, partition_size, max_inflight_partitions):
+    # tmp/<file> is split into partitions (see core_partition.py) that are scored concurrently, each on a session of
+    # its own so the ingress spreads them over the replicas, then merged in row order into tmp/<file>.scoreout.
+    filename = path.basename(file)
+    partitions = split_csv_file("tmp/" + filename, partition_size)
+    # input is all in the partitions now. Keeps local disk at one copy.
+    os.remove("tmp/" + filename)
+    print("Scoring file in partitions:", file, "partitions:", len(partitions))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(partitions), max_inflight_partitions)) as executor:
+            results = list(executor.map(lambda partition: _score_local_file(requests.session(), partition,
+                                                                            k8s_url_for_scoring, deadline, 'csv'),
+                                        partitions))
+        if not all(results):
+            print("Partitioned scoring failed for file:", file, "partitions failed:", results.count(False))
+            return False
+        merge_csv_files([partition + ".scoreout" for partition in partitions], "tmp/" + filename + ".scoreout")
+        return True
+    finally:
+        for partition in partitions:
+            for tmp_file in (partition, partition + ".scoreout"):
+                if path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+
+def _score_and_upload_one_file(awsconfig, s3folderin, s3folderout, file, k8s_url_for_scoring, deadline,
+                               transfer_config=None, output_format=None, partition_size=0, max_inflight_partitions=16):
+    # whole life of one file: download, submit, wait on /status, fetch result, upload. Runs on a pipeline thread.
+    # Own session per file for cookie/session affinity to the pod holding the job.
+    # csv files above partition_size are scored in partitions across replicas instead.
+    session_id = requests.session()
+    filename = path.basename(file)
+    output_format = _output_format(file, output_format)
+    try:
+        _download_one_file(awsconfig, s3folderin, file, transfer_config)
+        if output_format == 'csv' and is_partitionable(file, path.getsize("tmp/" + filename), partition_size):
+            scored = _score_partitioned(file, k8s_url_for_scoring, deadline, partition_size, max_inflight_partitions)
+        else:
+            scored = _score_local_file(session_id, file, k8s_url_for_scoring, deadline, output_format)
+        if not scored:
+            return False
+
+        return _upload_scoreout_one_file(session_id, awsconfig, s3folderout, file, transfer_config,
+                                         output_format) in range(200, 299)
+    except:
+        print("Unexpected error:", sys.exc_info())
+        print("Scoring failed for file in _score_and_upload_one_file:", file)
+        return False
+    finally:
+        # keep local disk bounded however many files the folder holds
+        for tmp_file in ("tmp/" + filename, "tmp/" + filename + ".scoreout"):
+            if path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def _stream_and_upload_one_file(awsconfig, s3folderin, s3folderout, file, k8s_url_for_scoring, deadline,
+                                transfer_config=None, output_format=None, partition_size=0, max_inflight_partitions=16):
+    # csv in, csv out streamed through the scoring pod (see _score_one_file_streaming), so only the scored output
+    # lands on local disk. Other formats, and pods that cannot stream, go through _score_and_upload_one_file.
+    regular = functools.partial(_score_and_upload_one_file, awsconfig, s3folderin, s3folderout, file,
+                                k8s_url_for_scoring, deadline, transfer_config, output_format, partition_size,
+                                max_inflight_partitions)
+    if not (_output_format(file, None) == 'csv' and _output_format(file, output_format) == 'csv'):
+        return regular()
+    session_id = requests.session()
+    scoreout_filename = "tmp/" + path.basename(file) + ".scoreout"
+    try:
+        scoring_status = _score_one_file_streaming(session_id, awsconfig, s3folderin, file, k8s_url_for_scoring)
+        if scoring_status == "scoring_unavailable":
+            return regular()
+        if not scoring_status == "scoring_completed":
+            return False
+        return _upload_scoreout_one_file(session_id, awsconfig, s3folderout, file, transfer_config) in range(200, 299)
+    finally:
+        if path.exists(scoreout_filename):
+            os.remove(scoreout_filename)
+
+
+def _score_and_cache_one_file(score_one_file, awsconfig, s3folderin, s3folderout, file, k8s_url_for_scoring, deadline,
+                              result_cache=None, output_format=None):
+    if not score_one_file(awsconfig, s3folderin, s3folderout, file, k8s_url_for_scoring, deadline):
+        return False
+    output_format = _output_format(file, output_format)
+    store_in_result_cache(awsconfig, s3folderout, _scoreout_objkey(s3folderout, file, output_format),
+                          result_cache['folder'], result_cache['etags'][file], result_cache['image_digest'],
+                          output_format)
+    return True
+
+
+def score_s3files_from_result_cache(awsconfig, s3folderout, files, result_cache, output_format=None):
+    # files ({'Key', 'ETag', ...}) scored before with this model image get their scoreout copied from the result cache
+    # (see core_result_cache.py). Returns the files that still need scoring.
+    def _serve_from_cache(file):
+        file_output_format = _output_format(file['Key'], output_format)
+        entry_key = lookup_result_cache(awsconfig, result_cache['folder'], file['ETag'], result_cache['image_digest'],
+                                        file_output_format, result_cache['max_age'])
+        if entry_key is None:
+            return False
+        objkey = _scoreout_objkey(s3folderout, file['Key'], file_output_format)
+        if not copy_from_result_cache(awsconfig, result_cache['folder'], entry_key, s3folderout, objkey):
+            return False
+        print("scored output copied from result cache:", objkey)
+        return True
+
+    files = list(files)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        served = list(executor.map(_serve_from_cache, files))
+    print("Files served from result cache:", served.count(True), "files to score:", served.count(False))
+    return [file for file, hit in zip(files, served) if not hit]
+
+
+def score_s3files_concurrent_controller(awsconfig, s3folderin, s3folderout, k8s_url_for_scoring, maxtime_scoring,
+                                        max_inflight_files=16, direct_s3_io=False, s3files=None, transfer_config=None,
+                                        output_format=None, partition_size=0, result_cache=None, streaming=False):
+    # Pipelined version of score_s3files_controller. Each file goes through download, submit, poll and upload on its
+    # own thread and its result is uploaded as soon as it is ready. At most max_inflight_files files are in flight, so
+    # threads, sessions and local disk stay bounded for folders with any number of files.
+    # With direct_s3_io the scoring pod moves the bytes to and from S3 itself and this controller only coordinates.
+    # s3files gives the keys to score in submission order (largest first from plan_scaling); default lists s3folderin.
+    # transfer_config (get_transfer_config) enables parallel multipart upload of large outputs.
+    # output_format csv, parquet or arrow for all scored outputs; None keeps each input file's format.
+    # partition_size > 0 scores csv files above it in partitions across replicas (not with direct_s3_io, the bytes
+    # have to come through here to be split).
+    # streaming streams csv files through the scoring pods instead (_stream_and_upload_one_file). Such files are
+    # scored whole, not in partitions.
+    score_one_file = functools.partial(_stream_and_upload_one_file if streaming else _score_and_upload_one_file,
+                                       transfer_config=transfer_config, output_format=output_format,
+                                       partition_size=partition_size, max_inflight_partitions=max_inflight_files)
+    if direct_s3_io:
+        score_one_file = functools.partial(_score_one_file_direct_s3, output_format=output_format)
+    # result_cache {'folder', 'image_digest', 'etags' (Key -> ETag)} keeps each scored output in the result cache.
+    if result_cache is not None:
+        score_one_file = functools.partial(_score_and_cache_one_file, score_one_file, result_cache=result_cache,
+                                           output_format=output_format)
+    print("Concurrent scoring process started at ", time.ctime(time.time()))
+    deadline = time.time() + maxtime_scoring
+    files_scored = 0
+    files_failed = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_inflight_files) as executor:
+        in_flight = {}
+        for file in (s3files if s3files is not None else _get_s3file_list(awsconfig, s3folderin)):
+            if len(in_flight) >= max_inflight_files:
+                done, pending = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future.result():
+                        files_scored += 1
+                    else:
+                        files_failed += 1
+                    del in_flight[future]
+            future = executor.submit(score_one_file, awsconfig, s3folderin, s3folderout, file,
+                                     k8s_url_for_scoring, deadline)
+            in_flight[future] = file
+
+        for future in concurrent.futures.as_completed(in_flight):
+            if future.result():
+                files_scored += 1
+            else:
+                files_failed += 1
+
+    print("Concurrent scoring process Ended at ", time.ctime(time.time()), "files scored:", files_scored,
+          "files failed:", files_failed)
+    if files_failed > 0:
+        return 1
+
+
+def score_s3files_controller(awsconfig,s3folderin,s3folderout,k8s_url_for_scoring, maxtime_scoring):
+    # build a session_list structure that has 4 tuples for each entry. This 4 tuple helps us maintain control over job execution
+    # 1. session_id to help cookie and session affinity 2. file - name of file we are dealing
+    # 3. token - used to check back on status from scoring service 4. actual status of job
+
+    print("Scoring process started at ", time.ctime(time.time()))
+
+    sessions_list = []
+    s3file_list = _get_s3file_list(awsconfig,s3folderin)
+
+    # Phase1 - submit scoring job for each file. All scoring is done in parallel with a fire-and-forget approach
+    # but do save scoring_token from each submission. We need these to go back and retreive scored output in phase1
+    for file in s3file_list:
+        session_id = requests.session()
+        scoring_result = _score_one_file(session_id, awsconfig, s3folderin, file, k8s_url_for_scoring)
+        scoring_token = json.loads(scoring_result)["id"]
+        sessions_list.append((session_id, file, scoring_token, "scoring_started"))
+        print("Set for scoring file, scoring_token, sessionid :", file, scoring_token, session_id)
+
+    # for debug purposes save as pickle file and then reload
+    #print("session list:", sessions_list )
+    #with open("tmp/session_list.dat", "wb") as f:
+    #    pickle.dump(sessions_list, f)
+
+    # phase2 - check status of each scoring job. # wait on this until all jobs are complete.
+    # Ask /status first and only fetch output once job succeeded. Back off between rounds so we do not hammer ingress.
+    jobs_pending = True
+    backoff = 0.5
+    start = time.time()
+    while jobs_pending and (time.time() - start < maxtime_scoring):
+        jobs_pending = False # just set it to false if any of jobs is still in progress we will set it back to True
+        for session_item in range(len(sessions_list)):
+            session_id, file, scoring_token, scoring_status = sessions_list[session_item]
+            if scoring_status not in ("scoring_completed", "scoring_failed"):
+                job_status, waited = _get_scoring_status(session_id, scoring_token, k8s_url_for_scoring)
+                if job_status == "failed":
+                    print("Scoring failed for file. See /query/" + scoring_token + "/log :", file)
+                    scoring_status = "scoring_failed"
+                elif job_status in ("succeeded", None):
+                    scoring_status = _get_scoring_result(session_id, file, scoring_token, k8s_url_for_scoring)
+            if scoring_status not in ("scoring_completed", "scoring_failed"):
+                jobs_pending = True
+            sessions_list[session_item] = ( session_id, file, scoring_token, scoring_status)
+        if jobs_pending:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 10)
+
+
+    if jobs_pending:
+        print("Went beyond allocated time. Aborting scoring ")
+        print("Time limit for scoring in secs: ",maxtime_scoring, "start time: ", time.ctime(start), "current time: ", time.ctime(time.time()))
+        return 1
+
+    # phase-3  upload each scored output file to s3
+    scoring_failed = False
+    for session_item in range(len(sessions_list)):
+        session_id, file, scoring_token, scoring_status = sessions_list[session_item]
+        if scoring_status == "scoring_failed":
+            scoring_failed = True
+            continue
+        if not _upload_scoreout_one_file(session_id, awsconfig, s3folderout, file) in range (200,299):
+            return 1
+
+    print("Scoring process Ended at ", time.ctime(time.time()))
+    if scoring_failed:
+        return 1
+
+
+########
+##
+# Real-time scoring through /score on the scoring service: one record (dict) or a small list of them, scores come back
+# in the response. Sessions are kept per thread and scoring url so calls reuse keep-alive connections; a new TCP
+# connection per record would cost more than scoring it. requests sessions are not thread safe, hence per thread.
+_realtime_sessions = threading.local()
+
+
+def _realtime_session(k8s_url_for_scoring):
+    sessions = getattr(_realtime_sessions, 'sessions', None)
+    if sessions is None:
+        sessions = _realtime_sessions.sessions = {}
+    session_id = sessions.get(k8s_url_for_scoring)
+    if session_id is None:
+        session_id = sessions[k8s_url_for_scoring] = requests.session()
+    return session_id
+
+
+def score_records_realtime(k8s_url_for_scoring, records, timeout=5):
+    # dict of scores for a dict, list of them (same order) for a list. Raises requests.exceptions.HTTPError when the
+    # service refused or failed the request (e.g. 501 for images without in-process scoring).
+    http_response = _realtime_session(k8s_url_for_scoring.rstrip('/')).post(
+        url=k8s_url_for_scoring.rstrip('/') + "/score", json=records, timeout=timeout)
+    http_response.raise_for_status()
+    return http_response.json()
+
+
+if __name__ == '__main__':
+    validate_pingpong_on_scoring("http://ab9f8139f783911eabed40a902ea44af-1673116921.us-east-1.elb.amazonaws.com:8080/")
+
+
+
+
+
+
+
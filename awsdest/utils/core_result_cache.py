@@ -0,0 +1,85 @@
+import datetime
+import hashlib
+from urllib.parse import urlparse
+
+from awsdest.utils.core_aws import *
+
+########
+##
+# Cache of scored outputs keyed by (input ETag, model image digest, output format). An entry is a copy of the scoreout
+# kept under <s3folderout>/_scorecache/, so a file scored before with the very same model image is copied from there
+# instead of provisioning pods and scoring it again. S3 ETags are content hashes (for uploads in one part), so the same
+# content under a new name hits as well. The image digest rather than the tag makes a re-pushed :latest miss.
+# Entries older than scoring.cache.max.age secs are ignored and evicted; beyond scoring.cache.max.bytes in total the
+# oldest go first. Lambda keeps the same layout, see lambdafunc_core_result_cache.py.
+RESULT_CACHE_FOLDER = "_scorecache/"
+
+
+def result_cache_folder(s3folderout):
+    return s3folderout.rstrip('/') + '/' + RESULT_CACHE_FOLDER
+
+
+def _cache_entry_key(cache_folder, etag, image_digest, output_format):
+    prefix = urlparse(cache_folder, allow_fragments=False).path.lstrip('/')
+    return prefix + hashlib.sha256((etag.strip('"') + "/" + image_digest + "/" + output_format).encode('utf-8')).hexdigest()
+
+
+def _age_secs(last_modified):
+    return (datetime.datetime.now(datetime.timezone.utc) - last_modified).total_seconds()
+
+
+def lookup_result_cache(awsconfig, cache_folder, etag, image_digest, output_format, max_age):
+    # key of a fresh entry, None on a miss.
+    bucket = urlparse(cache_folder, allow_fragments=False).netloc
+    entry_key = _cache_entry_key(cache_folder, etag, image_digest, output_format)
+    try:
+        response = get_aws_client(awsconfig, 's3').head_object(Bucket=bucket, Key=entry_key)
+    except ClientError as e:
+        if not e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            print("Unexpected error while looking up result cache: %s" % e)
+        return None
+    if _age_secs(response['LastModified']) > max_age:
+        return None
+    return entry_key
+
+
+def _copy_s3object(awsconfig, bucket_from, key_from, bucket_to, key_to):
+    # managed copy, multipart for objects above 5GB. Bytes stay within S3.
+    try:
+        get_aws_client(awsconfig, 's3').copy({'Bucket': bucket_from, 'Key': key_from}, bucket_to, key_to)
+        return True
+    except ClientError as e:
+        print("Unexpected error while copying s3 object %s: %s" % (key_from, e))
+        return False
+
+
+def copy_from_result_cache(awsconfig, cache_folder, entry_key, s3folderout, objkey):
+    return _copy_s3object(awsconfig, urlparse(cache_folder, allow_fragments=False).netloc, entry_key,
+                          urlparse(s3folderout, allow_fragments=False).netloc, objkey)
+
+
+def store_in_result_cache(awsconfig, s3folderout, objkey, cache_folder, etag, image_digest, output_format):
+    return _copy_s3object(awsconfig, urlparse(s3folderout, allow_fragments=False).netloc, objkey,
+                          urlparse(cache_folder, allow_fragments=False).netloc,
+                          _cache_entry_key(cache_folder, etag, image_digest, output_format))
+
+
+def evict_result_cache(awsconfig, cache_folder, max_age, max_bytes):
+    entries = sorted(iter_s3folder_objects(awsconfig, cache_folder), key=lambda entry: entry['LastModified'])
+    total_bytes = sum(entry['Size'] for entry in entries)
+    evicted = []
+    for entry in entries:
+        if _age_secs(entry['LastModified']) > max_age or total_bytes > max_bytes:
+            evicted.append({'Key': entry['Key']})
+            total_bytes -= entry['Size']
+
+    bucket = urlparse(cache_folder, allow_fragments=False).netloc
+    s3_client = get_aws_client(awsconfig, 's3')
+    try:
+        # delete_objects takes 1000 keys per call
+        for batch in range(0, len(evicted), 1000):
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': evicted[batch:batch + 1000], 'Quiet': True})
+    except ClientError as e:
+        print("Unexpected error while evicting result cache entries: %s" % e)
+        return
+    print("Result cache entries:", len(entries) - len(evicted), "bytes:", total_bytes, "evicted:", len(evicted))
@@ -0,0 +1,199 @@
+import concurrent.futures
+import math
+import os
+import time
+
+import requests
+
+from awsdest.utils.core_aws import *
+
+########
+##
+# Parallel S3 transfers for large files. Uploads go through S3 multipart upload with presigned UploadPart URLs: the
+# file is cut into parts that are PUT concurrently, each retried on its own, so one TCP stream or one failure no
+# longer limits a file of tens of GB (a single POST also stops at 5 GB).
+# transfer_config keys: multipart_threshold, multipart_part_size, multipart_concurrency, multipart_part_retries.
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+DEFAULT_TRANSFER_CONFIG = {
+    'multipart_threshold': 64 * 1024 * 1024,
+    'multipart_part_size': 32 * 1024 * 1024,
+    'multipart_concurrency': 8,
+    'multipart_part_retries': 3
+}
+
+
+def get_transfer_config(siteconfig):
+    return {
+        'multipart_threshold': siteconfig.get('s3_multipart_threshold', DEFAULT_TRANSFER_CONFIG['multipart_threshold']),
+        'multipart_part_size': siteconfig.get('s3_multipart_part_size', DEFAULT_TRANSFER_CONFIG['multipart_part_size']),
+        'multipart_concurrency': siteconfig.get('s3_multipart_concurrency', DEFAULT_TRANSFER_CONFIG['multipart_concurrency']),
+        'multipart_part_retries': siteconfig.get('s3_multipart_part_retries', DEFAULT_TRANSFER_CONFIG['multipart_part_retries'])
+    }
+
+
+def use_multipart_upload(filename, transfer_config):
+    return transfer_config is not None and os.path.getsize(filename) >= transfer_config['multipart_threshold']
+
+
+class _FilePart(object):
+    # read-only view of length bytes of a file from offset. requests streams it from disk with a Content-Length, so
+    # concurrency x part size never has to fit in memory.
+    def __init__(self, filename, offset, length):
+        self._file = open(filename, 'rb')
+        self._file.seek(offset)
+        self._remaining = length
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def _part_layout(file_size, part_size):
+    # S3 wants parts of at least 5MB (except the last) and at most 10000 of them. Returns [(offset, length)].
+    part_size = max(part_size, S3_MIN_PART_SIZE, int(math.ceil(file_size / S3_MAX_PARTS)))
+    return [(offset, min(part_size, file_size - offset)) for offset in range(0, max(file_size, 1), part_size)]
+
+
+def _put_part(part_url, filename, offset, length, retries):
+    # returns ETag of the uploaded part or None once retries are used up.
+    for attempt in range(retries + 1):
+        part = _FilePart(filename, offset, length)
+        try:
+            http_response = requests.put(part_url, data=part, timeout=(10, 300))
+            if http_response.status_code == 200:
+                return http_response.headers['ETag']
+            print("part upload to s3 failed", http_response.status_code, http_response.text)
+        except requests.exceptions.RequestException as e:
+            print("part upload to s3 failed", str(e))
+        finally:
+            part.close()
+        time.sleep(min(2 ** attempt, 30))
+    return None
+
+
+def upload_file_multipart(awsconfig, s3folder, objectkey, filename, transfer_config):
+    # True once the object is complete in S3. On any part failing for good the upload is aborted.
+    parts_layout = _part_layout(os.path.getsize(filename), transfer_config['multipart_part_size'])
+    upload_id = create_multipart_upload(awsconfig, s3folder, objectkey)
+    if upload_id is None:
+        return False
+
+    try:
+        # URLs have to outlive the slowest part, not just the first.
+        part_urls = generate_presigned_urls_for_uploadpart(awsconfig, s3folder, objectkey, upload_id,
+                                                           len(parts_layout), expires_in=6 * 3600)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=transfer_config['multipart_concurrency']) as executor:
+            etags = list(executor.map(lambda part: _put_part(part[0], filename, part[1][0], part[1][1],
+                                                             transfer_config['multipart_part_retries']),
+                                      zip(part_urls, parts_layout)))
+        if None in etags:
+            print("multipart upload to s3 failed for", objectkey, "parts failed:", etags.count(None))
+            abort_multipart_upload(awsconfig, s3folder, objectkey, upload_id)
+            return False
+
+        parts = [{'ETag': etag, 'PartNumber': part_number} for part_number, etag in enumerate(etags, start=1)]
+        if not complete_multipart_upload(awsconfig, s3folder, objectkey, upload_id, parts):
+            abort_multipart_upload(awsconfig, s3folder, objectkey, upload_id)
+            return False
+    except Exception:
+        abort_multipart_upload(awsconfig, s3folder, objectkey, upload_id)
+        raise
+
+    print("multipart upload to s3 complete:", objectkey, "parts:", len(parts_layout))
+    return True
+
+
+########
+##
+# Downloads: concurrent byte-range GETs against the presigned URL, each written at its offset into a preallocated
+# file. Uses the same threshold, part size, concurrency and retries as uploads.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _probe_object(s3file_downloadurl):
+    # (size, etag) from a one byte ranged GET. size None when the server ignored the range and sent the whole object.
+    with requests.get(s3file_downloadurl, headers={'Range': 'bytes=0-0'}, stream=True, timeout=(10, 60)) as http_response:
+        if http_response.status_code == 416:
+            # empty object, nothing to range over
+            return (0, None)
+        http_response.raise_for_status()
+        etag = http_response.headers.get('ETag')
+        if http_response.status_code == 206:
+            return (int(http_response.headers['Content-Range'].split('/')[-1]), etag)
+        return (None, etag)
+
+
+def _download_single_stream(s3file_downloadurl, filename):
+    with requests.get(s3file_downloadurl, stream=True, timeout=(10, 300)) as http_response:
+        http_response.raise_for_status()
+        written = 0
+        with open(filename, "wb") as f:
+            for chunk in http_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+        expected = http_response.headers.get('Content-Length')
+        return expected is None or written == int(expected)
+
+
+def _get_range(s3file_downloadurl, filename, offset, length, etag, retries):
+    # bytes written to [offset, offset + length): length once the range is complete, 0 if it failed. If-Match makes
+    # S3 refuse (412) if the object was replaced since the probe, so ranges of two different versions never end up
+    # in one file.
+    headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+    if etag is not None:
+        headers['If-Match'] = etag
+    for attempt in range(retries + 1):
+        try:
+            with requests.get(s3file_downloadurl, headers=headers, stream=True, timeout=(10, 300)) as http_response:
+                if http_response.status_code == 412:
+                    print("s3 object changed during download")
+                    return 0
+                if http_response.status_code == 206:
+                    written = 0
+                    with open(filename, "r+b") as f:
+                        f.seek(offset)
+                        for chunk in http_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            # more than asked for would overwrite the next range
+                            if written + len(chunk) > length:
+                                break
+                            f.write(chunk)
+                            written += len(chunk)
+                        else:
+                            if written == length:
+                                return written
+                print("range download from s3 failed", http_response.status_code, offset, length)
+        except requests.exceptions.RequestException as e:
+            print("range download from s3 failed", str(e))
+        time.sleep(min(2 ** attempt, 30))
+    return 0
+
+
+def download_file_ranged(s3file_downloadurl, filename, transfer_config):
+    # True once every range of the object is written, their bytes adding up to the size S3 reported. The file is
+    # preallocated to that size, so its size on disk says nothing.
+    size, etag = _probe_object(s3file_downloadurl)
+    if size is None or size < transfer_config['multipart_threshold']:
+        return _download_single_stream(s3file_downloadurl, filename)
+
+    with open(filename, "wb") as f:
+        f.truncate(size)
+    ranges = _part_layout(size, transfer_config['multipart_part_size'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=transfer_config['multipart_concurrency']) as executor:
+        written = list(executor.map(lambda part: _get_range(s3file_downloadurl, filename, part[0], part[1], etag,
+                                                            transfer_config['multipart_part_retries']), ranges))
+    failed = [part for part, part_written in zip(ranges, written) if not part_written == part[1]]
+    if failed:
+        print("ranged download from s3 failed for", filename, "ranges failed:", len(failed))
+        return False
+    return sum(written) == size
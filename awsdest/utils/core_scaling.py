@@ -0,0 +1,158 @@
+import heapq
+import json
+import math
+import os
+import threading
+
+from awsdest.utils.core_aws import *
+from awsdest.utils.core_partition import *
+
+########
+##
+# Replica scaling policies for create_deployment_for_model. A policy looks at the files about to be scored
+# ({'Key', 'Size', 'ETag'} from iter_s3folder_objects) and returns how many replicas it wants. plan_scaling caps that,
+# assigns files to replicas and returns the plan both the deployment and the scoring controller work from:
+#   {'policy', 'replicas', 'files' (submission order), 'assignment' (files per replica), 'makespan' (est secs or None)}
+# Add a policy with @scaling_policy("name") and select it with scaling.policy in config.properties.
+# With scoring.partition.size set, csv files above it count as one unit per partition since each partition can go to
+# a different replica; policies and the assignment then work on those units.
+SCALING_POLICIES = {}
+
+
+def scaling_policy(name):
+    def register(policy):
+        SCALING_POLICIES[name] = policy
+        return policy
+    return register
+
+
+def _total_bytes(files):
+    return sum(file['Size'] for file in files)
+
+
+def _lpt_assignment(files, replicas):
+    # longest processing time first: biggest file to the least loaded replica. Makespan stays within 4/3 of optimal.
+    # Returns (files per replica, bytes on the busiest replica).
+    loads = [(0, replica) for replica in range(replicas)]
+    assignment = [[] for replica in range(replicas)]
+    for file in sorted(files, key=lambda file: file['Size'], reverse=True):
+        load, replica = heapq.heappop(loads)
+        assignment[replica].append(file)
+        heapq.heappush(loads, (load + file['Size'], replica))
+    return assignment, max(load for load, replica in loads)
+
+
+@scaling_policy("simple-total-file-based")
+def _replicas_per_file(files, siteconfig, bytes_per_sec):
+    return len(files)
+
+
+@scaling_policy("total-bytes")
+def _replicas_by_total_bytes(files, siteconfig, bytes_per_sec):
+    return math.ceil(_total_bytes(files) / siteconfig['scaling_bytes_per_replica'])
+
+
+@scaling_policy("per-file-size")
+def _replicas_by_file_size(files, siteconfig, bytes_per_sec):
+    # a file is scored by one replica, so makespan never beats the largest file. Replicas beyond
+    # total / largest would only sit idle.
+    largest = max(file['Size'] for file in files)
+    if largest == 0:
+        return len(files)
+    return math.ceil(_total_bytes(files) / largest)
+
+
+@scaling_policy("throughput")
+def _replicas_by_throughput(files, siteconfig, bytes_per_sec):
+    # fewest replicas whose estimated makespan at this model image's measured throughput fits time.limit.on.scoring.
+    # Without history for the image it is the same as per-file-size.
+    upper = min(_replicas_by_file_size(files, siteconfig, bytes_per_sec), siteconfig['scaling_max_replicas'])
+    if bytes_per_sec is None:
+        return upper
+    for replicas in range(1, upper + 1):
+        assignment, busiest_bytes = _lpt_assignment(files, replicas)
+        if busiest_bytes / bytes_per_sec <= siteconfig['time.limit.on.scoring']:
+            return replicas
+    return upper
+
+
+def _planning_units(files, partition_size):
+    units = []
+    for file in files:
+        if is_partitionable(file['Key'], file['Size'], partition_size):
+            count = partition_count(file['Size'], partition_size)
+            units.extend(dict(file, Size=int(math.ceil(file['Size'] / count))) for partition in range(count))
+        else:
+            units.append(file)
+    return units
+
+
+def plan_scaling(siteconfig, model_imagename, files):
+    policy_name = siteconfig['scaling_policy']
+    if policy_name not in SCALING_POLICIES:
+        raise ValueError("Unknown scaling policy " + policy_name + ". Known: " + ", ".join(sorted(SCALING_POLICIES)))
+
+    files = list(files)
+    units = _planning_units(files, siteconfig['scoring_partition_size'])
+    bytes_per_sec = get_scoring_throughput(siteconfig, model_imagename)
+    replicas = SCALING_POLICIES[policy_name](units, siteconfig, bytes_per_sec) if units else 1
+    # more replicas than files (partitions) never helps and scaling.max.replicas keeps us within the cluster.
+    replicas = max(1, min(replicas, len(units), siteconfig['scaling_max_replicas']))
+    assignment, busiest_bytes = _lpt_assignment(units, replicas)
+
+    scaling_plan = {
+        'policy': policy_name,
+        'replicas': replicas,
+        # replicas sit behind one service so the closest we get to the assignment is submitting largest first.
+        'files': sorted(files, key=lambda file: file['Size'], reverse=True),
+        'assignment': assignment,
+        'makespan': busiest_bytes / bytes_per_sec if bytes_per_sec else None
+    }
+    print("Scaling policy:", policy_name, "files:", len(files), "partitions:", len(units), "bytes:", _total_bytes(files),
+          "replicas:", replicas, "estimated makespan secs:", scaling_plan['makespan'])
+    return scaling_plan
+
+
+########
+##
+# Scoring throughput history per model image, bytes/sec a single replica gets through. Kept as json in
+# scaling.history.file and smoothed across runs so one slow run does not swing the next plan.
+THROUGHPUT_SMOOTHING = 0.5
+_history_lock = threading.Lock()
+
+
+def _load_scaling_history(history_file):
+    if not os.path.exists(history_file):
+        return {}
+    try:
+        with open(history_file) as f:
+            return json.load(f)
+    except ValueError:
+        print("Ignoring unreadable scaling history file:", history_file)
+        return {}
+
+
+def get_scoring_throughput(siteconfig, model_imagename):
+    with _history_lock:
+        history = _load_scaling_history(siteconfig['scaling_history_file'])
+    return history.get(model_imagename, {}).get('bytes_per_sec')
+
+
+def record_scoring_throughput(siteconfig, model_imagename, scaling_plan, elapsed_secs):
+    # the busiest replica decides how long the run took, so its bytes over elapsed is what one replica manages.
+    busiest_bytes = max(_total_bytes(files) for files in scaling_plan['assignment'])
+    if elapsed_secs <= 0 or busiest_bytes == 0:
+        return
+    measured = busiest_bytes / elapsed_secs
+
+    with _history_lock:
+        history_file = siteconfig['scaling_history_file']
+        history = _load_scaling_history(history_file)
+        previous = history.get(model_imagename, {}).get('bytes_per_sec')
+        bytes_per_sec = measured if previous is None else \
+            THROUGHPUT_SMOOTHING * measured + (1 - THROUGHPUT_SMOOTHING) * previous
+        history[model_imagename] = {'bytes_per_sec': bytes_per_sec, 'runs': history.get(model_imagename, {}).get('runs', 0) + 1}
+        with open(history_file + ".tmp", "w") as f:
+            json.dump(history, f, indent=2)
+        os.replace(history_file + ".tmp", history_file)
+    print("Scoring throughput for", model_imagename, "bytes/sec per replica:", round(bytes_per_sec, 1))